@@ -2,7 +2,6 @@
 
 # required env vars:
 # HASH
-# HASH_ORIG
 # KERNELDIR
 # KERNEL_RELEASE
 # OUTPUT
@@ -11,11 +10,25 @@
 # PROBE_VERSION
 
 # optional env vars
+# CCACHE_DIR (use ccache, if available, with the cache in this directory)
+# CCACHE_MAXSIZE
 # CLANG
 # LLC
+# MAKE_JOBS (number of parallel make jobs)
+
+# usage: builder-entrypoint.sh [bpf|all|configure]
+#   (no argument) build the kernel module
+#   bpf           build the eBPF probe
+#   all           build both probes out of a single configured source tree
+#   configure     configure the source tree once and save it to /code/prepared
+#                 (subsequent builds with /code/prepared mounted will skip cmake)
+#   ccache-stats  print (and reset) the statistics of the compiler cache in CCACHE_DIR
 
 export CLANG=${CLANG:-clang}
 export LLC=${LLC:-llc}
+if [[ -n "${MAKE_JOBS:-}" ]]; then
+	export MAKEFLAGS="-j${MAKE_JOBS} ${MAKEFLAGS:-}"
+fi
 
 set -euo pipefail
 
@@ -43,14 +56,7 @@ call_cmake() {
 	cmake -DBUILD_DRIVER=On -DBUILD_BPF=On -DCMAKE_BUILD_TYPE=Release -D${PROBE_NAME_PARAM}=$PROBE_NAME -D${PROBE_VERSION_PARAM}=$PROBE_VERSION -D${PROBE_DEVICE_NAME_PARAM}=$PROBE_DEVICE_NAME -DCREATE_TEST_TARGETS=OFF ${SRC_DIR}
 }
 
-build_kmod() {
-	if [[ -f "${KERNELDIR}/scripts/gcc-plugins/stackleak_plugin.so" ]]; then
-		echo "Rebuilding gcc plugins for ${KERNELDIR}"
-		(cd "${KERNELDIR}" && make gcc-plugins)
-	fi
-
-	echo Building $PROBE_NAME-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.ko
-
+configure_source() {
 	mkdir -p /build/sysdig
 	cd /build/sysdig
 
@@ -58,13 +64,132 @@ build_kmod() {
 	if call_cmake /code/sysdig-rw; then
 		# cmake was successful, we'll run 'make' from within the
 		# /build/sysdig directory where cmake copied all files for us
-		make -C /build/sysdig driver
+		CMAKE_CONFIGURED=1
 		BUILD_DIR=/build/sysdig/driver
 	else
 		# cmake failed, so we're probably dealing with an agent-kmodule.tgz
 		# package file and we can therefore run make from the source tree
 		# (without the driver/ prefix)
+		CMAKE_CONFIGURED=0
+		BUILD_DIR=/code/sysdig-rw
+	fi
+}
+
+# save the configured tree to /code/prepared so that the per-kernel builds
+# only need to copy the driver sources and run make
+save_prepared_source() {
+	if [[ $CMAKE_CONFIGURED == 1 ]]; then
+		# keep the driver sources, along with all the files cmake checks
+		# to decide whether the build system needs to be regenerated
+		# (cp -a preserves their timestamps, so it won't be)
+		mkdir -p /code/prepared/src
+		cd /code/sysdig-rw
+		CMAKE_DEPENDS=$(grep -o '"/code/sysdig-rw/[^"]*"' /build/sysdig/CMakeFiles/Makefile.cmake | sed -e 's|^"/code/sysdig-rw/||' -e 's|"$||' | sort -u)
+		cp -a --parents driver /code/prepared/src
+		for f in $CMAKE_DEPENDS; do
+			if [[ -e $f ]]; then
+				cp -a --parents $f /code/prepared/src
+			fi
+		done
+		cp -a /build/sysdig /code/prepared/build
+	else
+		cp -a /code/sysdig-rw /code/prepared/src
+	fi
+	echo $CMAKE_CONFIGURED > /code/prepared/.configured
+}
+
+# if we have been given a compiler cache, put ccache in front of
+# the compilers used by the kernel build and the eBPF probe build
+setup_ccache() {
+	if [[ -z "${CCACHE_DIR:-}" ]]; then
+		return
+	fi
+	CCACHE=$(type -p ccache || true)
+	if [[ -z "$CCACHE" ]]; then
+		echo "ccache not available, building without a compiler cache"
+		return
+	fi
+
+	mkdir -p /tmp/ccache-bin
+	for compiler in gcc cc clang $(basename $CLANG); do
+		ln -sf $CCACHE /tmp/ccache-bin/$compiler
+	done
+	export PATH=/tmp/ccache-bin:$PATH
+	# the cache is per builder image, but make sure we never
+	# reuse objects built by a different compiler binary
+	export CCACHE_COMPILERCHECK=content
+	if [[ -n "${CCACHE_MAXSIZE:-}" ]]; then
+		ccache -M "$CCACHE_MAXSIZE" > /dev/null
+	fi
+}
+
+ccache_stats() {
+	if ! type -p ccache > /dev/null; then
+		echo "ccache not available"
+		return
+	fi
+	ccache -s
+	ccache -z > /dev/null
+}
+
+# empty a directory, which may be a (tmpfs) mount point
+# so we can't just remove and recreate it
+clean_dir() {
+	mkdir -p $1
+	find $1 -mindepth 1 -maxdepth 1 -exec rm -rf {} +
+}
+
+# use the tree saved by save_prepared_source: just the driver sources and the cmake
+# build directory (probe_builder mounts tmpfs on /code/sysdig-rw and /build/sysdig for it)
+use_prepared_source() {
+	clean_dir /code/sysdig-rw
+	clean_dir /build/sysdig
+	cp -a /code/prepared/src/. /code/sysdig-rw/
+	CMAKE_CONFIGURED=$(cat /code/prepared/.configured)
+	if [[ $CMAKE_CONFIGURED == 1 ]]; then
+		cp -a /code/prepared/build/. /build/sysdig/
+		BUILD_DIR=/build/sysdig/driver
+	else
 		BUILD_DIR=/code/sysdig-rw
+	fi
+}
+
+# make a local copy of the source code so we can
+# run cmake on it without altering the code on the host
+# (skip the git metadata, we don't need it to build the driver)
+# without a prepared tree, this is the whole checkout, so it stays on disk
+copy_source() {
+	clean_dir /code/sysdig-rw
+	find /code/sysdig-ro -mindepth 1 -maxdepth 1 ! -name .git -exec cp -a {} /code/sysdig-rw/ \;
+}
+
+setup_source() {
+	if [[ -e /code/prepared/.configured ]]; then
+		use_prepared_source
+	else
+		copy_source
+		configure_source
+	fi
+}
+
+# replace the output file instead of writing into it,
+# it may be a hard link to identical probes of other kernels
+install_output() {
+	cp $1 $2.tmp
+	mv -f $2.tmp $2
+}
+
+build_kmod() {
+	if [[ -f "${KERNELDIR}/scripts/gcc-plugins/stackleak_plugin.so" ]]; then
+		echo "Rebuilding gcc plugins for ${KERNELDIR}"
+		(cd "${KERNELDIR}" && make gcc-plugins)
+	fi
+
+	echo Building $PROBE_NAME-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.ko
+
+	if [[ $CMAKE_CONFIGURED == 1 ]]; then
+		make -C /build/sysdig driver
+	else
 		make -C $BUILD_DIR all
 	fi
 	strip -g $BUILD_DIR/$PROBE_NAME.ko
@@ -75,8 +200,7 @@ build_kmod() {
 		exit 1
 	fi
 
-	cp $BUILD_DIR/$PROBE_NAME.ko $OUTPUT/$PROBE_NAME-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.ko
-	cp $BUILD_DIR/$PROBE_NAME.ko $OUTPUT/$PROBE_NAME-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH_ORIG.ko
+	install_output $BUILD_DIR/$PROBE_NAME.ko $OUTPUT/$PROBE_NAME-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.ko
 }
 
 
@@ -86,11 +210,8 @@ build_bpf() {
 		echo "$CLANG not available, not building eBPF probe $PROBE_NAME-bpf-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.o"
 	else
 		echo "Building eBPF probe $PROBE_NAME-bpf-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.o"
-		mkdir -p /build/sysdig
-		cd /build/sysdig
 
-		# Glue code for backwards compatibility with a plain libs/ checkout
-		if call_cmake /code/sysdig-rw; then
+		if [[ $CMAKE_CONFIGURED == 1 ]]; then
 			# for the eBPF probe, cmake will only render driver_config.h
 			# in the source directory so we'll end up running
 			# make from the source tree anyway (as opposed to the build directory)
@@ -98,25 +219,39 @@ build_bpf() {
 			# so to copy the header files and trigger the configure system
 			# Ref: https://github.com/falcosecurity/driverkit/commit/dd7a2f19c7775bc66e8308cae607c0a9513457d1
 			make -C /build/sysdig bpf
-			BUILD_DIR=/build/sysdig/driver
 		else
-			# cmake failed, so we're probably dealing with an agent-kmodule.tgz
-			# package file and we can therefore run make from the source tree
-			# (without the driver/ prefix)
-			BUILD_DIR=/code/sysdig-rw
 			make -C $BUILD_DIR/bpf clean all
 		fi
-		cp $BUILD_DIR/bpf/probe.o $OUTPUT/$PROBE_NAME-bpf-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.o
+		install_output $BUILD_DIR/bpf/probe.o $OUTPUT/$PROBE_NAME-bpf-$PROBE_VERSION-$ARCH-$KERNEL_RELEASE-$HASH.o
 	fi
 }
 
-# make a local copy of the source code so we can
-# run cmake on it without altering the code on the host
-rm -rf /code/sysdig-rw
-cp -rf /code/sysdig-ro /code/sysdig-rw
+# build both probes out of a single configured source tree
+# a failure of one of them must not prevent building the other one,
+# so run each build in a subshell with its own errexit handling
+# and report failure if any of them failed
+build_all() {
+	set +e
+	(set -e; build_kmod)
+	KMOD_RC=$?
+	(set -e; build_bpf)
+	BPF_RC=$?
+	set -e
+
+	if [[ $KMOD_RC != 0 ]]; then
+		echo "kmod build failed with exit code $KMOD_RC"
+	fi
+	if [[ $BPF_RC != 0 ]]; then
+		echo "eBPF build failed with exit code $BPF_RC"
+	fi
+	[[ $KMOD_RC == 0 && $BPF_RC == 0 ]]
+}
 
 case "${1:-}" in
-	bpf) build_bpf;;
-	"") build_kmod;;
+	configure) copy_source; configure_source; save_prepared_source;;
+	ccache-stats) ccache_stats;;
+	bpf) setup_ccache; setup_source; build_bpf;;
+	"") setup_ccache; setup_source; build_kmod;;
+	all) setup_ccache; setup_source; build_all;;
 	*) exit 1;;
 esac
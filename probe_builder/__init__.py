@@ -1,13 +1,20 @@
+import asyncio
+import functools
+import gzip
+import json
 import logging
 import os
 import sys
+import time
 import traceback
 
 import click
 
 from probe_builder.kernel_crawler import crawl_kernels, DISTROS
-from . import kernel_crawler, disable_ipv6, git, docker
-from .builder import choose_builder, builder_image, ignorelist
+from . import kernel_crawler, disable_ipv6, git, docker, metrics, trace
+from .builder import artifacts, choose_builder, builder_image, endpoints, ignorelist, journal, ledger, manifest, \
+    report, scheduler, workqueue
+from .builder.report import RESULT_FIELDS, FAILED_RESULTS
 from .builder.distro import Distro
 from .context import Context, Workspace, Probe, DownloadConfig
 from concurrent.futures import ThreadPoolExecutor
@@ -25,7 +32,7 @@ def init_logging(debug):
     logger.debug("DEBUG logging enabled")
 
 
-def get_probe(workspace, sysdig_dir, probe_name, probe_version):
+def get_probe(workspace, sysdig_dir, probe_name, probe_version, clone=True):
     workspace_dir = workspace.workspace
 
     try:
@@ -33,7 +40,10 @@ def get_probe(workspace, sysdig_dir, probe_name, probe_version):
     except ValueError:
         probe_device_name = probe_name
 
-    if sysdig_dir is None:
+    if sysdig_dir is None and not clone:
+        # we only need the probe name and version
+        return Probe(None, probe_name, probe_version, probe_device_name)
+    elif sysdig_dir is None:
         sysdig_dir = os.path.join(workspace_dir, 'sysdig')
         if probe_device_name == 'sysdigcloud':
             repo = 'https://github.com/draios/agent-libs'
@@ -61,8 +71,16 @@ class CrawlDistro(object):
         self.distro_builder = self.distro_obj.builder()
         self.crawler_distro = crawler_distro
 
-    def get_kernels(self, workspace, _packages, download_config, crawler_filter):
-        return self.distro_builder.crawl(workspace, self.distro_obj, self.crawler_distro, download_config, crawler_filter)
+    def get_kernels(self, workspace, _packages, download_config, crawler_filter, download=True):
+        return self.distro_builder.crawl(workspace, self.distro_obj, self.crawler_distro, download_config, crawler_filter,
+                                         download)
+
+    def get_jobs(self, _packages, crawler_filter):
+        # the crawled package URLs, for the work queue
+        return crawl_kernels(self.crawler_distro, crawler_filter)
+
+    def get_job_kernels(self, workspace, packages, download_config, download=True):
+        return self.distro_builder.fetch_kernels(workspace, self.distro_obj, packages, download_config, download)
 
 class LocalDistro(object):
 
@@ -70,9 +88,20 @@ class LocalDistro(object):
         self.distro_obj = Distro(distro, builder_distro)
         self.distro_builder = self.distro_obj.builder()
 
-    def get_kernels(self, _workspace, packages, _download_config, _crawler_filter):
+    def get_kernels(self, _workspace, packages, _download_config, crawler_filter, _download=True):
         # For local distros we do not have the concept of a "distro release", so we use ""
-        return {("", krel): pkgs for krel, pkgs in self.distro_builder.batch_packages(packages).items()}
+        kernels = {("", krel): pkgs for krel, pkgs in self.distro_builder.batch_packages(packages).items()}
+        if crawler_filter.shard is not None:
+            kernels = crawler_filter.shard.filter(kernels)
+        return kernels
+
+    def get_jobs(self, packages, crawler_filter):
+        # the workers need to see the packages at the same paths
+        return {key: [os.path.abspath(pkg) for pkg in pkgs]
+                for key, pkgs in self.get_kernels(None, packages, None, crawler_filter).items()}
+
+    def get_job_kernels(self, _workspace, packages, _download_config, _download=True):
+        return packages
 
 
 CLI_DISTROS = {
@@ -100,6 +129,87 @@ CLI_DISTROS = {
 }
 
 
+def save_results(results_file, results, shard=None):
+    # results is any iterable of (drel, krel, kmod result, ebpf result) tuples,
+    # written one at a time so that it doesn't need to fit in memory
+    with open(results_file, 'w') as fp:
+        fp.write('{{\n "shard": {},\n "kernels": ['.format(json.dumps(str(shard) if shard else None)))
+        sep = '\n  '
+        for result in results:
+            fp.write(sep + json.dumps(dict(zip(RESULT_FIELDS, result))))
+            sep = ',\n  '
+        fp.write('\n ]\n}\n')
+
+
+def print_summary(results):
+    # print the results (an iterable of (drel, krel, kmod result, ebpf result) tuples)
+    # and return the number of failed kernels
+    fstr = "|{:<10}|{:<45}|{:<10}|{:<10}|"
+    l = fstr.format("Distro", "Kernel", "kmod", "ebpf")
+
+    print("List of analyzed kernels:")
+    print("-" * len(l))
+    print(l)
+    print("-" * len(l))
+    failed_results = []
+    analyzed = 0
+    reused = 0
+    for result in results:
+        _, _, kmod, ebpf = result
+        if kmod in FAILED_RESULTS or ebpf in FAILED_RESULTS:
+            failed_results.append(result)
+        reused += (kmod == 'REUSED') + (ebpf == 'REUSED')
+        print(fstr.format(*result))
+        analyzed += 1
+    print("-" * len(l))
+    print("Number of kernels analyzed: {}".format(analyzed))
+    if reused:
+        print("Number of builds saved by reusing probes: {}".format(reused))
+    print("")
+
+    if failed_results:
+        print("List of failed kernels:")
+        print("-" * len(l))
+        print(l)
+        print("-" * len(l))
+        for result in failed_results:
+            print(fstr.format(*result))
+        print("-" * len(l))
+        print("Number of failed kernels: {}".format(len(failed_results)))
+        print("")
+
+    return len(failed_results)
+
+
+def print_plan(distro_builder, distro, kernel_dirs, ignorelist, workspace, probe):
+    kernels = []
+    summary = {'kmod': {}, 'ebpf': {}, 'kernels_to_build': 0}
+    # check all the kernels against the ignorelist in one go (plan_kernel gets the cached results)
+    krels = [release[1] if type(release) is tuple else release for release, _ in kernel_dirs]
+    for ignorelist_kind in ('kmod', 'legacy_ebpf'):
+        ignorelist.ignore_reasons(ignorelist_kind, krels)
+    for release, target in kernel_dirs:
+        drel, krel = release if type(release) is tuple else ("", release)
+        kernel_plan = distro_builder.plan_kernel(ignorelist, workspace, probe, distro.builder_distro, krel, target)
+        kernel_plan['distro_release'] = drel
+        kernels.append(kernel_plan)
+        for kind in ('kmod', 'ebpf'):
+            action = kernel_plan[kind]['action']
+            summary[kind][action] = summary[kind].get(action, 0) + 1
+        if 'build' in (kernel_plan['kmod']['action'], kernel_plan['ebpf']['action']):
+            summary['kernels_to_build'] += 1
+
+    plan = {
+        'probe_name': probe.probe_name,
+        'probe_version': probe.probe_version,
+        'machine': workspace.machine,
+        'distro': distro.distro,
+        'kernels': kernels,
+        'summary': summary,
+    }
+    print(json.dumps(plan, indent=2, sort_keys=True))
+
+
 @click.group()
 @click.option('--debug/--no-debug')
 def cli(debug):
@@ -109,39 +219,93 @@ def cli(debug):
 @click.command()
 @click.option('-b', '--builder-image-prefix', default='')
 @click.option('-m', '--machine', default=os.uname().machine)
-def prebuild(builder_image_prefix, machine):
+@click.option('-j', '--jobs', type=click.INT, default=4, help='Build this many images at a time')
+def prebuild(builder_image_prefix, machine, jobs):
     builder_source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     arch = kernel_crawler.repo.machine2arch(machine)
     all_dockerfiles_and_tags = choose_builder.all_dockerfiles(builder_source=builder_source)
     context_dir = os.getcwd()
-    for dockerfile, dockerfile_tag in all_dockerfiles_and_tags:
-        builder_image.prebuild(context_dir, builder_image_prefix, dockerfile, dockerfile_tag, arch)
+    # the images that are up to date (built from the same Dockerfile and files) are skipped
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(builder_image.prebuild, context_dir, builder_image_prefix, dockerfile,
+                                   dockerfile_tag, arch)
+                   for dockerfile, dockerfile_tag in all_dockerfiles_and_tags]
+    for future in futures:
+        future.result()
+    builder_image.remove_dangling_images()
+
+def parse_docker_hosts(_ctx, _param, value):
+    try:
+        return [endpoints.Endpoint.parse(spec) for spec in value]
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def parse_shard(_ctx, _param, value):
+    if value is None:
+        return None
+    try:
+        return kernel_crawler.repo.Shard.parse(value)
+    except ValueError as exc:
+        raise click.BadParameter('expected INDEX/COUNT ({})'.format(exc))
+
 
 @click.command()
 @click.option('-b', '--builder-image-prefix', default='')
+@click.option('--ccache/--no-ccache', default=False)
+@click.option('--ccache-size', default='5G')
+@click.option('-c', '--cpus', type=click.INT, default=len(os.sched_getaffinity(0)))
 @click.option('-d', '--download-concurrency', type=click.INT, default=1)
+@click.option('-D', '--docker-host', multiple=True, callback=parse_docker_hosts,
+              help='Run the builds on this Docker daemon (HOST[,slots=N][,copy]), may be repeated')
 @click.option('-j', '--jobs', type=click.INT, default=len(os.sched_getaffinity(0)))
 @click.option('-k', '--kernel-type', type=click.Choice(sorted(CLI_DISTROS.keys())))
 @click.option('-R', '--distro-filter', default='')
 @click.option('-f', '--kernel-filter', default='')
 @click.option('-p', '--probe-name')
 @click.option('-r', '--retries', type=click.INT, default=1)
+@click.option('--retry-failed', is_flag=True, default=False)
 @click.option('-s', '--source-dir')
 @click.option('-t', '--download-timeout', type=click.FLOAT)
 @click.option('-v', '--probe-version')
 @click.option('-m', '--machine', default=os.uname().machine)
 @click.option('-l', '--ignore-list', default='')
+@click.option('--plan', is_flag=True, default=False)
+@click.option('--queue', help='Publish the kernels to a work queue for `probe_builder worker` and wait for the results')
+@click.option('--results-file')
+@click.option('--report-file', help='Append a JSON record per kernel as it finishes (default: build-report.ndjson)')
+@click.option('--junit-file', help='Also save the results as a JUnit XML report')
+@click.option('--shard', callback=parse_shard, help='Only build shard INDEX/COUNT of the kernels (e.g. 1/4)')
+@click.option('--build-timeout', type=click.FLOAT, help='Kill builder containers running for longer (in seconds)')
+@click.option('--tmpfs-size', default='1g',
+              help='Size limit of the in-memory scratch space of every build (0 to build on disk)')
+@click.option('--trace', 'trace_file', help='Save a Chrome trace of the build phases (for ui.perfetto.dev)')
+@click.option('--metrics-port', type=click.INT, help='Serve OpenMetrics on this port during the build')
+@click.option('--metrics-file', help='Keep the metrics in this file (for the Prometheus textfile collector)')
+@click.option('--resume', is_flag=True, default=False, help='Pick up where the last (interrupted) run stopped')
+@click.option('--artifact-store', help='Reuse the probes built from the same inputs in this directory '
+                                       '(default: artifacts in the workspace)')
+@click.option('--xz', is_flag=True, default=False, help='Also save xz-compressed kernel modules (.ko.xz)')
 @click.argument('package', nargs=-1)
-def build(builder_image_prefix,
-          download_concurrency, jobs, kernel_type, distro_filter,
-          kernel_filter, probe_name, retries,
-          source_dir, download_timeout, probe_version, machine, ignore_list, package):
+def build(builder_image_prefix, ccache, ccache_size, cpus,
+          download_concurrency, docker_host, jobs, kernel_type, distro_filter,
+          kernel_filter, probe_name, retries, retry_failed,
+          source_dir, download_timeout, probe_version, machine, ignore_list, plan, queue, results_file,
+          report_file, junit_file, shard,
+          build_timeout, tmpfs_size, trace_file, metrics_port, metrics_file, resume, artifact_store, xz, package):
+    if trace_file:
+        trace.start(trace_file)
     workspace_dir = os.getcwd()
     builder_source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
     arch = kernel_crawler.repo.machine2arch(machine)
-    workspace = Workspace(machine, arch, docker.is_privileged(), docker.get_mount_mapping(), workspace_dir, builder_source, builder_image_prefix)
-    probe = get_probe(workspace, source_dir, probe_name, probe_version)
+    if plan or queue:
+        # don't talk to Docker when only planning the build or when the workers do the building
+        workspace = Workspace(machine, arch, True, None, workspace_dir, builder_source, builder_image_prefix)
+    else:
+        workspace = Workspace(machine, arch, docker.is_privileged(), docker.get_mount_mapping(), workspace_dir, builder_source, builder_image_prefix,
+                              ccache_size if ccache else None, build_timeout=build_timeout, tmpfs_size=tmpfs_size)
+    probe = get_probe(workspace, source_dir, probe_name, probe_version, clone=not (plan or queue))
     distro_obj = CLI_DISTROS[kernel_type]
 
     distro_builder = distro_obj.distro_builder
@@ -154,69 +318,407 @@ def build(builder_image_prefix,
             yamldoc = fp.read()
     kil = ignorelist.KernelIgnoreList(yamldoc, probe_version)
 
-    crawler_filter = kernel_crawler.repo.CrawlerFilter(machine=machine, arch=arch, distro_filter=distro_filter, kernel_filter=kernel_filter)
+    crawler_filter = kernel_crawler.repo.CrawlerFilter(machine=machine, arch=arch, distro_filter=distro_filter, kernel_filter=kernel_filter,
+                                                       shard=shard)
+
+    if plan:
+        # print what we would build (as JSON), without downloading or unpacking anything
+        kernels = distro_obj.get_kernels(workspace, package, download_config, crawler_filter, False)
+        kernel_dirs = distro_builder.unpack_kernels(workspace, distro.distro, kernels, unpack=False)
+        print_plan(distro_builder, distro, kernel_dirs, kil, workspace, probe)
+        return
+
+    if queue:
+        work_queue = workqueue.WorkQueue(queue)
+        work_queue.set_settings({
+            'kernel_type': kernel_type,
+            'probe_name': probe_name,
+            'probe_version': probe_version,
+            'machine': machine,
+            'builder_image_prefix': builder_image_prefix,
+            'ignore_list': yamldoc.decode('utf-8') if yamldoc else None,
+        })
+        work_queue.publish(distro_obj.get_jobs(package, crawler_filter))
+        results = wait_for_queue(work_queue)
+        work_queue.close()
+        if results_file:
+            save_results(results_file, results, shard)
+        failed = print_summary(results)
+        sys.exit(1 if failed else 0)
+
+    exporter = metrics.Exporter(metrics_port, metrics_file)
+    run_journal = journal.RunJournal(workspace.subdir('journal.sqlite'), {
+        'kernel_type': kernel_type,
+        'packages': sorted(os.path.abspath(pkg) for pkg in package),
+        'distro_filter': distro_filter,
+        'kernel_filter': kernel_filter,
+        'shard': str(shard) if shard else None,
+        'probe_name': probe.probe_name,
+        'probe_version': probe.probe_version,
+        'machine': machine,
+    })
+    packages = run_journal.packages() if resume else None
+    if packages is None:
+        with trace.span('get_kernels', 'crawl', distro=distro.distro):
+            packages = distro_obj.get_jobs(package, crawler_filter)
+        run_journal.start(packages)
+    kernel_dirs = unpack_packages(distro_obj, packages, workspace, download_config, run_journal)
+
+    endpoint_pool = None
+    if docker_host:
+        # run as many builds as the Docker daemons have slots,
+        # assuming every daemon has `cpus` CPUs
+        endpoint_pool = endpoints.EndpointPool(docker_host)
+        jobs = endpoint_pool.total_slots()
+
+    # start with the kernels that took the longest to build last time
+    # and split the CPUs (of every Docker daemon) between its builder containers
+    history = scheduler.BuildHistory(workspace.subdir('build-history.json'))
+    build_scheduler = scheduler.BuildScheduler(history, jobs, cpus, docker_host)
+    build_ledger = ledger.BuildLedger(workspace.subdir('ledger.sqlite'), retry_failed)
+    store = artifacts.ArtifactStore(artifact_store or workspace.subdir('artifacts'), compress=xz)
+
+    # list the existing probes once instead of checking for each kernel
+    builder_image.output_index(workspace.subdir('output'))
+
+    # the results go to the report as soon as every kernel is done,
+    # the summary and the other formats are read back from it
+    build_report = report.BuildReport(report_file or workspace.subdir('build-report.ndjson'))
+    # the kernels built before the run got interrupted only go to the report
+    built = run_journal.built()
+    for record in built.values():
+        build_report.write(record)
+    kernel_dirs = [(release, target) for release, target in kernel_dirs if release not in built]
+    del built
+
+    # build the images these kernels need up front, in parallel
+    # (on every Docker daemon), instead of when the first kernel needs one
+    if endpoint_pool is not None:
+        image_workspaces = [workspace._replace(endpoint=endpoint) for endpoint in endpoint_pool.endpoints]
+    else:
+        image_workspaces = [workspace]
+    with trace.span('prepare_images', 'image'):
+        builder_image.prepare_images(image_workspaces, distro_builder.builder_dockerfiles(
+            workspace, distro.builder_distro, kernel_dirs), jobs)
 
-    kernels = distro_obj.get_kernels(workspace, package, download_config, crawler_filter)
-    kernel_dirs = distro_builder.unpack_kernels(workspace, distro.distro, kernels)
+    try:
+        asyncio.run(build_kernels(distro_obj, kernel_dirs, kil, workspace, probe, jobs,
+                                  build_scheduler, build_ledger, endpoint_pool, build_report, run_journal, store))
+    finally:
+        # keep the durations of the kernels built so far (and the trace, the metrics, ...),
+        # even if the run got interrupted
+        close_all(history.save, build_report.close, store.close, run_journal.close, build_ledger.close,
+                  trace.save, exporter.stop)
+    manifest.write_manifest(workspace.subdir('output'), probe.probe_name, probe.probe_version, workspace.workspace)
+    builder_image.remove_dangling_images()
+
+    if results_file:
+        save_results(results_file, build_report.results(), shard)
+    if junit_file:
+        report.write_junit(build_report.records, junit_file)
+
+    failed = print_summary(build_report.results())
+
+    if ccache:
+        builder_image.ccache_stats(workspace)
 
-    with ThreadPoolExecutor(max_workers=jobs) as executor:
-        kernels_futures = []
-        for release, target in kernel_dirs:
-            drel, krel = release if type(release) is tuple else ("", release)
-            future = executor.submit(distro_builder.build_kernel, kil, workspace, probe, distro.builder_distro, krel, target)
-            kernels_futures.append((release, future))
+    sys.exit(1 if failed else 0)
 
 
-    print("List of analyzed kernels:")
-    fstr = "|{:<10}|{:<45}|{:<10}|{:<10}|"
-    l = fstr.format("Distro", "Kernel", "kmod", "ebpf")
-    print("-" * len(l))
-    print(l)
-    print("-" * len(l))
+def close_all(*closers):
+    # call every one of them, even if the ones before failed
+    for close in closers:
+        try:
+            close()
+        except Exception:
+            logger.error('Failed to run {}'.format(getattr(close, '__qualname__', close)))
+            traceback.print_exc()
 
-    failed = 0
-    for release, future in kernels_futures:
+
+def unpack_packages(distro_obj, packages, workspace, download_config, run_journal):
+    # download and unpack the packages of every crawler key that isn't unpacked yet
+    # (according to the journal) and return the (release, target) pairs of all the kernels
+    distro_builder = distro_obj.distro_builder
+    distro = distro_obj.distro_obj
+    unpacked = run_journal.unpacked()
+    todo = {key: pkgs for key, pkgs in packages.items() if key not in unpacked}
+    if todo:
+        # all the downloads in one batch
+        with trace.span('download_kernels', 'download', distro=distro.distro, kernels=len(todo)):
+            distro_obj.get_job_kernels(workspace, todo, download_config)
+    with trace.span('unpack_kernels', 'unpack', distro=distro.distro, kernels=len(todo)):
+        for key, pkgs in todo.items():
+            kernels = distro_obj.get_job_kernels(workspace, {key: pkgs}, download_config, download=False)
+            unpacked[key] = distro_builder.unpack_kernels(workspace, distro.distro, kernels)
+            run_journal.record_unpacked(key, unpacked[key])
+
+    # the same kernel may come from more than one crawler key, the last one wins
+    # (like when batching the packages of all the keys at once)
+    kernel_dirs = {}
+    for key in packages:
+        for release, target in unpacked[key]:
+            kernel_dirs[release] = target
+    return list(kernel_dirs.items())
+
+
+# the size of the thread pool for the blocking parts of the builds
+BLOCKING_THREADS = 16
+
+
+async def build_kernels(distro_obj, kernel_dirs, kil, workspace, probe, jobs, build_scheduler, build_ledger,
+                        endpoint_pool, build_report, run_journal=None, artifact_store=None):
+    # run every build as a task on a single event loop, at most `jobs` at a time,
+    # and add every kernel to build_report (and run_journal) as soon as it's done
+    distro_builder = distro_obj.distro_builder
+    distro = distro_obj.distro_obj
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=min(jobs, BLOCKING_THREADS)))
+    slots = asyncio.Semaphore(jobs)
+
+    async def build_one(krel, target):
+        async with slots:
+            metrics.queue_depth.dec(stage='build')
+            metrics.in_progress.inc(stage='build')
+            try:
+                with trace.span('build_kernel', kernel=krel, distro=distro.builder_distro):
+                    return await distro_builder.build_kernel_async(kil, workspace, probe, distro.builder_distro, krel,
+                                                                   target, build_scheduler, build_ledger,
+                                                                   endpoint_pool, artifact_store)
+            finally:
+                metrics.in_progress.dec(stage='build')
+
+    # don't hold on to the finished tasks (and their results)
+    pending = set()
+    all_done = loop.create_future()
+
+    def task_done(releases, task):
+        # every distro release the kernel was found in gets its own record
+        for release in releases:
+            record = build_report.add(release, task)
+            # retry the kernels that failed with an exception when resuming
+            if run_journal is not None and record['kmod'] != 'EXCEPTION':
+                run_journal.record_built(release, record)
+        pending.discard(task)
+        if not pending and not all_done.done():
+            all_done.set_result(None)
+
+    # build each kernel only once, however many distro releases it's in
+    builds = distro_builder.unique_builds(workspace, kernel_dirs)
+    # the durations are kept per builder image, so look up the one each kernel is going to use
+    builders = {}
+    for krel, target, releases in builds:
+        try:
+            _, builders[krel] = distro_builder.kernel_builder(workspace, distro.builder_distro, krel, target)
+        except Exception:
+            pass
+    for krel, target, releases in build_scheduler.order(builds, builders):
+        metrics.queue_depth.inc(stage='build')
+        task = build_scheduler.create_task(build_one(krel, target))
+        # the task name shows up as the track name in the trace
+        task.set_name(krel)
+        task.add_done_callback(functools.partial(task_done, releases))
+        pending.add(task)
+    build_scheduler.all_submitted()
+    if pending:
+        await all_done
+
+
+QUEUE_POLL_INTERVAL = 10
+
+
+def wait_for_queue(work_queue):
+    # wait until the workers are done with all the jobs and return
+    # the results in the same format as kernel_results
+    while True:
+        counts = work_queue.counts()
+        if not counts.get(work_queue.QUEUED) and not counts.get(work_queue.LEASED):
+            break
+        logger.info('Jobs queued: {}, in progress: {}, done: {}'.format(
+            counts.get(work_queue.QUEUED, 0), counts.get(work_queue.LEASED, 0), counts.get(work_queue.DONE, 0)))
+        time.sleep(QUEUE_POLL_INTERVAL)
+
+    results = []
+    for key, job_results in work_queue.results():
+        if job_results is None:
+            # the job kept timing out
+            drel, krel = key if type(key) is tuple else ("", key)
+            results.append((drel, krel, "EXCEPTION", "EXCEPTION"))
+        else:
+            results.extend(tuple(kernel[field] for field in RESULT_FIELDS) for kernel in job_results)
+    return results
+
+
+def build_job(distro_obj, key, packages, kil, workspace, probe, download_config, build_scheduler, build_ledger,
+              artifact_store=None):
+    # download, unpack and build the kernels of a single work queue job
+    # and return the results as a list of dicts (the format of --results-file)
+    distro_builder = distro_obj.distro_builder
+    distro = distro_obj.distro_obj
+    drel, krel = key if type(key) is tuple else ("", key)
+    try:
+        with trace.span('get_kernels', 'crawl', distro=distro.distro, kernel=krel):
+            kernels = distro_obj.get_job_kernels(workspace, {key: packages}, download_config)
+        with trace.span('unpack_kernels', 'unpack', distro=distro.distro, kernel=krel):
+            kernel_dirs = distro_builder.unpack_kernels(workspace, distro.distro, kernels)
+    except:
+        traceback.print_exc()
+        kernel_dirs = []
+    if not kernel_dirs:
+        return [dict(zip(RESULT_FIELDS, (drel, krel, "EXCEPTION", "EXCEPTION")))]
+
+    results = []
+    for release, target in kernel_dirs:
         drel, krel = release if type(release) is tuple else ("", release)
         try:
-            res = future.result()
-            if res.failed():
-                failed += 1
-            print(fstr.format(drel, krel,
-                res.kmod_result.build_result_string(),
-                res.ebpf_result.build_result_string()))
+            with trace.span('build_kernel', kernel=krel, distro=distro.builder_distro):
+                res = distro_builder.build_kernel(kil, workspace, probe, distro.builder_distro, krel, target,
+                                                  build_scheduler, build_ledger, artifact_store=artifact_store)
+            result = (drel, krel, res.kmod_result.build_result_string(), res.ebpf_result.build_result_string())
         except:
-            failed += 1
-            print(fstr.format(drel, krel, "EXCEPTION", "EXCEPTION"))
+            traceback.print_exc()
+            result = (drel, krel, "EXCEPTION", "EXCEPTION")
+        results.append(dict(zip(RESULT_FIELDS, result)))
+    return results
+
+
+def run_worker(work_queue, worker_id, heartbeat, distro_obj, kil, workspace, probe, download_config,
+               build_scheduler, build_ledger, artifact_store=None):
+    while True:
+        job = work_queue.lease(worker_id)
+        if job is None:
+            # other workers may still give up their jobs
+            if work_queue.finished():
+                return
+            time.sleep(QUEUE_POLL_INTERVAL)
+            continue
+
+        job_id, key, packages = job
+        logger.info('Building job {} ({})'.format(job_id, key))
+        heartbeat.add(job_id)
+        metrics.in_progress.inc(stage='job')
+        try:
+            results = build_job(distro_obj, key, packages, kil, workspace, probe, download_config,
+                                build_scheduler, build_ledger, artifact_store)
+        finally:
+            metrics.in_progress.dec(stage='job')
+            heartbeat.remove(job_id)
+        work_queue.complete(worker_id, job_id, results)
 
-    print("-" * len(l))
-    print("Number of kernels analyzed: {}".format(len(kernels_futures)))
-    print("")
 
-    if failed:
-        print("List of failed kernels:")
-        print("-" * len(l))
-        print(l)
-        print("-" * len(l))
+@click.command()
+@click.option('--ccache/--no-ccache', default=False)
+@click.option('--ccache-size', default='5G')
+@click.option('-c', '--cpus', type=click.INT, default=len(os.sched_getaffinity(0)))
+@click.option('-d', '--download-concurrency', type=click.INT, default=1)
+@click.option('-j', '--jobs', type=click.INT, default=len(os.sched_getaffinity(0)))
+@click.option('--lease-time', type=click.INT, default=300)
+@click.option('-r', '--retries', type=click.INT, default=1)
+@click.option('--retry-failed', is_flag=True, default=False)
+@click.option('-s', '--source-dir')
+@click.option('-t', '--download-timeout', type=click.FLOAT)
+@click.option('-w', '--worker-id', default=workqueue.default_worker_id())
+@click.option('--build-timeout', type=click.FLOAT, help='Kill builder containers running for longer (in seconds)')
+@click.option('--tmpfs-size', default='1g',
+              help='Size limit of the in-memory scratch space of every build (0 to build on disk)')
+@click.option('--trace', 'trace_file', help='Save a Chrome trace of the build phases (for ui.perfetto.dev)')
+@click.option('--metrics-port', type=click.INT, help='Serve OpenMetrics on this port during the build')
+@click.option('--metrics-file', help='Keep the metrics in this file (for the Prometheus textfile collector)')
+@click.option('--artifact-store', help='Reuse the probes built from the same inputs in this directory '
+                                       '(default: artifacts in the workspace)')
+@click.option('--xz', is_flag=True, default=False, help='Also save xz-compressed kernel modules (.ko.xz)')
+@click.argument('queue')
+def worker(ccache, ccache_size, cpus, download_concurrency, jobs, lease_time, retries, retry_failed,
+           source_dir, download_timeout, worker_id, build_timeout, tmpfs_size, trace_file,
+           metrics_port, metrics_file, artifact_store, xz, queue):
+    if trace_file:
+        trace.start(trace_file)
+    work_queue = workqueue.WorkQueue(queue, lease_time)
+    settings = work_queue.settings()
+    if not settings:
+        click.echo('No jobs published to {}'.format(queue), err=True)
+        sys.exit(1)
 
-        for release, future in kernels_futures:
-            try:
-                res = future.result()
-                if res.failed():
-                    drel, krel = release if type(release) is tuple else ("", release)
-                    print(fstr.format(drel, krel,
-                        res.kmod_result.build_result_string(),
-                        res.ebpf_result.build_result_string()))
-            except:
-                print(fstr.format(release, "EXCEPTION", "EXCEPTION"))
-                traceback.print_exc()
+    workspace_dir = os.getcwd()
+    builder_source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    machine = settings['machine']
+    arch = kernel_crawler.repo.machine2arch(machine)
+    workspace = Workspace(machine, arch, docker.is_privileged(), docker.get_mount_mapping(), workspace_dir, builder_source,
+                          settings['builder_image_prefix'], ccache_size if ccache else None,
+                          build_timeout=build_timeout, tmpfs_size=tmpfs_size)
+    probe = get_probe(workspace, source_dir, settings['probe_name'], settings['probe_version'])
+    distro_obj = CLI_DISTROS[settings['kernel_type']]
+    download_config = DownloadConfig(download_concurrency, download_timeout, retries, None)
+    kil = ignorelist.KernelIgnoreList(settings['ignore_list'], settings['probe_version'])
 
-        print("-" * len(l))
-        print("Number of failed kernels: {}".format(failed))
-        print("")
+    history = scheduler.BuildHistory(workspace.subdir('build-history.json'))
+    build_scheduler = scheduler.BuildScheduler(history, jobs, cpus)
+    build_ledger = ledger.BuildLedger(workspace.subdir('ledger.sqlite'), retry_failed)
+    store = artifacts.ArtifactStore(artifact_store or workspace.subdir('artifacts'), compress=xz)
+    builder_image.output_index(workspace.subdir('output'))
 
+    exporter = metrics.Exporter(metrics_port, metrics_file)
+    heartbeat = workqueue.Heartbeat(work_queue, worker_id)
+    heartbeat.start()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(run_worker, work_queue, worker_id, heartbeat, distro_obj, kil, workspace, probe,
+                                       download_config, build_scheduler, build_ledger, store) for _ in range(jobs)]
+    finally:
+        # keep the durations of the kernels built so far (and the trace, the metrics, ...),
+        # even if the worker got interrupted
+        close_all(history.save, heartbeat.stop, store.close, build_ledger.close, work_queue.close,
+                  trace.save, exporter.stop)
+    manifest.write_manifest(workspace.subdir('output'), probe.probe_name, probe.probe_version, workspace.workspace)
+    builder_image.remove_dangling_images()
+
+    if ccache:
+        builder_image.ccache_stats(workspace)
+
+    failed = 0
+    for future in futures:
+        try:
+            future.result()
+        except:
+            failed += 1
+            traceback.print_exc()
     sys.exit(1 if failed else 0)
 
 
+@click.command()
+@click.argument('results_file', nargs=-1, required=True)
+def merge_results(results_file):
+    results = []
+    for path in results_file:
+        with open(path) as fp:
+            doc = json.load(fp)
+        for kernel in doc['kernels']:
+            results.append(tuple(kernel[field] for field in RESULT_FIELDS))
+
+    failed = print_summary(results)
+    sys.exit(1 if failed else 0)
+
+
+@click.command()
+@click.option('--junit-file', help='Also save the results as a JUnit XML report')
+@click.argument('report_file')
+def show_report(junit_file, report_file):
+    # the summary of a build report, e.g. of a run that got killed
+    if junit_file:
+        report.write_junit(lambda: report.read_records(report_file), junit_file)
+    failed = print_summary(report.record_result(record) for record in report.read_records(report_file))
+    sys.exit(1 if failed else 0)
+
+
+@click.command()
+@click.option('-p', '--probe-name', required=True)
+@click.option('-v', '--probe-version', required=True)
+@click.option('-c', '--cache-dir', help='Directory for the stat cache (e.g. the workspace), to only hash new probes')
+@click.argument('output_dir', default='output')
+def write_manifest(probe_name, probe_version, cache_dir, output_dir):
+    # (re)write the manifest of an output directory, e.g. after merging the output of several builds
+    click.echo(manifest.write_manifest(output_dir, probe_name, probe_version, cache_dir))
+
+
 @click.command()
 @click.argument('distro', type=click.Choice(sorted(DISTROS.keys())))
 @click.argument('distro_filter', required=False, default='')
@@ -230,9 +732,80 @@ def crawl(distro, distro_filter='', kernel_filter=''):
             print(' {}'.format(pkg))
 
 
+@click.command()
+@click.option('-p', '--probe-name')
+@click.option('-v', '--probe-version')
+@click.option('-m', '--machine')
+@click.option('--failed', is_flag=True, default=False)
+def status(probe_name, probe_version, machine, failed):
+    db_path = os.path.join(os.getcwd(), 'ledger.sqlite')
+    if not os.path.exists(db_path):
+        click.echo('No build ledger in {}'.format(os.getcwd()), err=True)
+        sys.exit(1)
+    build_ledger = ledger.BuildLedger(db_path)
+    rows = build_ledger.results(probe_name, probe_version, machine, 'FAILED' if failed else None)
+    build_ledger.close()
+
+    fstr = "|{:<20}|{:<10}|{:<8}|{:<45}|{:<32}|{:<5}|{:<10}|{:>9}|"
+    l = fstr.format("Probe", "Version", "Arch", "Kernel", "Config hash", "Kind", "Result", "Time")
+    print("-" * len(l))
+    print(l)
+    print("-" * len(l))
+    counts = {}
+    for name, version, mach, krel, config_hash, kind, _builder, result, duration, _timestamp in rows:
+        counts[result] = counts.get(result, 0) + 1
+        print(fstr.format(name, version, mach, krel, config_hash, kind, result,
+                          '{:.1f}s'.format(duration) if duration else ''))
+    print("-" * len(l))
+    for result, count in sorted(counts.items()):
+        print("{}: {}".format(result, count))
+
+
+@click.command()
+@click.option('-p', '--probe-name')
+@click.option('-v', '--probe-version')
+@click.option('-k', '--kind', type=click.Choice(['kmod', 'ebpf']))
+@click.argument('kernel_release')
+def logs(probe_name, probe_version, kind, kernel_release):
+    db_path = os.path.join(os.getcwd(), 'ledger.sqlite')
+    if not os.path.exists(db_path):
+        click.echo('No build ledger in {}'.format(os.getcwd()), err=True)
+        sys.exit(1)
+    build_ledger = ledger.BuildLedger(db_path)
+    rows = build_ledger.log_paths(kernel_release, probe_name, probe_version, kind)
+    build_ledger.close()
+    if not rows:
+        click.echo('No build logs for {}'.format(kernel_release), err=True)
+        sys.exit(1)
+
+    # the combined builds share a log, only print it once
+    kinds = {}
+    for name, version, mach, config_hash, log_kind, result, log_path in rows:
+        kinds.setdefault(log_path, []).append(log_kind)
+    for name, version, mach, config_hash, log_kind, result, log_path in rows:
+        if log_path not in kinds:
+            continue
+        click.echo('=== {}-{} {} {}-{} {} {} ({}) ==='.format(name, version, mach, kernel_release, config_hash,
+                                                           '+'.join(kinds.pop(log_path)), result, log_path))
+        sys.stdout.flush()
+        try:
+            with gzip.open(log_path, 'rb') as fp:
+                for line in fp:
+                    sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+        except (IOError, OSError) as exc:
+            click.echo('Failed to read {}: {}'.format(log_path, exc), err=True)
+
+
 cli.add_command(prebuild, 'prebuild')
 cli.add_command(build, 'build')
 cli.add_command(crawl, 'crawl')
+cli.add_command(merge_results, 'merge-results')
+cli.add_command(show_report, 'report')
+cli.add_command(write_manifest, 'manifest')
+cli.add_command(worker, 'worker')
+cli.add_command(status, 'status')
+cli.add_command(logs, 'logs')
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,173 @@
+import errno
+import hashlib
+import json
+import logging
+import lzma
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# the files of the kernel headers that decide what a probe built against them looks like
+# (the rest of the tree comes from the same packages as these)
+HEADER_FILES = (
+    '.config',
+    'Makefile',
+    'Module.symvers',
+    'include/config/kernel.release',
+    'include/generated/autoconf.h',
+    'include/generated/compile.h',
+    'include/generated/utsrelease.h',
+    'include/generated/uapi/linux/version.h',
+    'include/linux/version.h',
+)
+
+
+def header_digest(kernel_dir):
+    digest = hashlib.sha256()
+    for name in HEADER_FILES:
+        digest.update(name.encode('utf-8') + b'\0')
+        try:
+            with open(os.path.join(kernel_dir, name), 'rb') as fp:
+                while True:
+                    chunk = fp.read(65536)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+        except (IOError, OSError):
+            digest.update(b'\0missing')
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def fingerprint(machine, probe, kernel_release, config_hash, headers, builder_hash, kind):
+    # everything that goes into a build: a probe built from the same inputs
+    # is the same probe, whatever distro the kernel came from
+    doc = [machine, probe.probe_name, probe.probe_version, kernel_release, config_hash, headers, builder_hash, kind]
+    return hashlib.sha256(json.dumps(doc).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compress_xz(src, dst):
+    # the kernel (and kmod) only accept xz modules with CRC32 checks
+    tmp_path = '{}.{}.tmp'.format(dst, os.getpid())
+    with open(src, 'rb') as src_fp:
+        with lzma.open(tmp_path, 'wb', check=lzma.CHECK_CRC32) as dst_fp:
+            shutil.copyfileobj(src_fp, dst_fp)
+    os.rename(tmp_path, dst)
+
+
+class ArtifactStore(object):
+    # The probes we built, stored once by their content (<root>/objects/<sha256[:2]>/<sha256>)
+    # and linked under the fingerprint of their build inputs (<root>/<fingerprint[:2]>/<fingerprint><ext>)
+    # so that a kernel with the same inputs (e.g. a RHEL kernel rebuilt by CentOS, Alma or Rocky)
+    # gets its probes linked into the output directory instead of compiled again.
+    #
+    # Everything is hard linked: the output files with the same content (whatever kernel
+    # they were built for) share a single copy with the store, which doesn't take
+    # any extra space and can be shared between workspaces on the same filesystem
+    # (on another filesystem, the probes get copied instead).
+    #
+    # With compress=True, every kernel module also gets an .ko.xz companion in the output
+    # directory (listed in the manifest, so that sysdig-probe-loader downloads it instead),
+    # compressed once per content in a background thread, so that it doesn't hold up the builds.
+
+    def __init__(self, root, compress=False):
+        self.root = root
+        self.executor = None
+        if compress:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xz')
+        self.futures = []
+
+    def path(self, fp, ext):
+        return os.path.join(self.root, fp[:2], fp + ext)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    @staticmethod
+    def makedirs(path):
+        try:
+            os.makedirs(os.path.dirname(path), 0o755)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def link(src, dst):
+        # link (or copy) src to dst atomically, replacing dst
+        tmp_path = '{}.{}.tmp'.format(dst, os.getpid())
+        try:
+            os.link(src, tmp_path)
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(src, tmp_path)
+        os.rename(tmp_path, dst)
+
+    def fetch(self, fp, output_file):
+        # link the probe with this fingerprint to output_file, return False if we don't have it
+        path = self.path(fp, os.path.splitext(output_file)[1])
+        try:
+            self.link(path, output_file)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                logger.warn('Failed to reuse {} for {}: {}'.format(path, output_file, exc))
+            return False
+        logger.info('Reused {} for {}'.format(path, os.path.basename(output_file)))
+        self.compress(output_file)
+        return True
+
+    def store(self, output_file, fp=None):
+        # replace output_file with a link to the stored copy of its content
+        # (storing it if it's new) and link that under the fingerprint
+        try:
+            obj = self.object_path(file_digest(output_file))
+            if os.path.exists(obj):
+                self.link(obj, output_file)
+                logger.debug('{} is identical to {}'.format(os.path.basename(output_file), obj))
+            else:
+                self.makedirs(obj)
+                self.link(output_file, obj)
+            if fp is not None:
+                path = self.path(fp, os.path.splitext(output_file)[1])
+                self.makedirs(path)
+                self.link(obj, path)
+        except (IOError, OSError) as exc:
+            # the build itself is fine, just the next one won't be able to reuse it
+            logger.warn('Failed to store {} in {}: {}'.format(output_file, self.root, exc))
+        self.compress(output_file)
+
+    def compress(self, output_file):
+        if self.executor is not None and output_file.endswith('.ko'):
+            self.futures.append(self.executor.submit(self.compress_output, output_file))
+
+    def compress_output(self, output_file):
+        try:
+            obj = self.object_path(file_digest(output_file))
+            if not os.path.exists(obj + '.xz'):
+                self.makedirs(obj)
+                compress_xz(output_file, obj + '.xz')
+            self.link(obj + '.xz', output_file + '.xz')
+        except (IOError, OSError) as exc:
+            logger.warn('Failed to compress {}: {}'.format(output_file, exc))
+
+    def close(self):
+        # wait for the compression to finish
+        if self.executor is not None:
+            pending = sum(1 for future in self.futures if not future.done())
+            if pending:
+                logger.info('Waiting for {} modules to be compressed'.format(pending))
+            self.executor.shutdown(wait=True)
+            self.futures = []
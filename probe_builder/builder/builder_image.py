@@ -1,7 +1,17 @@
+import asyncio
+import errno
+import glob
+import gzip
+import hashlib
 import logging
 import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-from .. import docker
+from .. import docker, trace
+from ..py23 import make_string
 from ..version import Version
 import threading
 
@@ -11,17 +21,262 @@ logger = logging.getLogger(__name__)
 #class BuilderImage:
 
 # cache the builders we have already built, so that we only
-# do this once
+# do this once (each with its own lock, so that building one
+# image does not block the kernels that need another one)
 builders = {}
+builders_locks = {}
 builders_lock = threading.Lock()
 
+# the Docker daemons we built images on, with dangling images to remove
+built_hosts = set()
+
+# the content hashes of the Dockerfiles (with their context)
+content_hashes = {}
+content_hashes_lock = threading.Lock()
+
+# the build logs get compressed and written by a single thread,
+# in the order the output arrived, so that the event loop never waits for the disk
+build_log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='build-log')
+
+# the image label with the content hash the image was built from
+CONTENT_HASH_LABEL = 'com.sysdig.probe-builder.content-hash'
+
+DOCKERFILE_SOURCES_RE = re.compile(r'^\s*(ADD|COPY)\s+(?P<args>.*)$', re.IGNORECASE)
+
+# likewise, cache the driver source trees we have already configured
+# (one per probe and builder image, each with its own lock so that
+# configuring the source for one builder does not block the others)
+prepared_sources = {}
+prepared_sources_locks = {}
+prepared_sources_lock = threading.Lock()
+
+# the ids of the builder images, by image name
+image_digests = {}
+image_digests_lock = threading.Lock()
+
+# the builder images we ran with a compiler cache
+ccache_images = set()
+
+# the contents of the output directories, by path
+output_indexes = {}
+output_indexes_lock = threading.Lock()
+
+
+class OutputIndex(object):
+    # The names of the files in an output directory, listed once
+    # so that checking for existing probes doesn't stat every file.
+    # Only the builds themselves write to the output directory
+    # so after a build we refresh just the files it was supposed to create.
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.files = set()
+        # the same file names, without the kernel config hash
+        self.releases = set()
+        try:
+            for entry in os.scandir(output_dir):
+                self.files.add(entry.name)
+                self.releases.add(self.strip_config_hash(entry.name))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        logger.debug('Indexed {} files in {}'.format(len(self.files), output_dir))
+
+    @staticmethod
+    def strip_config_hash(file_name):
+        # sysdig-probe-1.0-x86_64-5.4.0-1-generic-<hash>.ko -> sysdig-probe-1.0-x86_64-5.4.0-1-generic.ko
+        base, ext = os.path.splitext(file_name)
+        return base.rsplit('-', 1)[0] + ext
+
+    def __contains__(self, file_name):
+        with self.lock:
+            return file_name in self.files
+
+    def contains_any_config(self, file_name):
+        with self.lock:
+            return self.strip_config_hash(file_name) in self.releases
+
+    def refresh(self, file_name):
+        exists = os.path.exists(os.path.join(self.output_dir, file_name))
+        with self.lock:
+            if exists:
+                self.files.add(file_name)
+                self.releases.add(self.strip_config_hash(file_name))
+            else:
+                self.files.discard(file_name)
+        return exists
+
+
+class BuildLog(docker.LogSink):
+    # Writes the output of a build to a compressed file in the workspace
+    # (while still logging it at debug level), on the build_log_writer thread
+
+    def __init__(self, path, prefix=None):
+        super(BuildLog, self).__init__(prefix)
+        self.path = path
+        self.fp = None
+        self.closed = None
+        build_log_writer.submit(self._open)
+
+    def _open(self):
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path), 0o755)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+            self.fp = gzip.open(self.path, 'wb')
+        except (IOError, OSError) as exc:
+            logger.warn('Failed to create build log {}: {}'.format(self.path, exc))
+
+    def _write(self, chunk):
+        if self.fp is not None:
+            self.fp.write(chunk)
+
+    def _close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+    def write(self, chunk):
+        build_log_writer.submit(self._write, chunk)
+        super(BuildLog, self).write(chunk)
+
+    def close(self):
+        # wait for the log to be complete
+        self._submit_close().result()
+
+    async def close_async(self):
+        await asyncio.wrap_future(self._submit_close())
+
+    def _submit_close(self):
+        if self.closed is None:
+            super(BuildLog, self).close()
+            self.closed = build_log_writer.submit(self._close)
+        return self.closed
+
+
+def build_log_path(probe, kernel_release, config_hash, kind):
+    # relative to the workspace, kind is kmod, ebpf or all (both in one container)
+    return os.path.join('logs', '{}-{}'.format(probe.probe_name, probe.probe_version),
+                        '{}-{}-{}.log.gz'.format(kernel_release, config_hash, kind))
+
+
+def output_index(output_dir):
+    with output_indexes_lock:
+        index = output_indexes.get(output_dir)
+        if index is None:
+            index = OutputIndex(output_dir)
+            output_indexes[output_dir] = index
+        return index
+
+
+def docker_host(workspace):
+    if workspace.endpoint is None:
+        return None
+    return workspace.endpoint.host
+
+def copies_files(workspace):
+    # the Docker daemon can't see the workspace, so the files need to be copied
+    return workspace.endpoint is not None and not workspace.endpoint.shared
+
+def volume(workspace, path, container_path, readonly=True):
+    if copies_files(workspace):
+        # the files are copied from our side, so use the local path
+        return docker.DockerVolume(path, container_path, readonly)
+    return docker.DockerVolume(workspace.host_dir(path), container_path, readonly)
+
+def dockerfile_sources(dockerfile):
+    # the files (patterns, relative to the context) a Dockerfile ADDs or COPYs
+    sources = []
+    with open(dockerfile) as fp:
+        for line in fp:
+            m = DOCKERFILE_SOURCES_RE.match(line)
+            if not m:
+                continue
+            args = m.group('args').split()
+            if any(arg.startswith('--from') for arg in args):
+                # from another image or build stage, not from the context
+                continue
+            args = [arg for arg in args if not arg.startswith('--')]
+            # the last one is the destination
+            sources.extend(arg for arg in args[:-1] if '://' not in arg)
+    return sources
+
+
+def hash_file(digest, path):
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def content_hash(dockerfile, context_dir, arch):
+    # a hash of the Dockerfile and all the files it takes from the context,
+    # so that we only rebuild the images that would actually change
+    k = (dockerfile, context_dir, arch)
+    with content_hashes_lock:
+        if k in content_hashes:
+            return content_hashes[k]
+
+    digest = hashlib.sha256()
+    digest.update(arch.encode('utf-8') + b'\0')
+    hash_file(digest, dockerfile)
+    for source in dockerfile_sources(dockerfile):
+        for path in sorted(glob.glob(os.path.join(context_dir, source))):
+            if os.path.isdir(path):
+                paths = []
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames[:] = [d for d in dirnames if d not in ('.git', '__pycache__')]
+                    paths.extend(os.path.join(dirpath, f) for f in filenames)
+            else:
+                paths = [path]
+            for file_path in sorted(paths):
+                if not os.path.isfile(file_path):
+                    continue
+                digest.update(os.path.relpath(file_path, context_dir).encode('utf-8') + b'\0')
+                hash_file(digest, file_path)
+
+    with content_hashes_lock:
+        content_hashes[k] = digest.hexdigest()
+        return content_hashes[k]
+
+
+def build_image(arch, image_name, dockerfile, context_dir, host=None):
+    # build the image unless we already have one built from the same content
+    chash = content_hash(dockerfile, context_dir, arch)
+    labels = docker.image_labels('{}-{}'.format(image_name, arch), host)
+    if labels is not None and labels.get(CONTENT_HASH_LABEL) == chash:
+        logger.info('Builder image {}-{} is up to date'.format(image_name, arch))
+        return
+    with trace.span('builder_image.build', 'image', image=image_name, host=host):
+        docker.build(arch, image_name, dockerfile, context_dir, host, {CONTENT_HASH_LABEL: chash})
+    with builders_lock:
+        built_hosts.add(host)
+
+
+def remove_dangling_images():
+    # once we're done building, not after every image
+    with builders_lock:
+        hosts = list(built_hosts)
+        built_hosts.clear()
+    for host in hosts:
+        docker.remove_dangling_images(host)
+
+
 def prebuild(context_dir, image_prefix, dockerfile, dockerfile_tag, arch):
     image_name = '{}sysdig-probe-builder:{}'.format(image_prefix, dockerfile_tag)
-    docker.build(arch, image_name, dockerfile, context_dir)
+    build_image(arch, image_name, dockerfile, context_dir)
 
 def build(workspace, dockerfile, dockerfile_tag):
+    # every Docker daemon needs its own copy of the image
+    k = (docker_host(workspace), dockerfile, dockerfile_tag)
     with builders_lock:
-        k = (dockerfile, dockerfile_tag)
+        key_lock = builders_locks.setdefault(k, threading.Lock())
+
+    with key_lock:
         obj = builders.get(k)
         if obj is not None:
             return obj
@@ -36,19 +291,135 @@ def build(workspace, dockerfile, dockerfile_tag):
             pass
         else:
             # otherwise, we'll have to built it ourselves
-            docker.build(workspace.arch, image_name, dockerfile, workspace.builder_source)
+            build_image(workspace.arch, image_name, dockerfile, workspace.builder_source, docker_host(workspace))
 
         # cache the object
         builders[k] = obj
         return obj
 
-def run(workspace, probe, kernel_dir, kernel_release,
-        config_hash, container_name, image_name, args):
+def prepare_images(workspaces, dockerfiles, jobs):
+    # build the images the kernels need (dockerfiles is a set of (dockerfile, tag) pairs)
+    # up front and in parallel, for every workspace (i.e. Docker daemon)
+    # the builds then find them in the cache. If an image fails to build, the kernels
+    # that need it will try again (and fail) on their own
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [((dockerfile, docker_host(workspace)), executor.submit(build, workspace, dockerfile, tag))
+                   for workspace in workspaces for dockerfile, tag in sorted(dockerfiles)]
+    for (dockerfile, host), future in futures:
+        try:
+            future.result()
+        except Exception as exc:
+            logger.warn('Failed to build {} on {}: {}'.format(dockerfile, host or 'the default Docker daemon', exc))
+    remove_dangling_images()
+
+def image_digest(workspace, image_name):
+    k = (docker_host(workspace), image_name)
+    with image_digests_lock:
+        if k not in image_digests:
+            image_digests[k] = docker.image_id('{}-{}'.format(image_name, workspace.arch), docker_host(workspace))
+        return image_digests[k]
+
+def prepare_source(workspace, probe, image_name, dockerfile_tag):
+    # run cmake on the driver source once per probe and builder image (on every Docker daemon,
+    # their images are built separately) and keep the result in the workspace, so that
+    # the per-kernel builds only need to run make (the configured tree does not depend on the kernel)
+    host = docker_host(workspace)
+    k = (probe.probe_name, probe.probe_version, dockerfile_tag, host)
+    with prepared_sources_lock:
+        key_lock = prepared_sources_locks.setdefault(k, threading.Lock())
+
+    with key_lock:
+        if k in prepared_sources:
+            return prepared_sources[k]
+
+        name = dockerfile_tag
+        if host is not None:
+            name = '{}@{}'.format(dockerfile_tag, re.sub(r'[^A-Za-z0-9.-]+', '_', host))
+        prepared_dir = workspace.subdir('prepared', '{}-{}'.format(probe.probe_name, probe.probe_version), name)
+        if os.path.exists(os.path.join(prepared_dir, '.configured')):
+            logger.info('Using configured driver source in {}'.format(prepared_dir))
+        else:
+            # configure into a temporary directory and rename it when done
+            # so that we never use a half-configured tree
+            tmp_dir = prepared_dir + '.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir, 0o755)
+            volumes = [
+                volume(workspace, probe.sysdig_dir, '/code/sysdig-ro', True),
+                volume(workspace, tmp_dir, '/code/prepared', False),
+            ]
+            env = [
+                docker.EnvVar('PROBE_NAME', probe.probe_name),
+                docker.EnvVar('PROBE_VERSION', probe.probe_version),
+                docker.EnvVar('PROBE_DEVICE_NAME', probe.probe_device_name),
+            ]
+            try:
+                with trace.span('prepare_source', 'image', image=image_name, probe=probe.probe_version):
+                    docker.run(image_name, volumes, ['configure'], env, arch=workspace.arch,
+                               host=docker_host(workspace), copy_volumes=copies_files(workspace))
+            except subprocess.CalledProcessError:
+                logger.warn('Failed to configure driver source with {}, every build will configure it again'.format(
+                    image_name))
+                prepared_dir = None
+            else:
+                shutil.rmtree(prepared_dir, ignore_errors=True)
+                os.rename(tmp_dir, prepared_dir)
+
+        prepared_sources[k] = prepared_dir
+        return prepared_dir
+
+def ccache_dir(workspace, image_name):
+    # keep a separate cache for every builder image (and architecture),
+    # so that objects built by different compilers never get mixed up
+    _, tag = image_name.rsplit(':', 1)
+    return workspace.subdir('ccache', '{}-{}'.format(tag, workspace.arch))
+
+def ccache_stats(workspace):
+    for image_name in sorted(ccache_images):
+        volumes = [
+            docker.DockerVolume(workspace.host_dir(ccache_dir(workspace, image_name)), '/ccache', False),
+        ]
+        env = [
+            docker.EnvVar('CCACHE_DIR', '/ccache'),
+        ]
+        try:
+            stdout = docker.run(image_name, volumes, ['ccache-stats'], env, arch=workspace.arch)
+        except subprocess.CalledProcessError:
+            logger.warn('Failed to get compiler cache statistics for {}'.format(image_name))
+            continue
+        logger.info('Compiler cache statistics for {}:'.format(image_name))
+        for line in stdout.splitlines(False):
+            logger.info(make_string(line))
+
+async def run(workspace, probe, kernel_dir, kernel_release,
+              config_hash, container_name, image_name, args, prepared_dir=None, cpus=None, log_path=None):
+    # log_path is relative to the workspace, by default the output only goes to the debug log
+    if copies_files(workspace):
+        # don't copy the whole workspace, just the kernel headers
+        # (along with their siblings, e.g. the -common headers on Debian)
+        headers_dir = os.path.dirname(kernel_dir)
+        kernel_volume = volume(workspace, headers_dir, headers_dir.replace(workspace.workspace, '/build/probe'), True)
+    else:
+        kernel_volume = volume(workspace, workspace.workspace, '/build/probe', True)
     volumes = [
-        docker.DockerVolume(workspace.host_dir(probe.sysdig_dir), '/code/sysdig-ro', True),
-        docker.DockerVolume(workspace.host_workspace(), '/build/probe', True),
-        docker.DockerVolume(workspace.host_workspace() + "/output", '/output', False),
+        kernel_volume,
+        volume(workspace, workspace.subdir('output'), '/output', False),
     ]
+    # with a prepared tree, the container doesn't need the checkout (don't copy it for nothing)
+    if prepared_dir is None or not copies_files(workspace):
+        volumes.insert(0, volume(workspace, probe.sysdig_dir, '/code/sysdig-ro', True))
+    tmpfs = []
+    if prepared_dir is not None:
+        volumes.append(volume(workspace, prepared_dir, '/code/prepared', True))
+        # the writable copy of the (prepared) driver source and the build directory are scratch space,
+        # keep them in memory so that the only thing written to disk is the probe. Without a prepared
+        # tree, the whole checkout gets copied and configured, on disk
+        if workspace.tmpfs_size and workspace.tmpfs_size != '0':
+            options = 'exec,size={}'.format(workspace.tmpfs_size)
+            tmpfs = [
+                docker.DockerTmpfs('/code/sysdig-rw', options),
+                docker.DockerTmpfs('/build/sysdig', options),
+            ]
     env = [
         docker.EnvVar('OUTPUT', '/output'),
         docker.EnvVar('PROBE_NAME', probe.probe_name),
@@ -57,10 +428,32 @@ def run(workspace, probe, kernel_dir, kernel_release,
         docker.EnvVar('KERNELDIR', kernel_dir.replace(workspace.workspace, '/build/probe/')),
         docker.EnvVar('KERNEL_RELEASE', kernel_release),
         docker.EnvVar('HASH', config_hash),
-        docker.EnvVar('HASH_ORIG', config_hash)
     ]
 
-    return docker.run(image_name, volumes, args, env, name=container_name, arch=workspace.arch)
+    if cpus is not None:
+        env.append(docker.EnvVar('MAKE_JOBS', cpus))
+
+    # there's no point in copying the compiler cache back and forth
+    if workspace.ccache_size and not copies_files(workspace):
+        cache_dir = ccache_dir(workspace, image_name)
+        try:
+            os.makedirs(cache_dir, 0o755)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        volumes.append(volume(workspace, cache_dir, '/ccache', False))
+        env.append(docker.EnvVar('CCACHE_DIR', '/ccache'))
+        env.append(docker.EnvVar('CCACHE_MAXSIZE', workspace.ccache_size))
+        ccache_images.add(image_name)
+
+    if log_path is not None:
+        sink = BuildLog(workspace.subdir(log_path), kernel_release)
+    else:
+        sink = docker.LogSink(kernel_release)
+    return await docker.run_async(image_name, volumes, args, env, name=container_name, arch=workspace.arch,
+                                  tmpfs=tmpfs, cpus=cpus, host=docker_host(workspace),
+                                  copy_volumes=copies_files(workspace), sink=sink,
+                                  timeout=workspace.build_timeout)
 
 
 def probe_output_file(mach, probe, kernel_release, config_hash, bpf):
@@ -112,12 +505,25 @@ MIN_EBPF_SUPPORTED_RELEASE = {
     's390x': '5.5',
 }
 
-def probe_built(mach, probe, output_dir, kernel_release, config_hash, bpf):
+def probe_built(mach, probe, output_dir, kernel_release, config_hash, bpf, refresh=False):
+    # pass refresh=True after running a build to pick up its output
     probe_file_name = probe_output_file(mach, probe, kernel_release, config_hash, bpf)
-    return os.path.exists(os.path.join(output_dir, probe_file_name))
+    index = output_index(output_dir)
+    if refresh:
+        return index.refresh(probe_file_name)
+    return probe_file_name in index
+
+def probe_built_any_config(mach, probe, output_dir, kernel_release, bpf):
+    # for kernels we haven't unpacked yet, so we don't know the config hash
+    probe_file_name = probe_output_file(mach, probe, kernel_release, 'any', bpf)
+    return output_index(output_dir).contains_any_config(probe_file_name)
 
 def skip_build(mach, probe, output_dir, kernel_release, config_hash, bpf):
-    if probe_built(mach, probe, output_dir, kernel_release, config_hash, bpf):
+    # config_hash may be None when planning a build for a kernel we haven't unpacked
+    if config_hash is None:
+        if probe_built_any_config(mach, probe, output_dir, kernel_release, bpf):
+            return "Already built"
+    elif probe_built(mach, probe, output_dir, kernel_release, config_hash, bpf):
         return "Already built"
 
     if (kernel_release, config_hash) in SKIPPED_KERNELS:
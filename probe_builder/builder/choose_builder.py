@@ -1,7 +1,7 @@
 import os
 import logging
 import re
-import glob
+import threading
 
 from ..version import Version
 
@@ -12,6 +12,58 @@ LINUX_COMPILER_RE = re.compile('^#define LINUX_COMPILER "gcc version ([0-9.]+)')
 FEDORA_KERNEL_RE = re.compile(r'.*\.(fc[0-9]+)\..*Kernel Configuration$')
 AMAZONLINUX2_KERNEL_RE = re.compile(r'.*\.amzn2\..*Kernel Configuration$')
 
+# the names of the Dockerfiles in the builder source directories, listed once
+dockerfile_catalogs = {}
+dockerfile_catalogs_lock = threading.Lock()
+
+
+def dockerfile_catalog(builder_source):
+    with dockerfile_catalogs_lock:
+        catalog = dockerfile_catalogs.get(builder_source)
+        if catalog is None:
+            catalog = sorted(f for f in os.listdir(builder_source) if f.startswith('Dockerfile.'))
+            dockerfile_catalogs[builder_source] = catalog
+        return catalog
+
+
+# the (filename, [GCC-]Version, support_bpf) tuples of the gcc builders
+# of every builder distro, sorted by version
+gcc_dockerfiles = {}
+gcc_dockerfiles_lock = threading.Lock()
+
+
+class KernelMetadata(object):
+    # What we need to know about an unpacked kernel to pick its builder,
+    # found in a single pass over the generated headers
+    def __init__(self, distro_tag=None, gcc_version=None):
+        self.distro_tag = distro_tag
+        self.gcc_version = gcc_version
+
+    @classmethod
+    def scan(cls, kernel_dir):
+        metadata = cls()
+        try:
+            with open(os.path.join(kernel_dir, "include/generated/autoconf.h")) as fp:
+                for line in fp:
+                    if metadata.distro_tag is None:
+                        m = FEDORA_KERNEL_RE.match(line)
+                        if m:
+                            metadata.distro_tag = m.group(1)
+                        elif AMAZONLINUX2_KERNEL_RE.match(line):
+                            metadata.distro_tag = 'amzn2'
+                    if metadata.gcc_version is None:
+                        m = AUTOCONF_RE.match(line)
+                        if m:
+                            version = [int(m.group(1)), int(m.group(2)), int(m.group(3))]
+                            metadata.gcc_version = '.'.join(str(s) for s in version)
+                    if metadata.distro_tag is not None and metadata.gcc_version is not None:
+                        break
+        except IOError:
+            pass
+        if metadata.gcc_version is None:
+            metadata.gcc_version = get_kernel_gcc_version(kernel_dir, autoconf=False)
+        return metadata
+
 
 def get_kernel_distro_tag(kernel_dir):
     # Try to find a distro-specific builder based on the version
@@ -37,17 +89,20 @@ def get_kernel_distro_tag(kernel_dir):
         pass
 
 
-def choose_distro_dockerfile(builder_source, _builder_distro, kernel_dir):
+def choose_distro_dockerfile(builder_source, _builder_distro, kernel_dir, metadata=None):
     # Look for a distro-specific tag within the source header files
-    distro_tag = get_kernel_distro_tag(kernel_dir)
+    if metadata is not None:
+        distro_tag = metadata.distro_tag
+    else:
+        distro_tag = get_kernel_distro_tag(kernel_dir)
     if distro_tag is None:
         return
 
     # if we have a distro tag (e.g. fc34), look for that exact Dockerfile.fc34* (modulo the -bpf suffix)
-    dockerfile = os.path.join(builder_source, 'Dockerfile.{}'.format(distro_tag))
-    m = glob.glob(dockerfile+'*')
+    prefix = 'Dockerfile.{}'.format(distro_tag)
+    m = [f for f in dockerfile_catalog(builder_source) if f.startswith(prefix)]
     if m:
-        fn = m[0]
+        fn = os.path.join(builder_source, m[0])
         return fn, distro_tag, fn.endswith("-bpf")
 
 def all_dockerfiles(builder_source):
@@ -56,20 +111,22 @@ def all_dockerfiles(builder_source):
         (f, f.replace(prefix,'')) for f in os.listdir(builder_source) if f.startswith(prefix)
     ]
 
-def get_kernel_gcc_version(kernel_dir):
+def get_kernel_gcc_version(kernel_dir, autoconf=True):
     # Try to find the gcc version used to build this particular kernel
     # Check CONFIG_GCC_VERSION=90201 in the kernel config first
     # as 5.8.0 seems to have a different format for the LINUX_COMPILER string
-    try:
-        logger.debug('checking {} for gcc version'.format(os.path.join(kernel_dir, "include/generated/autoconf.h")))
-        with open(os.path.join(kernel_dir, "include/generated/autoconf.h")) as fp:
-            for line in fp:
-                m = AUTOCONF_RE.match(line)
-                if m:
-                    version = [int(m.group(1)), int(m.group(2)), int(m.group(3))]
-                    return '.'.join(str(s) for s in version)
-    except IOError:
-        pass
+    # (with autoconf=False, the caller already did)
+    if autoconf:
+        try:
+            logger.debug('checking {} for gcc version'.format(os.path.join(kernel_dir, "include/generated/autoconf.h")))
+            with open(os.path.join(kernel_dir, "include/generated/autoconf.h")) as fp:
+                for line in fp:
+                    m = AUTOCONF_RE.match(line)
+                    if m:
+                        version = [int(m.group(1)), int(m.group(2)), int(m.group(3))]
+                        return '.'.join(str(s) for s in version)
+        except IOError:
+            pass
 
     # then, try the LINUX_COMPILER macro, in two separate files
     try:
@@ -97,8 +154,11 @@ def get_kernel_gcc_version(kernel_dir):
     return '4.8.0'
 
 
-def choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir):
-    kernel_gcc = get_kernel_gcc_version(kernel_dir)
+def choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir, metadata=None):
+    if metadata is not None:
+        kernel_gcc = metadata.gcc_version
+    else:
+        kernel_gcc = get_kernel_gcc_version(kernel_dir)
     logger.debug('kernel gcc version: {}'.format(kernel_gcc))
 
     # We don't really care about the compiler patch levels, only the major/minor version
@@ -129,22 +189,7 @@ def choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir):
     #   9.2
     #   10.0
     # and now we properly realize that gcc 10 is newer than 9.2, not older than 4.4
-
-    # we're looking for something like Dockerfile.<builder_distro>-gcc<gcc_version>[-bpf]
-    #                                  ^------prefix-----------------^
-    prefix = 'Dockerfile.{}-gcc'.format(builder_distro)
-    # build a regex from which we can extract all available gcc versions
-    # NOTE: for now we're having the consumer figure the logic by itself
-    regex = re.compile('^' + re.escape(prefix) + '(?P<gccver>[0-9]+\.[0-9]+)(?P<bpf>(\-bpf)?)$')
-
-    # build a list of (filename, [GCC-]Version, support_bpf) tuples
-    dockerfile_versions = [
-        (f, Version(regex.match(f).group('gccver')), regex.match(f).group('bpf') != "")
-        for f in os.listdir(builder_source)
-        if regex.match(f)
-    ]
-    # sort by Version (using semantic versioning)
-    dockerfile_versions.sort(key=lambda t: t[1])
+    dockerfile_versions = gcc_dockerfile_versions(builder_source, builder_distro)
     logger.debug('available (dockerfile, gcc-version, support-bpf) combinations: {!r}'.format(dockerfile_versions))
 
     # mind: exact match, slightly newer, slightly older, in that order of preference
@@ -163,12 +208,40 @@ def choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir):
     return os.path.join(builder_source, dockerfile), tag, support_bpf
 
 
+def gcc_dockerfile_versions(builder_source, builder_distro):
+    k = (builder_source, builder_distro)
+    with gcc_dockerfiles_lock:
+        if k in gcc_dockerfiles:
+            return gcc_dockerfiles[k]
+
+    # we're looking for something like Dockerfile.<builder_distro>-gcc<gcc_version>[-bpf]
+    #                                  ^------prefix-----------------^
+    prefix = 'Dockerfile.{}-gcc'.format(builder_distro)
+    # build a regex from which we can extract all available gcc versions
+    # NOTE: for now we're having the consumer figure the logic by itself
+    regex = re.compile('^' + re.escape(prefix) + '(?P<gccver>[0-9]+\.[0-9]+)(?P<bpf>(\-bpf)?)$')
+
+    # build a list of (filename, [GCC-]Version, support_bpf) tuples
+    dockerfile_versions = [
+        (f, Version(regex.match(f).group('gccver')), regex.match(f).group('bpf') != "")
+        for f in dockerfile_catalog(builder_source)
+        if regex.match(f)
+    ]
+    # sort by Version (using semantic versioning)
+    dockerfile_versions.sort(key=lambda t: t[1])
+
+    with gcc_dockerfiles_lock:
+        gcc_dockerfiles[k] = dockerfile_versions
+        return dockerfile_versions
+
+
 # return the tuple ("/path/to/Dockerfile.centos-gcc11.0-bpf", "gcc11.0-bpf", True)
-def choose_dockerfile(builder_source, builder_distro, kernel_dir):
+def choose_dockerfile(builder_source, builder_distro, kernel_dir, metadata=None):
+    # metadata (a KernelMetadata) saves looking at the kernel headers again
     # First, let'see if we can find a dockerfile for the exact same kernel distro
-    dockerfile_with_tag = choose_distro_dockerfile(builder_source, builder_distro, kernel_dir)
+    dockerfile_with_tag = choose_distro_dockerfile(builder_source, builder_distro, kernel_dir, metadata)
     if dockerfile_with_tag is not None:
         return dockerfile_with_tag
 
     # If not, let's find one with the same builder distro and gcc version
-    return choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir)
+    return choose_gcc_dockerfile(builder_source, builder_distro, kernel_dir, metadata)
@@ -1,4 +1,7 @@
+import asyncio
 import errno
+import functools
+import json
 import logging
 import os
 import subprocess
@@ -6,16 +9,21 @@ import time
 
 import click
 
-from probe_builder import docker
-from probe_builder.builder import builder_image, choose_builder
+from probe_builder import docker, metrics, spawn, trace
+from probe_builder.builder import artifacts, builder_image, choose_builder
 from probe_builder.kernel_crawler import crawl_kernels
 from probe_builder.kernel_crawler.repo import EMPTY_FILTER
 from probe_builder.kernel_crawler.download import download_batch
-from probe_builder.py23 import make_bytes, make_string
 
 logger = logging.getLogger(__name__)
 
 
+async def run_blocking(fn, *args):
+    # run the parts of a build that block (talking to Docker outside
+    # of the containers, the ledger, reading files) in the event loop's thread pool
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+
 def to_s(s):
     if s is None:
         return ''
@@ -29,10 +37,14 @@ class DistroBuilder(object):
         BUILD_EXISTING=1
         BUILD_SKIPPED=2
         BUILD_FAILED=3
-        def __init__(self, build_result, build_time=0, error_log=b''):
+        BUILD_KNOWN_FAILURE=4
+        BUILD_REUSED=5
+        def __init__(self, build_result, build_time=0, error_log=b'', log_path=None):
             self.build_time = build_time
             self.build_result = build_result
+            # the tail of the build output, the whole output is in log_path (relative to the workspace)
             self.error_log = error_log
+            self.log_path = log_path
 
         def build_result_string(self):
             mydict = {
@@ -40,29 +52,43 @@ class DistroBuilder(object):
                 self.BUILD_EXISTING: 'EXISTING',
                 self.BUILD_SKIPPED: 'SKIPPED',
                 self.BUILD_FAILED: 'FAILED',
+                self.BUILD_KNOWN_FAILURE: 'KNOWN_FAIL',
+                self.BUILD_REUSED: 'REUSED',
             }
             return mydict[self.build_result]
 
         def failed(self):
-            return self.build_result == self.BUILD_FAILED
+            return self.build_result in (self.BUILD_FAILED, self.BUILD_KNOWN_FAILURE)
 
     class KernelBuildResult(object):
         def __init__(self, kmod_result, ebpf_result):
             self.kmod_result = kmod_result
             self.ebpf_result = ebpf_result
+            # filled in by build_kernel: the builder image and how long each phase took (in seconds)
+            self.builder_image = None
+            self.phases = {}
 
         def failed(self):
             return self.kmod_result.failed() or self.ebpf_result.failed()
 
+    # kept in the directory the kernel is unpacked to, next to the unpack markers
+    METADATA_FILE = '.kernel-metadata-{}.json'
+
     @staticmethod
     def md5sum(path):
         from hashlib import md5
         digest = md5()
-        with open(path) as fp:
-            digest.update(fp.read().encode('utf-8'))
+        with open(path, 'rb') as fp:
+            while True:
+                chunk = fp.read(65536)
+                if not chunk:
+                    break
+                digest.update(chunk)
         return digest.hexdigest()
 
-    def unpack_kernels(self, workspace, distro, kernels):
+    def unpack_kernels(self, workspace, distro, kernels, unpack=True):
+        # with unpack=False, only return the target directories
+        # (used when planning a build)
         raise NotImplementedError
 
     def hash_config(self, release, target):
@@ -72,8 +98,8 @@ class DistroBuilder(object):
         raise NotImplementedError
 
     @classmethod
-    def build_kernel_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace, bpf,
-                          skip_reason):
+    async def build_kernel_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace, bpf,
+                          skip_reason, prepared_dir=None, cpus=None):
         if bpf:
             label = 'eBPF'
             args = ['bpf']
@@ -89,27 +115,87 @@ class DistroBuilder(object):
             logger.info('Skipping build of {} probe {}-{}: {}'.format(label, release, config_hash, skip_reason))
             return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_SKIPPED, 0)
 
+        log_path = builder_image.build_log_path(probe, release, config_hash, 'ebpf' if bpf else 'kmod')
         #docker.rm(container_name)
         try:
             ts0 = time.time()
-            stdout = builder_image.run(workspace, probe, kernel_dir, release, config_hash, container_name, image_name, args)
-        except subprocess.CalledProcessError as e:
+            with trace.span('build_kernel_impl', kernel=release, config_hash=config_hash, kind=label):
+                stdout = await builder_image.run(workspace, probe, kernel_dir, release, config_hash, container_name,
+                                                 image_name, args, prepared_dir, cpus, log_path)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
             took = time.time() - ts0
-            logger.error("Build failed for {} probe {}-{} (took {:.3f}s)".format(label, release, config_hash, took))
-            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, e.output)
+            metrics.build_seconds.observe(took, builder_image=image_name, kind='ebpf' if bpf else 'kmod')
+            logger.error("Build failed for {} probe {}-{} (took {:.3f}s), see {}".format(
+                label, release, config_hash, took, log_path))
+            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, e.output, log_path)
         else:
             took = time.time() - ts0
-            if builder_image.probe_built(workspace.machine, probe, output_dir, release, config_hash, bpf):
+            metrics.build_seconds.observe(took, builder_image=image_name, kind='ebpf' if bpf else 'kmod')
+            if builder_image.probe_built(workspace.machine, probe, output_dir, release, config_hash, bpf, refresh=True):
                 logger.info("Build for {} probe {}-{} successful (took {:.3f}s)".format(label, release, config_hash, took))
-                return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_BUILT, took)
+                return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_BUILT, took, log_path=log_path)
             else:
-                logger.warn("Build for {} probe {}-{} failed silently: no output file found".format(label, release, config_hash))
-                for line in stdout.splitlines(False):
-                    logger.warn(make_string(line))
-                return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, stdout)
+                logger.warn("Build for {} probe {}-{} failed silently: no output file found, see {}".format(
+                    label, release, config_hash, log_path))
+                return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, stdout, log_path)
 
-    def build_kernel(self, ignorelist, workspace, probe, builder_distro, release, target):
-        config_hash = self.hash_config(release, target)
+    @classmethod
+    async def build_kernel_combined_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace,
+                                   prepared_dir=None, cpus=None):
+        # build both the kmod and the eBPF probe in a single container,
+        # sharing the source copy and the cmake configuration step
+        output_dir = workspace.subdir('output')
+        log_path = builder_image.build_log_path(probe, release, config_hash, 'all')
+        ts0 = time.time()
+        try:
+            with trace.span('build_kernel_impl', kernel=release, config_hash=config_hash, kind='kmod+eBPF'):
+                stdout = await builder_image.run(workspace, probe, kernel_dir, release, config_hash, container_name,
+                                                 image_name, ['all'], prepared_dir, cpus, log_path)
+            build_failed = False
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            stdout = e.output
+            build_failed = True
+        took = time.time() - ts0
+        metrics.build_seconds.observe(took, builder_image=image_name, kind='all')
+
+        results = []
+        for bpf, label in ((False, 'kmod'), (True, 'eBPF')):
+            if builder_image.probe_built(workspace.machine, probe, output_dir, release, config_hash, bpf, refresh=True):
+                logger.info("Build for {} probe {}-{} successful (took {:.3f}s)".format(label, release, config_hash, took))
+                results.append(cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_BUILT, took, log_path=log_path))
+            elif build_failed:
+                logger.error("Build failed for {} probe {}-{} (took {:.3f}s), see {}".format(
+                    label, release, config_hash, took, log_path))
+                results.append(cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, stdout, log_path))
+            else:
+                logger.warn("Build for {} probe {}-{} failed silently: no output file found, see {}".format(
+                    label, release, config_hash, log_path))
+                results.append(cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, stdout, log_path))
+
+        return cls.KernelBuildResult(*results)
+
+    def build_kernel(self, ignorelist, workspace, probe, builder_distro, release, target, scheduler=None, ledger=None,
+                     endpoints=None, artifact_store=None):
+        # for callers outside of an event loop (e.g. the work queue workers)
+        return spawn.run_sync(self.build_kernel_async(ignorelist, workspace, probe, builder_distro, release, target,
+                                                      scheduler, ledger, endpoints, artifact_store))
+
+    async def build_kernel_async(self, ignorelist, workspace, probe, builder_distro, release, target, scheduler=None,
+                                 ledger=None, endpoints=None, artifact_store=None):
+        if endpoints is not None:
+            # do everything on one of the Docker daemons
+            endpoint = await endpoints.acquire_async()
+            try:
+                return await self.build_kernel_async(ignorelist, workspace._replace(endpoint=endpoint), probe,
+                                                     builder_distro, release, target, scheduler, ledger,
+                                                     artifact_store=artifact_store)
+            finally:
+                endpoints.release(endpoint)
+
+        phases = {}
+        ts0 = time.time()
+        config_hash, metadata = await run_blocking(self.kernel_metadata, workspace, release, target)
+        phases['kernel_metadata'] = time.time() - ts0
         output_dir = workspace.subdir('output')
 
         kmod_skip_reason = builder_image.skip_build(workspace.machine, probe, output_dir, release, config_hash, False)
@@ -129,13 +215,15 @@ class DistroBuilder(object):
                 raise
 
         kernel_dir = self.get_kernel_dir(workspace, release, target)
-        dockerfile, dockerfile_tag, support_bpf = choose_builder.choose_dockerfile(workspace.builder_source, builder_distro,
-                                                                    kernel_dir)
+        dockerfile, dockerfile_tag, support_bpf = await run_blocking(choose_builder.choose_dockerfile,
+                                                                     workspace.builder_source, builder_distro,
+                                                                     kernel_dir, metadata)
 
         ts0 = time.time()
         # let build() figure out if it actually needs to build or pull anything
-        builder_image.build(workspace, dockerfile, dockerfile_tag)
+        await run_blocking(builder_image.build, workspace, dockerfile, dockerfile_tag)
         took = time.time() - ts0
+        phases['builder_image'] = took
 
         logger.info("Docker building of {} took {:.2f}s".format(dockerfile, took))
 
@@ -146,18 +234,255 @@ class DistroBuilder(object):
         #container_name = 'sysdig-probe-builder-{}'.format(dockerfile_tag)
         container_name = ''
 
-        return self.KernelBuildResult(
-            self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release, workspace, False,
-                                kmod_skip_reason),
-            self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release, workspace, True,
-                                ebpf_skip_reason),
-        )
+        # probes built from the same inputs (e.g. for the same kernel in another distro)
+        # only need linking into the output directory
+        fingerprints = {}
+        kmod_reused = False
+        ebpf_reused = False
+        if artifact_store is not None and not (kmod_skip_reason and ebpf_skip_reason):
+            ts0 = time.time()
+            headers = await run_blocking(artifacts.header_digest, kernel_dir)
+            builder_hash = await run_blocking(builder_image.content_hash, dockerfile, workspace.builder_source,
+                                              workspace.arch)
+            for kind, bpf in (('kmod', False), ('ebpf', True)):
+                fingerprints[bpf] = artifacts.fingerprint(workspace.machine, probe, release, config_hash, headers,
+                                                          builder_hash, kind)
+            if not kmod_skip_reason and await run_blocking(self.reuse_probe, artifact_store, fingerprints[False],
+                                                           workspace, probe, release, config_hash, False):
+                kmod_reused = True
+                kmod_skip_reason = 'Reused a probe built from the same inputs'
+            if not ebpf_skip_reason and await run_blocking(self.reuse_probe, artifact_store, fingerprints[True],
+                                                           workspace, probe, release, config_hash, True):
+                ebpf_reused = True
+                ebpf_skip_reason = 'Reused a probe built from the same inputs'
+            phases['artifact_store'] = time.time() - ts0
+
+        # don't retry builds that failed in a previous run with the same inputs
+        kmod_known_failure = False
+        ebpf_known_failure = False
+        image_digest = None
+        if ledger is not None:
+            image_digest = await run_blocking(builder_image.image_digest, workspace, image_name)
+            if not kmod_skip_reason and await run_blocking(ledger.known_failure, probe, workspace.machine, release,
+                                                           config_hash, 'kmod', image_digest):
+                kmod_known_failure = True
+                kmod_skip_reason = 'Failed in a previous run'
+            if not ebpf_skip_reason and await run_blocking(ledger.known_failure, probe, workspace.machine, release,
+                                                           config_hash, 'ebpf', image_digest):
+                ebpf_known_failure = True
+                ebpf_skip_reason = 'Failed in a previous run'
+
+        if kmod_skip_reason and ebpf_skip_reason:
+            # nothing to build, let build_kernel_impl report why
+            result = self.KernelBuildResult(
+                await self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release,
+                                             workspace, False, kmod_skip_reason),
+                await self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release,
+                                             workspace, True, ebpf_skip_reason),
+            )
+        else:
+            # configure the driver source for this builder (only once)
+            ts0 = time.time()
+            prepared_dir = await run_blocking(builder_image.prepare_source, workspace, probe, image_name,
+                                              dockerfile_tag)
+            phases['prepare_source'] = time.time() - ts0
+
+            cpus = None
+            if scheduler is not None:
+                cpus = await scheduler.acquire_cpus_async(workspace.endpoint)
+            ts0 = time.time()
+            try:
+                if not kmod_skip_reason and not ebpf_skip_reason:
+                    # both probes need building, do it in one go
+                    result = await self.build_kernel_combined_impl(config_hash, container_name, image_name,
+                                                                   kernel_dir, probe, release, workspace, prepared_dir,
+                                                                   cpus)
+                else:
+                    result = self.KernelBuildResult(
+                        await self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe,
+                                                     release, workspace, False, kmod_skip_reason, prepared_dir, cpus),
+                        await self.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe,
+                                                     release, workspace, True, ebpf_skip_reason, prepared_dir, cpus),
+                    )
+            finally:
+                if scheduler is not None:
+                    scheduler.release_cpus(cpus, workspace.endpoint)
+
+            phases['build'] = time.time() - ts0
+            if scheduler is not None:
+                scheduler.record(release, dockerfile_tag, phases['build'])
+
+        if kmod_known_failure:
+            result.kmod_result = self.ProbeBuildResult(self.ProbeBuildResult.BUILD_KNOWN_FAILURE)
+        if ebpf_known_failure:
+            result.ebpf_result = self.ProbeBuildResult(self.ProbeBuildResult.BUILD_KNOWN_FAILURE)
+        if kmod_reused:
+            result.kmod_result = self.ProbeBuildResult(self.ProbeBuildResult.BUILD_REUSED)
+        if ebpf_reused:
+            result.ebpf_result = self.ProbeBuildResult(self.ProbeBuildResult.BUILD_REUSED)
+
+        # keep what we built (once per content) for the next kernel with the same inputs
+        if artifact_store is not None:
+            for bpf, res in ((False, result.kmod_result), (True, result.ebpf_result)):
+                if res.build_result != res.BUILD_BUILT:
+                    continue
+                output_file = os.path.join(
+                    output_dir, builder_image.probe_output_file(workspace.machine, probe, release, config_hash, bpf))
+                await run_blocking(artifact_store.store, output_file, fingerprints.get(bpf))
+
+        result.builder_image = image_name
+        result.phases = phases
+
+        for kind, res in (('kmod', result.kmod_result), ('ebpf', result.ebpf_result)):
+            metrics.build_results.inc(kind=kind, result=res.build_result_string())
+
+        if ledger is not None:
+            for kind, res in (('kmod', result.kmod_result), ('ebpf', result.ebpf_result)):
+                if res.build_result in (res.BUILD_EXISTING, res.BUILD_REUSED):
+                    await run_blocking(ledger.record_existing, probe, workspace.machine, release, config_hash, kind)
+                elif res.build_result in (res.BUILD_BUILT, res.BUILD_FAILED):
+                    await run_blocking(ledger.record, probe, workspace.machine, release, config_hash, kind, image_name,
+                                       image_digest, res.build_result_string(), res.build_time, res.error_log,
+                                       res.log_path)
+
+        return result
+
+    @staticmethod
+    def reuse_probe(artifact_store, fp, workspace, probe, release, config_hash, bpf):
+        output_dir = workspace.subdir('output')
+        output_file = builder_image.probe_output_file(workspace.machine, probe, release, config_hash, bpf)
+        if not artifact_store.fetch(fp, os.path.join(output_dir, output_file)):
+            return False
+        return builder_image.probe_built(workspace.machine, probe, output_dir, release, config_hash, bpf, refresh=True)
+
+    def kernel_metadata(self, workspace, release, target, save=True):
+        # return the config hash and the choose_builder.KernelMetadata of an unpacked kernel,
+        # found once and saved in the target directory (until a package gets unpacked there again)
+        # with save=False, a saved copy is still used but nothing gets written (e.g. for --plan)
+        metadata_path = os.path.join(target, self.METADATA_FILE.format(release.replace('/', '_')))
+        try:
+            saved = os.stat(metadata_path).st_mtime
+            newest_marker = max([entry.stat().st_mtime for entry in os.scandir(target)
+                                 if entry.name.startswith('.') and not entry.name.startswith('.kernel-metadata-')]
+                                or [0])
+            if newest_marker <= saved:
+                with open(metadata_path) as fp:
+                    doc = json.load(fp)
+                return doc['config_hash'], choose_builder.KernelMetadata(doc['distro_tag'], doc['gcc_version'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        config_hash = self.hash_config(release, target)
+        metadata = choose_builder.KernelMetadata.scan(self.get_kernel_dir(workspace, release, target))
+        if not save:
+            return config_hash, metadata
+        try:
+            tmp_path = metadata_path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump({'config_hash': config_hash, 'distro_tag': metadata.distro_tag,
+                           'gcc_version': metadata.gcc_version}, fp)
+            os.rename(tmp_path, metadata_path)
+        except (IOError, OSError) as exc:
+            logger.warn('Failed to save the metadata of {}: {}'.format(release, exc))
+        return config_hash, metadata
+
+    def unique_builds(self, workspace, kernel_dirs):
+        # collapse the (release, target) pairs into the builds that actually need running:
+        # the same kernel may show up under more than one distro release (e.g. in 7 and 7.9,
+        # or in both os and updates), unpacked into the same target directory
+        # return a list of (krel, target, [release, ...]) tuples
+        builds = {}
+        for release, target in kernel_dirs:
+            drel, krel = release if type(release) is tuple else ("", release)
+            try:
+                config_hash, _ = self.kernel_metadata(workspace, krel, target)
+            except (IOError, OSError):
+                # the build will fail (and report it) on its own
+                config_hash = None
+            builds.setdefault((krel, config_hash, target), []).append(release)
+
+        if len(builds) < len(kernel_dirs):
+            logger.info('Building {} unique kernels for {} distro releases'.format(len(builds), len(kernel_dirs)))
+        return [(krel, target, releases) for (krel, _, target), releases in builds.items()]
+
+    def kernel_builder(self, workspace, builder_distro, release, target):
+        # the (dockerfile, tag) pair of the builder image an unpacked kernel needs
+        _, metadata = self.kernel_metadata(workspace, release, target)
+        dockerfile, dockerfile_tag, _ = choose_builder.choose_dockerfile(
+            workspace.builder_source, builder_distro, self.get_kernel_dir(workspace, release, target), metadata)
+        return dockerfile, dockerfile_tag
+
+    def builder_dockerfiles(self, workspace, builder_distro, kernel_dirs):
+        # the (dockerfile, tag) pairs of the builder images the (unpacked) kernels need
+        dockerfiles = set()
+        for release, target in kernel_dirs:
+            drel, krel = release if type(release) is tuple else ("", release)
+            try:
+                dockerfiles.add(self.kernel_builder(workspace, builder_distro, krel, target))
+            except Exception as exc:
+                # the build of this kernel will fail (and report it) on its own
+                logger.warn('Failed to choose a builder for {}: {}'.format(krel, exc))
+        return dockerfiles
+
+    def plan_kernel(self, ignorelist, workspace, probe, builder_distro, release, target):
+        # figure out what build_kernel would do, without running (or writing) anything
+        # for kernels that aren't unpacked yet, we don't know the config hash
+        # or the builder image, so the plan is only based on the release
+        output_dir = workspace.subdir('output')
+        try:
+            config_hash, metadata = self.kernel_metadata(workspace, release, target, save=False)
+        except (IOError, OSError):
+            config_hash, metadata = None, None
+
+        plan = {
+            'kernel_release': release,
+            'config_hash': config_hash,
+            'estimated': config_hash is None,
+            'builder_image': None,
+        }
+
+        dockerfile = None
+        support_bpf = True
+        if config_hash is not None:
+            kernel_dir = self.get_kernel_dir(workspace, release, target)
+            dockerfile, dockerfile_tag, support_bpf = choose_builder.choose_dockerfile(
+                workspace.builder_source, builder_distro, kernel_dir, metadata)
+            plan['builder_image'] = '{}sysdig-probe-builder:{}'.format(workspace.image_prefix, dockerfile_tag)
+
+        for kind, bpf, ignorelist_kind in (('kmod', False, 'kmod'), ('ebpf', True, 'legacy_ebpf')):
+            skip_reason = builder_image.skip_build(workspace.machine, probe, output_dir, release, config_hash, bpf)
+            if skip_reason == 'Already built':
+                plan[kind] = {'action': 'existing'}
+                continue
+            if not skip_reason:
+                skip_reason = ignorelist.ignore_reason(ignorelist_kind, release)
+            if not skip_reason and bpf and not support_bpf:
+                skip_reason = "Builder {} does not support eBPF".format(dockerfile)
+            if skip_reason:
+                plan[kind] = {'action': 'skip', 'reason': skip_reason}
+            else:
+                plan[kind] = {'action': 'build'}
+
+        return plan
 
     def batch_packages(self, kernel_files):
         raise NotImplementedError
 
-    def crawl(self, workspace, distro, crawler_distro, download_config=None, crawler_filter=EMPTY_FILTER):
+    def crawl(self, workspace, distro, crawler_distro, download_config=None, crawler_filter=EMPTY_FILTER, download=True):
         kernels = crawl_kernels(crawler_distro, crawler_filter)
+        return self.fetch_kernels(workspace, distro, kernels, download_config, download)
+
+    def batch_crawled(self, kernel_files):
+        # kernel_files is a dict {'release'=>['/local/path/to/files'....]}
+        # grouped by the crawler, which may need further batching
+        return kernel_files
+
+    def fetch_kernels(self, workspace, distro, kernels, download_config=None, download=True):
+        # download the packages returned from the crawler (or a part of them)
+        if not download:
+            # only map the URLs to the local paths they would be downloaded to
+            return self.batch_crawled({release: [workspace.subdir(distro.distro, os.path.basename(url)) for url in urls]
+                                       for release, urls in kernels.items()})
         try:
             os.makedirs(workspace.subdir(distro.distro))
         except OSError as exc:
@@ -174,4 +499,4 @@ class DistroBuilder(object):
             download_batch(all_urls, workspace.subdir(distro.distro), download_config)
 
         # kernel_files is a dict {'release'=>['/local/path/to/files'....]}
-        return kernel_files
+        return self.batch_crawled(kernel_files)
@@ -13,11 +13,13 @@ logger = logging.getLogger(__name__)
 class CentosBuilder(DistroBuilder):
     RPM_KERNEL_RELEASE_RE = re.compile(r'^kernel-(uek-)?(core-|devel-|modules-)?(?P<release>.*)\.rpm$')
 
-    def unpack_kernels(self, workspace, distro, kernels):
+    def unpack_kernels(self, workspace, distro, kernels, unpack=True):
         kernel_dirs = list()
         for (drel, krel), rpms in kernels.items():
             target = workspace.subdir('build', distro, krel)
             kernel_dirs.append(((drel,krel), target))
+            if not unpack:
+                continue
 
             for rpm in rpms:
                 rpm_basename = os.path.basename(rpm)
@@ -8,7 +8,6 @@ import click
 
 from probe_builder.builder import toolkit
 from probe_builder.builder.distro.base_builder import DistroBuilder
-from probe_builder.kernel_crawler.repo import EMPTY_FILTER
 
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(depth=4)
@@ -25,7 +24,7 @@ class DebianBuilder(DistroBuilder):
     #  linux-kbuild-6.6.8_pkgver                             |  6   . 6     . 8       optional   ^  |
     #  linux-kbuild-6.5.0-0_pkgver                           |  6   . 5     . 0      - 0            |
 
-    def crawl(self, workspace, distro, crawler_distro, download_config=None, crawler_filter=EMPTY_FILTER):
+    def batch_crawled(self, crawled_dict):
         # for debian, we essentially want to discard some of the classification work performed by the crawler
         # which will return a list of packages found in a given distro release and having a particular package version
         # ('bullseye', '6.1.38-4~bpo11+1'): ['/workspace/debian/linux-kbuild-6.1_6.1.38-4~bpo11+1_amd64.deb',
@@ -54,10 +53,6 @@ class DebianBuilder(DistroBuilder):
         #                                      '/workspace/debian/linux-headers-6.1.0-0.deb11.11-common_6.1.38-4~bpo11+1_all.deb',
         #                                      '/workspace/debian/linux-kbuild-6.1_6.1.38-4~bpo11+1_amd64.deb']}
 
-        # call the parent's method
-        crawled_dict = super().crawl(workspace=workspace, distro=distro,
-            crawler_distro=crawler_distro, download_config=download_config,
-            crawler_filter=crawler_filter)
         logger.debug("crawled_dict=\n{}".format(pp.pformat(crawled_dict)))
 
         batched_packages = {}
@@ -82,7 +77,7 @@ class DebianBuilder(DistroBuilder):
             os.unlink(build_link_path)
             os.symlink(build_link_target, build_link_path)
 
-    def unpack_kernels(self, workspace, distro, kernels):
+    def unpack_kernels(self, workspace, distro, kernels, unpack=True):
         kernel_dirs = list()
 
         for ((drel,krel), debs) in kernels.items():
@@ -93,6 +88,9 @@ class DebianBuilder(DistroBuilder):
             krel = krel.replace(':', '-')
 
             target = workspace.subdir('build', distro, version)
+            if not unpack:
+                kernel_dirs.append(((drel,krel), target))
+                continue
 
             try:
                 for deb in debs:
@@ -111,6 +109,9 @@ class DebianBuilder(DistroBuilder):
                 logger.error("release={}".format(krel))
                 traceback.print_exc()
 
+        if not unpack:
+            return kernel_dirs
+
         for (drel,krel), target in kernel_dirs:
             kerneldir = self.get_kernel_dir(workspace, krel, target)
 
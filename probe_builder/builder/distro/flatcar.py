@@ -3,25 +3,27 @@ import glob
 import logging
 import os
 import subprocess
+import time
 
 import click
 
 from .base_builder import DistroBuilder, to_s
 from .. import toolkit, builder_image
-from ... import crawl_kernels, docker
+from ... import docker, metrics, trace
 from ...kernel_crawler.download import download_file
-from ...kernel_crawler.repo import EMPTY_FILTER
 
 logger = logging.getLogger(__name__)
 
 
 class FlatcarBuilder(DistroBuilder):
-    def unpack_kernels(self, workspace, distro, kernels):
+    def unpack_kernels(self, workspace, distro, kernels, unpack=True):
         kernel_dirs = list()
 
         for release, dev_containers in kernels.items():
             target = workspace.subdir('build', distro, release)
             kernel_dirs.append((release, target))
+            if not unpack:
+                continue
 
             for dev_container in dev_containers:
                 dev_container_basename = os.path.basename(dev_container)
@@ -47,8 +49,8 @@ class FlatcarBuilder(DistroBuilder):
         return releases
 
     @classmethod
-    def build_kernel_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace, bpf,
-                          skip_reason):
+    async def build_kernel_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace, bpf,
+                          skip_reason, prepared_dir=None, cpus=None):
         if bpf:
             label = 'eBPF'
             args = ['bpf']
@@ -56,22 +58,60 @@ class FlatcarBuilder(DistroBuilder):
             label = 'kmod'
             args = []
 
+        # the probes are built (and named) for the kernel release of the development container,
+        # not for the Flatcar release
         coreos_kernel_release = os.path.basename(os.path.dirname(kernel_dir))
 
+        output_dir = workspace.subdir('output')
+        if builder_image.probe_built(workspace.machine, probe, output_dir, coreos_kernel_release, config_hash, bpf):
+            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_EXISTING, 0)
+
         if skip_reason:
             logger.info('Skipping build of {} probe {}-{} ({}): {}'.format(label, coreos_kernel_release, config_hash,
                                                                            release, skip_reason))
+            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_SKIPPED, 0)
 
-        docker.rm(container_name)
+        log_path = builder_image.build_log_path(probe, coreos_kernel_release, config_hash, 'ebpf' if bpf else 'kmod')
+        await docker.rm_async(container_name)
+        ts0 = time.time()
         try:
-            builder_image.run(workspace, probe, kernel_dir, coreos_kernel_release, config_hash, container_name, image_name, args)
-        except subprocess.CalledProcessError:
-            logger.error("Build failed for {} probe {}-{} ({})".format(label, coreos_kernel_release, config_hash, release))
-        else:
-            logger.info("Build for {} probe {}-{} ({}) successful".format(label, coreos_kernel_release, config_hash, release))
+            with trace.span('build_kernel_impl', kernel=coreos_kernel_release, config_hash=config_hash, kind=label):
+                stdout = await builder_image.run(workspace, probe, kernel_dir, coreos_kernel_release, config_hash,
+                                                 container_name, image_name, args, prepared_dir, cpus, log_path)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            took = time.time() - ts0
+            metrics.build_seconds.observe(took, builder_image=image_name, kind='ebpf' if bpf else 'kmod')
+            logger.error("Build failed for {} probe {}-{} ({}), see {}".format(label, coreos_kernel_release, config_hash,
+                                                                            release, log_path))
+            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, e.output, log_path)
+
+        took = time.time() - ts0
+        metrics.build_seconds.observe(took, builder_image=image_name, kind='ebpf' if bpf else 'kmod')
+        if builder_image.probe_built(workspace.machine, probe, output_dir, coreos_kernel_release, config_hash, bpf,
+                                     refresh=True):
+            logger.info("Build for {} probe {}-{} ({}) successful".format(label, coreos_kernel_release, config_hash,
+                                                                         release))
+            return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_BUILT, took, log_path=log_path)
+        logger.warn("Build for {} probe {}-{} ({}) failed silently: no output file found, see {}".format(
+            label, coreos_kernel_release, config_hash, release, log_path))
+        return cls.ProbeBuildResult(cls.ProbeBuildResult.BUILD_FAILED, took, stdout, log_path)
 
-    def crawl(self, workspace, distro, crawler_distro, download_config=None, crawler_filter=EMPTY_FILTER):
-        kernels = crawl_kernels(crawler_distro, crawler_filter=crawler_filter)
+    @classmethod
+    async def build_kernel_combined_impl(cls, config_hash, container_name, image_name, kernel_dir, probe, release, workspace,
+                                   prepared_dir=None, cpus=None):
+        # Flatcar builds still use one container per probe kind
+        return cls.KernelBuildResult(
+            await cls.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release, workspace,
+                                        False, None, prepared_dir, cpus),
+            await cls.build_kernel_impl(config_hash, container_name, image_name, kernel_dir, probe, release, workspace,
+                                        True, None, prepared_dir, cpus),
+        )
+
+    def fetch_kernels(self, workspace, distro, kernels, download_config=None, download=True):
+        if not download:
+            return {release: [workspace.subdir(distro.distro, '{}-{}'.format(release, os.path.basename(url)))
+                              for url in urls]
+                    for release, urls in kernels.items()}
         try:
             os.makedirs(workspace.subdir(distro.distro))
         except OSError as exc:
@@ -8,7 +8,6 @@ import click
 
 from probe_builder.builder import toolkit
 from .base_builder import DistroBuilder
-from probe_builder.kernel_crawler.repo import EMPTY_FILTER
 
 logger = logging.getLogger(__name__)
 pp = pprint.PrettyPrinter(depth=4)
@@ -17,8 +16,7 @@ class UbuntuBuilder(DistroBuilder):
     KERNEL_VERSION_RE = re.compile(r'(?P<version>[0-9]\.[0-9]+\.[0-9]+-[0-9]+)\.(?P<update>[0-9][^_]*)')
     KERNEL_RELEASE_RE = re.compile(r'(?P<release>[0-9]\.[0-9]+\.[0-9]+-[0-9]+-[a-z0-9-]+)')
 
-    def crawl(self, workspace, distro, crawler_distro, download_config=None, crawler_filter=EMPTY_FILTER):
-        crawled_dict = super().crawl(workspace=workspace, distro=distro, crawler_distro=crawler_distro, download_config=download_config, crawler_filter=crawler_filter)
+    def batch_crawled(self, crawled_dict):
         kernels = []
         logger.debug("crawled_dict={}".format(crawled_dict))
         # batch packages according to package version, e.g. '5.15.0-1001/1' as returned by the crawler
@@ -29,7 +27,7 @@ class UbuntuBuilder(DistroBuilder):
             kernels.extend(self.batch_packages(flattened_packages, version))
         return kernels
 
-    def unpack_kernels(self, workspace, distro, kernels):
+    def unpack_kernels(self, workspace, distro, kernels, unpack=True):
         kernel_dirs = list()
 
         # notice how here kernels is a list of tuples
@@ -56,6 +54,9 @@ class UbuntuBuilder(DistroBuilder):
                                 version[0], version[1]
                             ))
 
+                    if not unpack:
+                        continue
+
                     if not os.path.exists(deb):
                         raise FileNotFoundError("{} is missing".format(deb))
 
@@ -67,6 +68,9 @@ class UbuntuBuilder(DistroBuilder):
                 target = workspace.subdir('build', distro, version[0], version[1])
                 # which we will address by release
                 # ( '5.4.0-1063-aws', '/path/to/5.4.0-1063/66' )
+                if not unpack:
+                    kernel_dirs.append((release, target))
+                    continue
 
                 for deb in debs:
                     deb_basename = os.path.basename(deb)
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import threading
+import time
+
+from .. import docker
+from .scheduler import wake_up
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint(object):
+    # A Docker daemon to run the builder containers on.
+    #
+    # `host` is a DOCKER_HOST-style URL (None for the default daemon),
+    # `slots` is the number of containers it runs at once and `shared`
+    # tells whether it sees the workspace at the same path as we do
+    # (otherwise the files are copied in and out of the containers)
+
+    def __init__(self, host=None, slots=1, shared=True):
+        self.host = host
+        self.slots = slots
+        self.shared = shared
+        self.busy = 0
+        self.healthy = True
+        self.checked = 0
+
+    @classmethod
+    def parse(cls, spec):
+        # HOST[,slots=N][,copy], where HOST may be `default`
+        parts = spec.split(',')
+        host = parts[0]
+        if host == 'default':
+            host = None
+        endpoint = cls(host)
+        for option in parts[1:]:
+            if option == 'copy':
+                endpoint.shared = False
+            elif option.startswith('slots='):
+                endpoint.slots = int(option[len('slots='):])
+                if endpoint.slots < 1:
+                    raise ValueError('Need at least one slot for {}'.format(spec))
+            else:
+                raise ValueError('Unknown option {} for {}'.format(option, spec))
+        return endpoint
+
+    def __str__(self):
+        return self.host or 'default'
+
+
+class NoHealthyEndpoint(Exception):
+    pass
+
+
+class EndpointPool(object):
+    # Hands out the endpoints to the builds, least loaded first,
+    # without exceeding the number of slots of any of them.
+    #
+    # An endpoint is health checked when it's first used and then again
+    # every HEALTH_CHECK_INTERVAL seconds. Unhealthy endpoints don't get
+    # any builds until they pass a health check again. When none of them
+    # is healthy, they all get checked again right away and if none passes,
+    # the build fails with NoHealthyEndpoint instead of waiting forever.
+    #
+    # The builds waiting for a slot park a future on their event loop,
+    # release() wakes them up (with call_soon_threadsafe, like BuildScheduler).
+
+    HEALTH_CHECK_INTERVAL = 60
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.lock = threading.Lock()
+        self.waiters = []
+        self.recheck = None
+
+    def total_slots(self):
+        return sum(endpoint.slots for endpoint in self.endpoints)
+
+    def _pick(self, now):
+        candidates = [e for e in self.endpoints
+                      if e.busy < e.slots and (e.healthy or now - e.checked >= self.HEALTH_CHECK_INTERVAL)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: float(e.busy) / e.slots)
+
+    def _check(self, endpoint):
+        healthy = docker.ping(endpoint.host)
+        with self.lock:
+            if healthy != endpoint.healthy:
+                if healthy:
+                    logger.info('Docker endpoint {} is healthy again'.format(endpoint))
+                else:
+                    logger.warn('Docker endpoint {} failed the health check'.format(endpoint))
+            endpoint.healthy = healthy
+            endpoint.checked = time.time()
+        return healthy
+
+    async def _check_async(self, endpoint):
+        # the ping is a blocking call
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._check, endpoint)
+
+    async def _check_all(self):
+        return any(await asyncio.gather(*[self._check_async(endpoint) for endpoint in self.endpoints]))
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                all_unhealthy = not any(endpoint.healthy for endpoint in self.endpoints)
+            if all_unhealthy:
+                # one round of checks for all the builds waiting
+                if self.recheck is None or self.recheck.done():
+                    self.recheck = asyncio.ensure_future(self._check_all())
+                if not await asyncio.shield(self.recheck):
+                    raise NoHealthyEndpoint('None of the Docker endpoints ({}) passed the health check'.format(
+                        ', '.join(str(endpoint) for endpoint in self.endpoints)))
+                continue
+
+            with self.lock:
+                endpoint = self._pick(time.time())
+                if endpoint is None:
+                    waiter = loop.create_future()
+                    self.waiters.append((loop, waiter))
+                else:
+                    endpoint.busy += 1
+                    check = time.time() - endpoint.checked >= self.HEALTH_CHECK_INTERVAL
+
+            if endpoint is None:
+                # wait for a free slot (or for an unhealthy endpoint to get another chance)
+                try:
+                    await asyncio.wait_for(waiter, self.HEALTH_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self.lock:
+                        if (loop, waiter) in self.waiters:
+                            self.waiters.remove((loop, waiter))
+                continue
+
+            if not check or await self._check_async(endpoint):
+                return endpoint
+            self.release(endpoint)
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.busy -= 1
+            waiters, self.waiters = self.waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(wake_up, waiter)
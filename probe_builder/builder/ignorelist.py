@@ -2,11 +2,18 @@ import jinja2
 import logging
 import re
 import sys
+import threading
+import time
 import yaml
 
 logger = logging.getLogger(__name__)
 
 class KernelIgnoreList:
+    # The ignorelist is compiled when loading it: only the entries for our probe version
+    # are kept, the skip_if templates are compiled once and the entries that apply
+    # to each probe kind are listed (in order) the first time the kind is asked about.
+    # The decisions are cached per (probe kind, kernel release).
+
     def __init__(self, yamldoc, probe_version):
         self.matchers = {}
         self.ignorelist = []
@@ -16,38 +23,99 @@ class KernelIgnoreList:
             self.ignorelist = config['ignorelist']
         self.probe_version = probe_version
 
-    def ignore_reason(self, probe_kind, kernel_release):
-        logger.debug("======== {} probe {} kernel {}".format(probe_kind, self.probe_version, kernel_release))
-        for b in self.ignorelist:
-            logger.debug("==== evaluating ignorelist entry '{}'".format(b['description']))
-            if self.probe_version in b['probe_versions']:
-                logger.debug("probe version {} matches one of agent versions {}".format(self.probe_version, b['probe_versions']))
-            else:
-                logger.debug("probe version {} NOT in {}".format(self.probe_version, b['probe_versions']))
-                continue
+        env = jinja2.Environment()
+        # (description, matcher name, probe kinds, compiled skip_if)
+        self.entries = [
+            (b['description'], b['matcher'], b['probe_kinds'], env.from_string(b['skip_if']))
+            for b in self.ignorelist if self.probe_version in b['probe_versions']
+        ]
+        logger.debug("{} of {} ignorelist entries apply to probe version {}".format(
+            len(self.entries), len(self.ignorelist), self.probe_version))
 
-            if not b['probe_kinds'] or probe_kind in b['probe_kinds']:
-                logger.debug("probe kind {} matches one of {}".format(probe_kind, b['probe_kinds']))
-            else:
-                logger.debug("probe kind {} does NOT match one of {}".format(probe_kind, b['probe_kinds']))
-                continue
+        self.lock = threading.Lock()
+        self.kind_entries = {}
+        self.reasons = {}
 
-            m = self.matchers[b['matcher']].search(kernel_release)
-            if m:
-                logger.debug("kernel {} matches matcher {}".format(kernel_release, b['matcher']))
-                logger.debug("unpack result: {}".format(m.groupdict()))
-                sif = b['skip_if']
-                t = jinja2.Template(sif)
-                r = t.render(m.groupdict())
-                if r and r != "False":
-                    logger.debug("== ignored by {}, jinja2 eval of {} returned {}({})".format(b['description'], sif, r, type(r)))
-                    return b['description']
-            else:
-                logger.debug("kernel {} does NOT belong to matcher {}".format(kernel_release, b['matcher']))
-
-        logger.debug("== kernel NOT ignored")
+    def entries_for(self, probe_kind):
+        with self.lock:
+            entries = self.kind_entries.get(probe_kind)
+            if entries is None:
+                entries = [(description, matcher, template) for description, matcher, kinds, template in self.entries
+                           if not kinds or probe_kind in kinds]
+                self.kind_entries[probe_kind] = entries
+            return entries
+
+    def evaluate(self, entries, kernel_release):
+        # run every matcher at most once per kernel
+        matches = {}
+        for description, matcher, template in entries:
+            if matcher not in matches:
+                m = self.matchers[matcher].search(kernel_release)
+                matches[matcher] = m.groupdict() if m else None
+            groups = matches[matcher]
+            if groups is None:
+                continue
+            r = template.render(groups)
+            if r and r != "False":
+                logger.debug("== {} ignored by {}, skip_if returned {}".format(kernel_release, description, r))
+                return description
         return None
 
+    def ignore_reason(self, probe_kind, kernel_release):
+        k = (probe_kind, kernel_release)
+        with self.lock:
+            if k in self.reasons:
+                return self.reasons[k]
+        reason = self.evaluate(self.entries_for(probe_kind), kernel_release)
+        with self.lock:
+            self.reasons[k] = reason
+        return reason
+
+    def ignore_reasons(self, probe_kind, kernel_releases):
+        # the reasons for a whole list of kernels at once, as a dict {kernel_release: reason or None}
+        entries = self.entries_for(probe_kind)
+        with self.lock:
+            reasons = {krel: self.reasons[(probe_kind, krel)] for krel in kernel_releases
+                       if (probe_kind, krel) in self.reasons}
+        todo = set(kernel_releases).difference(reasons)
+        computed = {krel: self.evaluate(entries, krel) for krel in todo}
+        with self.lock:
+            for krel, reason in computed.items():
+                self.reasons[(probe_kind, krel)] = reason
+        reasons.update(computed)
+        return reasons
+
+
+def benchmark(yamldoc, probe_version, count=50000):
+    # evaluate the ignorelist against `count` made up kernel releases
+    # (RHEL 8/9 and mainline-style), once from scratch and once cached
+    releases = []
+    n = 0
+    while len(releases) < count:
+        releases.append('4.18.0-{}.{}.1.el8_{}.x86_64'.format(n % 600, n // 600, n % 10))
+        releases.append('5.14.0-{}.{}.1.el9_{}.x86_64'.format(n % 500, n // 500, n % 5))
+        releases.append('{}.{}.{}-{}-generic'.format(5 + n % 2, n % 20, n % 200, n))
+        n += 1
+    releases = releases[:count]
+
+    results = {}
+    for kind in ('kmod', 'legacy_ebpf'):
+        kil = KernelIgnoreList(yamldoc, probe_version)
+        ts0 = time.time()
+        for krel in releases:
+            kil.ignore_reason(kind, krel)
+        single = time.time() - ts0
+        ts0 = time.time()
+        for krel in releases:
+            kil.ignore_reason(kind, krel)
+        cached = time.time() - ts0
+        kil = KernelIgnoreList(yamldoc, probe_version)
+        ts0 = time.time()
+        ignored = sum(1 for reason in kil.ignore_reasons(kind, releases).values() if reason)
+        batch = time.time() - ts0
+        results[kind] = (single, cached, batch, ignored)
+    return len(set(releases)), results
+
 
 ## =========== Test code =============
 _test_ignorelist = """\
@@ -84,3 +152,15 @@ if __name__ == "__main__":
     assert "kernel>=6.2" == kil.ignore_reason("kmod", "6.2.0")
     assert "kernel>=6.2" == kil.ignore_reason("kmod", "7.0.0")
     assert None == kil.ignore_reason("kmod", "6.1.99")
+    assert {"6.2.0": "kernel>=6.2", "6.1.99": None} == kil.ignore_reasons("kmod", ["6.2.0", "6.1.99"])
+    assert None == kil.ignore_reason("legacy_ebpf", "6.2.0")
+
+    # python -m probe_builder.builder.ignorelist agent_ignorelist.yaml 12.16.3
+    if len(sys.argv) > 2:
+        with open(sys.argv[1], mode="rb") as fp:
+            yamldoc = fp.read()
+        logger.setLevel(logging.INFO)
+        kernels, results = benchmark(yamldoc, sys.argv[2])
+        for kind, (single, cached, batch, ignored) in sorted(results.items()):
+            print("{}: {} kernels ({} ignored) in {:.3f}s, cached {:.3f}s, batch {:.3f}s".format(
+                kind, kernels, ignored, single, cached, batch))
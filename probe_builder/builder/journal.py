@@ -0,0 +1,123 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def encode_key(key):
+    # crawler keys and kernel releases are (drel, krel) tuples or plain strings
+    return json.dumps(key)
+
+
+def as_key(value):
+    # JSON turns the tuples into lists
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def decode_key(value):
+    return as_key(json.loads(value))
+
+
+class RunJournal(object):
+    # What a `build` run has done so far, stored in an SQLite database in the workspace,
+    # so that `build --resume` can pick up where an interrupted run stopped:
+    #  - the crawled packages (crawler key => package URLs or local files),
+    #  - the kernels unpacked from the packages of every crawler key,
+    #  - the report record of every kernel built (see report.BuildReport).
+    #
+    # The journal belongs to a single run, identified by its signature (the distro,
+    # filters, probe, ...), a new run (or a resumed run with a different signature)
+    # starts from scratch.
+
+    SCHEMA = [
+        '''
+        CREATE TABLE IF NOT EXISTS run (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            signature TEXT NOT NULL,
+            packages TEXT NOT NULL,
+            started REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS unpacked (
+            crawler_key TEXT PRIMARY KEY,
+            kernel_dirs TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS built (
+            kernel_release TEXT PRIMARY KEY,
+            record TEXT NOT NULL
+        )
+        ''',
+    ]
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = json.dumps(signature, sort_keys=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def packages(self):
+        # return the crawled packages of the journaled run, or None
+        # if there's nothing to resume (or it was a different run)
+        with self.lock:
+            row = self.db.execute('SELECT signature, packages, started FROM run').fetchone()
+        if row is None:
+            logger.info('No run to resume in {}'.format(self.path))
+            return None
+        signature, packages, started = row
+        if signature != self.signature:
+            logger.warn('The run in {} was started with different options, not resuming it'.format(self.path))
+            return None
+        logger.info('Resuming the run started at {}'.format(time.strftime('%Y-%m-%d %H:%M:%S',
+                                                                           time.localtime(started))))
+        return {as_key(key): pkgs for key, pkgs in json.loads(packages)}
+
+    def start(self, packages):
+        # forget the previous run
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM run')
+                self.db.execute('DELETE FROM unpacked')
+                self.db.execute('DELETE FROM built')
+                self.db.execute('INSERT INTO run (id, signature, packages, started) VALUES (1, ?, ?, ?)',
+                                (self.signature, json.dumps([(key, pkgs) for key, pkgs in packages.items()]),
+                                 time.time()))
+
+    def unpacked(self):
+        # crawler key => [(release, target), ...]
+        with self.lock:
+            rows = self.db.execute('SELECT crawler_key, kernel_dirs FROM unpacked').fetchall()
+        return {decode_key(key): [(as_key(release), target) for release, target in json.loads(kernel_dirs)]
+                for key, kernel_dirs in rows}
+
+    def record_unpacked(self, crawler_key, kernel_dirs):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO unpacked (crawler_key, kernel_dirs) VALUES (?, ?)',
+                                (encode_key(crawler_key), json.dumps(kernel_dirs)))
+
+    def built(self):
+        # kernel release => report record
+        with self.lock:
+            rows = self.db.execute('SELECT kernel_release, record FROM built').fetchall()
+        return {decode_key(release): json.loads(record) for release, record in rows}
+
+    def record_built(self, release, record):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO built (kernel_release, record) VALUES (?, ?)',
+                                (encode_key(release), json.dumps(record)))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,127 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BuildLedger(object):
+    # A persistent record of probe build results, stored in an SQLite database
+    # in the workspace. Every (probe, kernel release, config hash, probe kind)
+    # maps to the last result, along with the builder image that produced it.
+    #
+    # A failed build is considered known (and not retried) as long as it would
+    # be built with the same builder image, unless retry_failed is set.
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS results (
+            probe_name TEXT NOT NULL,
+            probe_version TEXT NOT NULL,
+            machine TEXT NOT NULL,
+            kernel_release TEXT NOT NULL,
+            config_hash TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            builder_image TEXT,
+            image_digest TEXT,
+            result TEXT NOT NULL,
+            duration REAL,
+            log_digest TEXT,
+            timestamp REAL NOT NULL,
+            log_path TEXT,
+            PRIMARY KEY (probe_name, probe_version, machine, kernel_release, config_hash, kind)
+        )
+    '''
+
+    def __init__(self, path, retry_failed=False):
+        self.path = path
+        self.retry_failed = retry_failed
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(self.SCHEMA)
+
+    def known_failure(self, probe, machine, kernel_release, config_hash, kind, image_digest):
+        if self.retry_failed:
+            return False
+        with self.lock:
+            row = self.db.execute(
+                'SELECT result, image_digest FROM results WHERE probe_name=? AND probe_version=? AND machine=? '
+                'AND kernel_release=? AND config_hash=? AND kind=?',
+                (probe.probe_name, probe.probe_version, machine, kernel_release, config_hash, kind)).fetchone()
+        if row is None:
+            return False
+        result, failed_digest = row
+        if result != 'FAILED':
+            return False
+        if image_digest is not None and failed_digest != image_digest:
+            logger.info('Builder image changed since {} probe {}-{} failed, retrying'.format(
+                kind, kernel_release, config_hash))
+            return False
+        return True
+
+    def record(self, probe, machine, kernel_release, config_hash, kind, builder_image, image_digest, result,
+               duration=None, log=None, log_path=None):
+        # log is the tail of the build output, log_path the file with all of it (relative to the workspace)
+        log_digest = None
+        if log:
+            log_digest = hashlib.sha256(log).hexdigest()
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO results (probe_name, probe_version, machine, kernel_release, config_hash, '
+                    'kind, builder_image, image_digest, result, duration, log_digest, timestamp, log_path) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (probe.probe_name, probe.probe_version, machine, kernel_release, config_hash, kind,
+                     builder_image, image_digest, result, duration, log_digest, time.time(), log_path))
+
+    def record_existing(self, probe, machine, kernel_release, config_hash, kind):
+        # we don't know who built an existing probe, so don't overwrite
+        # anything but failures (e.g. fixed by hand in the meantime)
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO results (probe_name, probe_version, machine, kernel_release, config_hash, '
+                    'kind, result, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (probe.probe_name, probe.probe_version, machine, kernel_release, config_hash, kind, 'EXISTING',
+                     time.time()))
+                self.db.execute(
+                    "UPDATE results SET result='EXISTING', builder_image=NULL, image_digest=NULL, duration=NULL, "
+                    "log_digest=NULL, log_path=NULL, timestamp=? WHERE probe_name=? AND probe_version=? AND machine=? AND kernel_release=? "
+                    "AND config_hash=? AND kind=? AND result='FAILED'",
+                    (time.time(), probe.probe_name, probe.probe_version, machine, kernel_release, config_hash, kind))
+
+    def results(self, probe_name=None, probe_version=None, machine=None, result=None):
+        query = 'SELECT probe_name, probe_version, machine, kernel_release, config_hash, kind, builder_image, ' \
+                'result, duration, timestamp FROM results'
+        conditions = []
+        params = []
+        for column, value in (('probe_name', probe_name), ('probe_version', probe_version),
+                              ('machine', machine), ('result', result)):
+            if value:
+                conditions.append('{}=?'.format(column))
+                params.append(value)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY probe_name, probe_version, machine, kernel_release, kind'
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def log_paths(self, kernel_release, probe_name=None, probe_version=None, kind=None):
+        # return (probe_name, probe_version, machine, config_hash, kind, result, log_path)
+        # for all the builds of a kernel we have a log of
+        query = 'SELECT probe_name, probe_version, machine, config_hash, kind, result, log_path FROM results ' \
+                'WHERE kernel_release=? AND log_path IS NOT NULL'
+        params = [kernel_release]
+        for column, value in (('probe_name', probe_name), ('probe_version', probe_version), ('kind', kind)):
+            if value:
+                query += ' AND {}=?'.format(column)
+                params.append(value)
+        query += ' ORDER BY probe_name, probe_version, machine, kind'
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,139 @@
+import errno
+import json
+import logging
+import os
+
+from .artifacts import file_digest
+
+logger = logging.getLogger(__name__)
+
+# next to the probes, e.g. sysdigcloud-probe-12.0.3.manifest
+MANIFEST_FILE = '{}-{}.manifest'
+
+# the inode, ctime and size of every file in the manifest when it was hashed,
+# to tell the files that were replaced since (which, with the probes hard linked
+# from the artifact store, may keep both their size and an old mtime).
+# It's kept out of the output directory (which gets published), in the workspace
+STAT_CACHE_FILE = '.{}-{}.manifest.stat'
+
+# one tab-separated line per probe, sorted, so that sysdig-probe-loader
+# can look up its kernel with awk instead of guessing URLs
+MANIFEST_FIELDS = ('arch', 'kernel_release', 'config_hash', 'kind', 'file', 'size', 'sha256')
+
+
+def manifest_path(output_dir, probe_name, probe_version):
+    return os.path.join(output_dir, MANIFEST_FILE.format(probe_name, probe_version))
+
+
+def parse_probe_file_name(probe_name, probe_version, file_name):
+    # the reverse of builder_image.probe_output_file (and of the .ko.xz companions):
+    # return (arch, kernel release, config hash, kind) or None for other files
+    for kind, prefix, ext in (('kmod', '{}-{}-'.format(probe_name, probe_version), '.ko'),
+                              ('kmod-xz', '{}-{}-'.format(probe_name, probe_version), '.ko.xz'),
+                              ('ebpf', '{}-bpf-{}-'.format(probe_name, probe_version), '.o')):
+        if not file_name.startswith(prefix) or not file_name.endswith(ext):
+            continue
+        rest = file_name[len(prefix):-len(ext)]
+        if rest.count('-') < 2:
+            continue
+        arch, rest = rest.split('-', 1)
+        kernel_release, config_hash = rest.rsplit('-', 1)
+        if kernel_release and config_hash:
+            return arch, kernel_release, config_hash, kind
+    return None
+
+
+def read_manifest(path):
+    # file name => manifest entry (a dict with MANIFEST_FIELDS)
+    entries = {}
+    try:
+        with open(path) as fp:
+            for line in fp:
+                if line.startswith('#'):
+                    continue
+                values = line.rstrip('\n').split('\t')
+                if len(values) != len(MANIFEST_FIELDS):
+                    continue
+                entry = dict(zip(MANIFEST_FIELDS, values))
+                entries[entry['file']] = entry
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    return entries
+
+
+def read_stat_cache(path):
+    # file name => [inode, ctime_ns, size]
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        logger.warn('Ignoring corrupted manifest stat cache {}'.format(path))
+    return {}
+
+
+def write_file(path, write):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        write(fp)
+    os.rename(tmp_path, path)
+
+
+def write_manifest(output_dir, probe_name, probe_version, cache_dir=None):
+    # list the probes of this version in the output directory. With a cache_dir for the stat cache,
+    # the digests of the probes already in the previous manifest are taken from there, unless
+    # the file got replaced (a different inode) or changed in place (a different ctime) since,
+    # the hard links to the same content are only hashed once
+    path = manifest_path(output_dir, probe_name, probe_version)
+    # from before the stat cache moved out of the output directory
+    try:
+        os.unlink(os.path.join(output_dir, STAT_CACHE_FILE.format(probe_name, probe_version)))
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+    stat_path = None
+    previous = {}
+    stat_cache = {}
+    if cache_dir is not None:
+        stat_path = os.path.join(cache_dir, STAT_CACHE_FILE.format(probe_name, probe_version))
+        previous = read_manifest(path)
+        stat_cache = read_stat_cache(stat_path)
+
+    entries = []
+    stats = {}
+    digests = {}
+    hashed = 0
+    for entry in os.scandir(output_dir):
+        parsed = parse_probe_file_name(probe_name, probe_version, entry.name)
+        if parsed is None or not entry.is_file():
+            continue
+        st = entry.stat()
+        stats[entry.name] = [st.st_ino, st.st_ctime_ns, st.st_size]
+        old = previous.get(entry.name)
+        if old is not None and stat_cache.get(entry.name) == stats[entry.name]:
+            sha256 = old['sha256']
+        else:
+            k = (st.st_dev, st.st_ino)
+            sha256 = digests.get(k)
+            if sha256 is None:
+                sha256 = file_digest(entry.path)
+                digests[k] = sha256
+                hashed += 1
+        entries.append(parsed + (entry.name, str(st.st_size), sha256))
+
+    entries.sort()
+
+    def write_entries(fp):
+        fp.write('# ' + '\t'.join(MANIFEST_FIELDS) + '\n')
+        for entry in entries:
+            fp.write('\t'.join(entry) + '\n')
+
+    # the manifest goes first: a stat cache newer than the manifest could vouch for stale digests
+    write_file(path, write_entries)
+    if stat_path is not None:
+        write_file(stat_path, lambda fp: json.dump(stats, fp))
+    logger.info('Listed {} probes in {} ({} hashed)'.format(len(entries), path, hashed))
+    return path
@@ -0,0 +1,138 @@
+import json
+import logging
+import threading
+import time
+import traceback
+from xml.sax.saxutils import quoteattr, escape
+
+logger = logging.getLogger(__name__)
+
+RESULT_FIELDS = ('distro_release', 'kernel_release', 'kmod', 'ebpf')
+FAILED_RESULTS = ('FAILED', 'KNOWN_FAIL', 'EXCEPTION')
+
+
+class BuildReport(object):
+    # The results of a build run, written to an NDJSON file (one JSON object
+    # per kernel) as soon as every kernel is done, so that they survive
+    # the process getting killed, and read back for the summary, the results file
+    # and the JUnit report without keeping the whole run in memory.
+    #
+    # Every record has the RESULT_FIELDS (like the kernels in a results file) and also
+    # the builder image, the time spent in every phase and, per probe kind,
+    # the build time and log file (relative to the workspace).
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = open(path, 'w')
+
+    def add(self, release, future):
+        # future is a (done) future or task returning a KernelBuildResult
+        record = result_record(release, future)
+        self.write(record)
+        return record
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.fp.write(line)
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+    def records(self):
+        return read_records(self.path)
+
+    def results(self):
+        return (record_result(record) for record in self.records())
+
+
+def result_record(release, future):
+    drel, krel = release if type(release) is tuple else ("", release)
+    record = {
+        'distro_release': drel,
+        'kernel_release': krel,
+        'finished': time.time(),
+    }
+    try:
+        res = future.result()
+    except:
+        traceback.print_exc()
+        record.update(kmod='EXCEPTION', ebpf='EXCEPTION', error=traceback.format_exc())
+        return record
+
+    record['builder_image'] = res.builder_image
+    record['phases'] = {phase: round(took, 3) for phase, took in res.phases.items()}
+    for kind, probe_result in (('kmod', res.kmod_result), ('ebpf', res.ebpf_result)):
+        record[kind] = probe_result.build_result_string()
+        record[kind + '_build_time'] = round(probe_result.build_time, 3)
+        record[kind + '_log_path'] = probe_result.log_path
+    return record
+
+
+def record_result(record):
+    # the (drel, krel, kmod result, ebpf result) tuple for print_summary
+    return tuple(record[field] for field in RESULT_FIELDS)
+
+
+def read_records(path):
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # the last line of a killed run may be cut short
+                logger.warn('Skipping truncated record in {}'.format(path))
+
+
+def junit_testcases(record):
+    # one test case per probe kind: (name, classname, result, log path, build time)
+    for kind in ('kmod', 'ebpf'):
+        yield (
+            '{} {}'.format(record['kernel_release'], kind),
+            record['distro_release'] or 'kernels',
+            record[kind],
+            record.get(kind + '_log_path'),
+            record.get(kind + '_build_time', 0),
+        )
+
+
+def write_junit(records, path, suite_name='probe_builder'):
+    # records is a callable returning an iterable of report records,
+    # called twice: once for the totals (in the testsuite element) and once for the test cases
+    tests = failures = skipped = 0
+    total_time = 0.0
+    for record in records():
+        for _, _, result, _, build_time in junit_testcases(record):
+            tests += 1
+            total_time += build_time or 0
+            if result in FAILED_RESULTS:
+                failures += 1
+            elif result == 'SKIPPED':
+                skipped += 1
+
+    with open(path, 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fp.write('<testsuite name={} tests="{}" failures="{}" errors="0" skipped="{}" time="{:.3f}">\n'.format(
+            quoteattr(suite_name), tests, failures, skipped, total_time))
+        for record in records():
+            for name, classname, result, log_path, build_time in junit_testcases(record):
+                fp.write('  <testcase name={} classname={} time="{:.3f}">\n'.format(
+                    quoteattr(name), quoteattr(classname), build_time or 0))
+                if result in FAILED_RESULTS:
+                    message = result
+                    if log_path:
+                        message = '{}, see {}'.format(result, log_path)
+                    fp.write('    <failure message={} type={}>{}</failure>\n'.format(
+                        quoteattr(message), quoteattr(result), escape(record.get('error') or '')))
+                elif result == 'SKIPPED':
+                    fp.write('    <skipped message={}/>\n'.format(quoteattr(result)))
+                if log_path:
+                    fp.write('    <system-out>{}</system-out>\n'.format(escape(log_path)))
+                fp.write('  </testcase>\n')
+        fp.write('</testsuite>\n')
@@ -0,0 +1,193 @@
+import asyncio
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BuildHistory(object):
+    # durations of previous kernel builds per builder image, persisted in the workspace
+    # (every SAVE_INTERVAL seconds during the run, so that an interrupted run keeps most of them)
+    # { "5.4.0-1063-aws": { "ubuntu-gcc9.3-bpf": 123.4 }, ... }
+
+    SAVE_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.mean_duration = None
+        self.saved = time.time()
+        try:
+            with open(path) as fp:
+                durations = json.load(fp)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logger.warn('Ignoring corrupted build history {}'.format(path))
+        else:
+            for release, entry in durations.items():
+                if 'duration' in entry:
+                    # the old format, with the last builder only
+                    entry = {entry['builder']: entry['duration']}
+                self.durations[release] = entry
+
+    def record(self, release, builder, duration):
+        with self.lock:
+            self.durations.setdefault(release, {})[builder] = round(duration, 3)
+            self.mean_duration = None
+            save = time.time() - self.saved >= self.SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def estimate(self, release, builder=None):
+        # kernels we have never built with this builder are assumed to take an average amount of time
+        with self.lock:
+            entry = self.durations.get(release, {})
+            if builder in entry:
+                return entry[builder]
+            if self.mean_duration is None:
+                durations = [duration for entry in self.durations.values() for duration in entry.values()]
+                if not durations:
+                    return 0
+                self.mean_duration = sum(durations) / len(durations)
+            return self.mean_duration
+
+    def save(self):
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(self.durations, fp, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+            self.saved = time.time()
+
+
+def wake_up(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class CpuBudget(object):
+    # the CPUs of one Docker daemon, split between its `slots` containers
+    def __init__(self, slots, total_cpus):
+        self.slots = slots
+        self.total_cpus = total_cpus
+        self.free_cpus = total_cpus
+        self.waiters = []
+
+
+class BuildScheduler(object):
+    # Orders the kernel builds longest-first (based on the build history)
+    # and splits a CPU budget between the running builder containers.
+    #
+    # Every container gets an equal share of the budget, assuming all
+    # `slots` containers run in parallel. When fewer kernels than slots
+    # are left (i.e. at the tail of the run), the remaining containers
+    # get larger shares instead of leaving the CPUs idle.
+    # The shares never add up to more than the budget: with no CPUs free
+    # (e.g. more slots than CPUs), a build waits for one to be released.
+    #
+    # With more than one Docker daemon (endpoints.Endpoint), each of them has
+    # its own budget of `total_cpus` CPUs, split between its own slots.
+    #
+    # The builds may run on more than one event loop (the work queue workers
+    # run one per thread), so the waiting builds park a future on their own loop
+    # and release_cpus wakes them up with call_soon_threadsafe.
+
+    def __init__(self, history, slots, total_cpus, endpoints=None):
+        self.history = history
+        self.lock = threading.Lock()
+        if endpoints:
+            self.budgets = {endpoint: CpuBudget(endpoint.slots, total_cpus) for endpoint in endpoints}
+        else:
+            self.budgets = {None: CpuBudget(slots, total_cpus)}
+        self.remaining = 0
+        self.submitting = True
+
+    def budget(self, endpoint=None):
+        budget = self.budgets.get(endpoint)
+        if budget is None:
+            budget = self.budgets[None]
+        return budget
+
+    def order(self, kernel_dirs, builders=None):
+        # kernel_dirs is a list of (release, target, ...) tuples
+        # where release is either krel or (drel, krel),
+        # builders is a dict {krel: builder image tag}, if known
+        builders = builders or {}
+
+        def estimate(kernel_dir):
+            release = kernel_dir[0]
+            _, krel = release if type(release) is tuple else ("", release)
+            return self.history.estimate(krel, builders.get(krel))
+
+        return sorted(kernel_dirs, key=estimate, reverse=True)
+
+    def create_task(self, coro):
+        # run the build as a task on the event loop and
+        # count it as remaining from the moment it's queued
+        with self.lock:
+            self.remaining += 1
+        return asyncio.ensure_future(self._run_task(coro))
+
+    async def _run_task(self, coro):
+        try:
+            return await coro
+        finally:
+            with self.lock:
+                self.remaining -= 1
+
+    def all_submitted(self):
+        # until we know how many jobs there are, assume all slots will be busy
+        with self.lock:
+            self.submitting = False
+
+    def _allocate(self, budget):
+        # with self.lock held, return None if there are no CPUs free
+        if budget.free_cpus < 1:
+            return None
+        if self.submitting:
+            concurrent = budget.slots
+        else:
+            concurrent = max(1, min(budget.slots, self.remaining))
+        share = max(1, budget.total_cpus // concurrent)
+        # never hand out more than what's free
+        cpus = min(share, budget.free_cpus)
+        budget.free_cpus -= cpus
+        logger.debug('Allocated {} CPUs ({} jobs remaining, {} CPUs free)'.format(
+            cpus, self.remaining, budget.free_cpus))
+        return cpus
+
+    async def acquire_cpus_async(self, endpoint=None):
+        budget = self.budget(endpoint)
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                cpus = self._allocate(budget)
+                if cpus is not None:
+                    return cpus
+                waiter = loop.create_future()
+                budget.waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self.lock:
+                    if (loop, waiter) in budget.waiters:
+                        budget.waiters.remove((loop, waiter))
+
+    def release_cpus(self, cpus, endpoint=None):
+        budget = self.budget(endpoint)
+        with self.lock:
+            budget.free_cpus += cpus
+            waiters, budget.waiters = budget.waiters, []
+        # every waiting build tries again, the ones that don't get any CPUs wait again
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(wake_up, waiter)
+
+    def record(self, release, builder, duration):
+        self.history.record(release, builder, duration)
@@ -1,7 +1,8 @@
 import errno
 import logging
+import time
 
-from .. import docker, spawn
+from .. import docker, metrics, spawn, trace
 import os
 
 logger = logging.getLogger(__name__)
@@ -24,11 +25,13 @@ def build_toolkit(workspace):
     HAVE_TOOLKIT = True
 
 
+@trace.traced('unpack', 'coreos_file', 'target_dir')
 def unpack_coreos(workspace, coreos_file, target_dir, marker):
     if marker is not None and os.path.exists(marker):
         logger.info('{} already exists, not unpacking {}'.format(marker, coreos_file))
         return
 
+    ts0 = time.time()
     coreos_file = os.path.abspath(coreos_file)
     target_dir = os.path.abspath(target_dir)
 
@@ -51,16 +54,19 @@ def unpack_coreos(workspace, coreos_file, target_dir, marker):
                 raise
         spawn.pipe(["/builder/toolkit-entrypoint.sh", "coreos", coreos_file, target_dir])
 
+    metrics.unpack_seconds.observe(time.time() - ts0, package_type='coreos')
     if marker is not None:
         with open(marker, 'w') as marker_fp:
             marker_fp.write('\n')
 
 
+@trace.traced('unpack', 'rpm_file', 'target_dir')
 def unpack_rpm(workspace, rpm_file, target_dir, marker):
     if marker is not None and os.path.exists(marker):
         logger.info('{} already exists, not unpacking {}'.format(marker, rpm_file))
         return
 
+    ts0 = time.time()
     rpm_file = os.path.abspath(rpm_file)
     target_dir = os.path.abspath(target_dir)
 
@@ -82,16 +88,19 @@ def unpack_rpm(workspace, rpm_file, target_dir, marker):
                 raise
         spawn.pipe(["/builder/toolkit-entrypoint.sh", "rpm", rpm_file, target_dir])
 
+    metrics.unpack_seconds.observe(time.time() - ts0, package_type='rpm')
     if marker is not None:
         with open(marker, 'w') as marker_fp:
             marker_fp.write('\n')
 
 
+@trace.traced('unpack', 'deb_file', 'target_dir')
 def unpack_deb(workspace, deb_file, target_dir, marker):
     if marker is not None and os.path.exists(marker):
         logger.info('{} already exists, not unpacking {}'.format(marker, deb_file))
         return
 
+    ts0 = time.time()
     deb_file = os.path.abspath(deb_file)
     target_dir = os.path.abspath(target_dir)
 
@@ -110,6 +119,7 @@ def unpack_deb(workspace, deb_file, target_dir, marker):
     ]
     docker.run('ubuntu:latest', volumes, ['dpkg', '-x', deb_file, target_dir], [])
 
+    metrics.unpack_seconds.observe(time.time() - ts0, package_type='deb')
     if marker is not None:
         with open(marker, 'w') as marker_fp:
             marker_fp.write('\n')
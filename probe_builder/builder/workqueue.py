@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def encode_key(key):
+    return json.dumps(key)
+
+
+def decode_key(key):
+    # crawler keys are (drel, release) tuples (or plain releases), JSON only has lists
+    key = json.loads(key)
+    if type(key) is list:
+        return tuple(key)
+    return key
+
+
+class WorkQueue(object):
+    # A durable queue of build jobs, stored in an SQLite database
+    # (on a filesystem shared between the coordinator and the workers).
+    #
+    # Every job is one crawler key (e.g. (drel, release)) with its package URLs.
+    # Workers lease jobs for `lease_time` seconds and need to renew the lease
+    # (heartbeat) while building. Jobs whose lease expired are handed out again,
+    # up to `max_attempts` times, after which they are given up on.
+    #
+    # The settings shared by all workers (probe, distro, ignore list etc.)
+    # are stored in the queue too. They identify the run: publishing with
+    # different settings starts a new run, dropping the jobs of the previous one.
+
+    SCHEMA = [
+        '''
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            packages TEXT NOT NULL,
+            state TEXT NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            results TEXT,
+            updated REAL NOT NULL
+        )
+        ''',
+    ]
+
+    QUEUED = 'queued'
+    LEASED = 'leased'
+    DONE = 'done'
+
+    def __init__(self, path, lease_time=300, max_attempts=3):
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # we do our own transactions, so that leasing a job is atomic across processes
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def _transaction(self, fn, *args):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(*args)
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def set_settings(self, settings):
+        # return True if this starts a new run
+        def _set():
+            rows = self.db.execute('SELECT name, value FROM settings').fetchall()
+            previous = {name: json.loads(value) for name, value in rows}
+            new_run = previous != settings
+            if new_run:
+                cursor = self.db.execute('DELETE FROM jobs')
+                if cursor.rowcount:
+                    logger.warn('Dropped the {} jobs of a run with different settings'.format(cursor.rowcount))
+                self.db.execute('DELETE FROM settings')
+            for name, value in settings.items():
+                self.db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (name, json.dumps(value)))
+            return new_run
+        return self._transaction(_set)
+
+    def settings(self):
+        with self.lock:
+            rows = self.db.execute('SELECT name, value FROM settings').fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def publish(self, kernels):
+        # kernels is a dict {key=>[urls...]}
+        # jobs that are already in the queue with the same packages are left alone,
+        # so that restarting the coordinator doesn't lose finished work,
+        # the ones whose packages changed start over
+        def _publish():
+            now = time.time()
+            added = 0
+            for key, packages in kernels.items():
+                cursor = self.db.execute(
+                    'INSERT INTO jobs (key, packages, state, updated) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET packages=excluded.packages, state=excluded.state, '
+                    'worker=NULL, lease_expires=NULL, attempts=0, results=NULL, updated=excluded.updated '
+                    'WHERE jobs.packages != excluded.packages',
+                    (encode_key(key), json.dumps(sorted(packages)), self.QUEUED, now))
+                added += cursor.rowcount
+            return added
+        added = self._transaction(_publish)
+        logger.info('Published {} new or changed jobs ({} kernels crawled)'.format(added, len(kernels)))
+        return added
+
+    def _expire_leases(self, now):
+        # give up on jobs that kept timing out, the rest goes back to the queue
+        self.db.execute(
+            'UPDATE jobs SET state=?, worker=NULL, lease_expires=NULL, updated=? '
+            'WHERE state=? AND lease_expires<? AND attempts>=?',
+            (self.DONE, now, self.LEASED, now, self.max_attempts))
+        cursor = self.db.execute(
+            'UPDATE jobs SET state=?, worker=NULL, lease_expires=NULL, updated=? WHERE state=? AND lease_expires<?',
+            (self.QUEUED, now, self.LEASED, now))
+        if cursor.rowcount:
+            logger.warn('Re-queued {} jobs with expired leases'.format(cursor.rowcount))
+
+    def lease(self, worker):
+        # return (job id, key, [packages...]) or None if there's nothing to do right now
+        def _lease():
+            now = time.time()
+            self._expire_leases(now)
+            row = self.db.execute('SELECT id, key, packages FROM jobs WHERE state=? ORDER BY id LIMIT 1',
+                                  (self.QUEUED,)).fetchone()
+            if row is None:
+                return None
+            job_id, key, packages = row
+            self.db.execute(
+                'UPDATE jobs SET state=?, worker=?, lease_expires=?, attempts=attempts+1, updated=? WHERE id=?',
+                (self.LEASED, worker, now + self.lease_time, now, job_id))
+            return job_id, decode_key(key), json.loads(packages)
+        return self._transaction(_lease)
+
+    def heartbeat(self, worker, job_ids):
+        # extend the leases we still hold, return the ids of the ones we lost
+        def _heartbeat():
+            now = time.time()
+            lost = []
+            for job_id in job_ids:
+                cursor = self.db.execute(
+                    'UPDATE jobs SET lease_expires=?, updated=? WHERE id=? AND worker=? AND state=?',
+                    (now + self.lease_time, now, job_id, worker, self.LEASED))
+                if not cursor.rowcount:
+                    lost.append(job_id)
+            return lost
+        return self._transaction(_heartbeat)
+
+    def complete(self, worker, job_id, results):
+        # results is a list of dicts, one per kernel built from the job
+        def _complete():
+            cursor = self.db.execute(
+                'UPDATE jobs SET state=?, worker=?, lease_expires=NULL, results=?, updated=? WHERE id=? AND state!=?',
+                (self.DONE, worker, json.dumps(results), time.time(), job_id, self.DONE))
+            return cursor.rowcount > 0
+        if not self._transaction(_complete):
+            logger.warn('Job {} was already completed by another worker'.format(job_id))
+
+    def counts(self):
+        def _counts():
+            self._expire_leases(time.time())
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return self._transaction(_counts)
+
+    def finished(self):
+        counts = self.counts()
+        return not counts.get(self.QUEUED) and not counts.get(self.LEASED)
+
+    def results(self):
+        # return a list of (key, results) for all the jobs, where results
+        # is None if the job was given up on
+        with self.lock:
+            rows = self.db.execute('SELECT key, results FROM jobs ORDER BY id').fetchall()
+        return [(decode_key(key), json.loads(results) if results else None) for key, results in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def default_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Heartbeat(object):
+    # renews the leases of the jobs a worker is busy with, in a background thread
+
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.job_ids = set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='heartbeat')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, job_id):
+        with self.lock:
+            self.job_ids.add(job_id)
+
+    def remove(self, job_id):
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def _run(self):
+        while not self.stopped.wait(self.queue.lease_time / 3.0):
+            with self.lock:
+                job_ids = list(self.job_ids)
+            if not job_ids:
+                continue
+            try:
+                lost = self.queue.heartbeat(self.worker, job_ids)
+            except sqlite3.Error as exc:
+                logger.warn('Failed to renew leases: {}'.format(exc))
+                continue
+            for job_id in lost:
+                logger.warn('Lost the lease on job {}'.format(job_id))
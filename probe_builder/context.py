@@ -8,7 +8,10 @@ class Context(object):
 
 class Workspace(
     namedtuple(
-        'Workspace', 'machine arch is_privileged mount_mapping workspace builder_source image_prefix')):
+        'Workspace',
+        'machine arch is_privileged mount_mapping workspace builder_source image_prefix ccache_size endpoint build_timeout '
+        'tmpfs_size',
+        defaults=[None, None, None, None])):
 
     def host_dir(self, container_dir):
         if self.mount_mapping is None:
@@ -1,7 +1,17 @@
-import json
+import asyncio
+import logging
 import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+from http.client import HTTPException
 
-from .spawn import pipe, json_pipe
+from . import docker_api
+from .py23 import make_string
+from .spawn import pipe, run_sync
+
+logger = logging.getLogger(__name__)
 
 
 class DockerVolume(object):
@@ -21,6 +31,21 @@ class DockerVolume(object):
             return '{}:{}'.format(self.host_path, self.container_path)
 
 
+class DockerTmpfs(object):
+    container_path = None
+    options = None
+
+    def __init__(self, container_path, options='exec'):
+        self.container_path = container_path
+        self.options = options
+
+    def __str__(self):
+        if self.options:
+            return '{}:{}'.format(self.container_path, self.options)
+        else:
+            return self.container_path
+
+
 class EnvVar(object):
     name = None
     value = None
@@ -33,45 +58,302 @@ class EnvVar(object):
         return '{}={}'.format(self.name, self.value)
 
 
-def run(image, volumes, command, env, privileged=False, name=None, arch=None):
-    cmd = ['docker', 'run', '--rm']
-    if privileged:
-        cmd.append('--privileged')
-    for volume in volumes:
-        cmd.append('-v')
-        cmd.append(str(volume))
-    for var in env:
-        cmd.append('-e')
-        cmd.append(str(var))
-    if name is not None:
-        cmd.append('--name')
-        cmd.append(str(name))
+def docker_cmd(host=None):
+    # host is a DOCKER_HOST-style URL, None means the default daemon
+    if host is None:
+        return ['docker']
+    return ['docker', '-H', host]
+
+
+def describe(image, command, host=None):
+    # what we'd run with the docker CLI, for the logs and error messages
+    return ' '.join(docker_cmd(host) + ['run', image] + [make_string(c) for c in command])
+
+
+# how much of the output of a container we keep in memory (the tail, for error messages),
+# the whole output only goes to the log sink
+MAX_OUTPUT = 64 * 1024
+
+
+class LogSink(object):
+    # Receives the output of a container as it runs and logs it
+    # line by line (at debug level), prefixed with e.g. the kernel release
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.partial = b''
+
+    def _log(self, line):
+        if self.prefix:
+            logger.debug('[{}] {}'.format(self.prefix, make_string(line)))
+        else:
+            logger.debug(make_string(line))
+
+    def write(self, chunk):
+        lines = (self.partial + chunk).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self._log(line)
+
+    def close(self):
+        if self.partial:
+            self._log(self.partial)
+            self.partial = b''
+
+    async def close_async(self):
+        # for sinks that need to wait for their output to be written
+        self.close()
+
+
+def run(image, volumes, command, env, privileged=False, name=None, arch=None, tmpfs=(), cpus=None, host=None,
+        copy_volumes=False, sink=None, timeout=None):
+    # for callers outside of an event loop
+    return run_sync(run_async(image, volumes, command, env, privileged, name, arch, tmpfs, cpus, host,
+                              copy_volumes, sink, timeout))
+
+
+async def run_async(image, volumes, command, env, privileged=False, name=None, arch=None, tmpfs=(), cpus=None,
+                    host=None, copy_volumes=False, sink=None, timeout=None):
+    # with copy_volumes, the daemon can't see our files: copy the read-only volumes
+    # into the container before starting it and the writable ones back
+    # afterwards (the volumes' host paths are local paths then)
+    #
+    # the output goes to `sink` as it arrives, only the last MAX_OUTPUT bytes
+    # are returned (or attached to the exception). If the container runs for longer
+    # than `timeout` seconds, it gets killed and subprocess.TimeoutExpired is raised
     if arch is not None:
         image = '{}-{}'.format(image, arch)
-    cmd.append(image)
-    cmd.extend(command)
+    cmd_string = describe(image, command, host)
+    logger.info('Running {}'.format(cmd_string))
+    # with a dedicated sink (e.g. a log file), don't repeat the output in our log on failure
+    log_failures = sink is None
+    if sink is None:
+        sink = LogSink()
+
+    client = docker_api.client(host)
+    output = bytearray()
+    timed_out = False
+    try:
+        container = await client.create_container(
+            image, command, [str(var) for var in env],
+            binds=() if copy_volumes else [str(volume) for volume in volumes],
+            tmpfs={mount.container_path: mount.options or '' for mount in tmpfs},
+            privileged=privileged, name=name, cpus=cpus)
+        try:
+            if copy_volumes:
+                for volume in volumes:
+                    await copy_to_container(client, container, volume)
+            await client.start_container(container)
+            try:
+                returncode = await asyncio.wait_for(wait_for_exit(client, container, sink, output), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+            if copy_volumes and not timed_out:
+                for volume in volumes:
+                    if not volume.readonly:
+                        await copy_from_container(client, container, volume)
+        finally:
+            # this kills the container if it's still running
+            await client.remove_container(container)
+    except (OSError, HTTPException, asyncio.IncompleteReadError, docker_api.APIError) as exc:
+        # report problems with the daemon like the docker CLI does
+        logger.warn('{} failed: {}'.format(cmd_string, exc))
+        raise subprocess.CalledProcessError(125, cmd_string, str(exc).encode('utf-8'))
+    finally:
+        await sink.close_async()
+
+    stdout = bytes(output)
+    if timed_out:
+        logger.warn('{} timed out after {} seconds'.format(cmd_string, timeout))
+        raise subprocess.TimeoutExpired(cmd_string, timeout, stdout)
+    if returncode != 0:
+        logger.warn('{} returned error code {}'.format(cmd_string, returncode))
+        if log_failures:
+            for line in stdout.splitlines(False):
+                logger.warn(make_string(line))
+        raise subprocess.CalledProcessError(returncode, cmd_string, stdout)
 
     # return stdout
-    return pipe(cmd)
+    return stdout
+
+
+async def wait_for_exit(client, container, sink, output):
+    # stream the output until the container exits and return its exit code
+    logs = client.container_logs(container)
+    try:
+        async for chunk in logs:
+            sink.write(chunk)
+            output.extend(chunk)
+            if len(output) > MAX_OUTPUT:
+                del output[:len(output) - MAX_OUTPUT]
+    finally:
+        await logs.aclose()
+    return await client.wait_container(container)
 
 
-def build(arch, image, dockerfile, context_dir):
-    pipe(['docker', 'buildx', 'build', '-t', '{}-{}'.format(str(image), arch), '-f', str(dockerfile), '--platform=linux/{}'.format(arch), str(context_dir)])
-    remove_dangling_images()
+def skip_git(info):
+    # the git metadata of a source checkout is never needed in the container
+    if os.path.basename(info.name) == '.git':
+        return None
+    return info
+
+
+def make_archive(fp, volume):
+    # a tarball with the full path in the container,
+    # so that all the parent directories get created
+    with tarfile.open(fileobj=fp, mode='w') as tar:
+        arcname = volume.container_path.lstrip('/')
+        if volume.readonly:
+            tar.add(volume.host_path, arcname=arcname, filter=skip_git)
+        else:
+            # writable volumes only get copied back, start with an empty directory
+            info = tarfile.TarInfo(arcname)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o777
+            tar.addfile(info)
+
+
+def is_within(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def unsafe_member(member, root):
+    # return why extracting the member into root would write (or link) outside of it,
+    # None if it's safe. The archive comes from the container, so don't trust it
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        return 'not a regular file, directory or link'
+    # this follows the links already extracted, too
+    path = os.path.realpath(os.path.join(root, member.name))
+    if not is_within(path, root):
+        return 'outside of {}'.format(root)
+    if member.issym():
+        target = os.path.realpath(os.path.join(os.path.dirname(path), member.linkname))
+    elif member.islnk():
+        target = os.path.realpath(os.path.join(root, member.linkname))
+    else:
+        return None
+    if not is_within(target, root):
+        return 'links to {}, outside of {}'.format(member.linkname, root)
+    return None
+
+
+def extract_archive(fp, volume):
+    # the archive contains the directory itself, e.g. output/foo.ko,
+    # and we want its contents in the host path
+    root = os.path.realpath(volume.host_path)
+    # the tarfile extraction filters are only there in the latest Python releases
+    extract_args = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    with tarfile.open(fileobj=fp, mode='r') as tar:
+        for member in tar:
+            parts = member.name.split('/', 1)
+            if len(parts) < 2 or not parts[1]:
+                continue
+            member.name = parts[1]
+            reason = None
+            if member.islnk():
+                # hard links point to another member, with the same prefix
+                link_parts = member.linkname.split('/', 1)
+                if len(link_parts) < 2 or link_parts[0] != parts[0]:
+                    reason = 'links to {}, outside of the archive'.format(member.linkname)
+                else:
+                    member.linkname = link_parts[1]
+            if reason is None:
+                reason = unsafe_member(member, root)
+            if reason is not None:
+                logger.warn('Not extracting {} from {}: {}'.format(member.name, volume.container_path, reason))
+                continue
+            try:
+                tar.extract(member, root, **extract_args)
+            except (tarfile.TarError, KeyError) as exc:
+                # KeyError: a hard link to a member we didn't extract
+                logger.warn('Not extracting {} from {}: {}'.format(member.name, volume.container_path, exc))
+
+
+async def copy_to_container(client, container, volume):
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryFile() as fp:
+        # tarring up the kernel headers takes a while, don't block the event loop
+        await loop.run_in_executor(None, make_archive, fp, volume)
+        await client.put_archive(container, '/', fp)
+
+
+async def copy_from_container(client, container, volume):
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryFile() as fp:
+        async for chunk in client.get_archive(container, volume.container_path):
+            fp.write(chunk)
+        fp.seek(0)
+        await loop.run_in_executor(None, extract_archive, fp, volume)
+
+
+def build(arch, image, dockerfile, context_dir, host=None, labels=None):
+    # buildx isn't part of the Engine API
+    # this leaves the old image dangling, see remove_dangling_images
+    label_args = []
+    for name, value in sorted((labels or {}).items()):
+        label_args += ['--label', '{}={}'.format(name, value)]
+    pipe(docker_cmd(host) + ['buildx', 'build', '-t', '{}-{}'.format(str(image), arch), '-f', str(dockerfile), '--platform=linux/{}'.format(arch)] + label_args + [str(context_dir)])
+
+
+def image_id(image, host=None):
+    try:
+        inspect = docker_api.client(host).inspect_image(image)
+    except (OSError, HTTPException, docker_api.APIError):
+        return None
+    if inspect is None:
+        return None
+    return inspect['Id']
+
+
+def image_labels(image, host=None):
+    # the labels of an image, None if we don't have it
+    try:
+        inspect = docker_api.client(host).inspect_image(image)
+    except (OSError, HTTPException, docker_api.APIError):
+        return None
+    if inspect is None:
+        return None
+    return inspect.get('Config', {}).get('Labels') or {}
+
+
+def ping(host=None):
+    try:
+        return docker_api.client(host).ping()
+    except (OSError, HTTPException, ValueError, docker_api.APIError):
+        return False
 
 
 def rm(container_name):
-    pipe(['docker', 'rm', container_name], silence_errors=True)
+    return run_sync(rm_async(container_name))
 
 
-def inspect_self():
+async def rm_async(container_name):
+    if not container_name:
+        return
     try:
-        hostname = os.uname()[1]
-        return json_pipe(['docker', 'inspect', hostname], silence_errors=True)
-    except Exception:
+        await docker_api.client().remove_container(container_name)
+    except (OSError, HTTPException, docker_api.APIError):
         pass
 
 
+# we only need to look at our own container once
+self_inspect = []
+self_inspect_lock = threading.Lock()
+
+
+def inspect_self():
+    with self_inspect_lock:
+        if not self_inspect:
+            try:
+                hostname = os.uname()[1]
+                inspect = docker_api.client().inspect_container(hostname)
+            except Exception:
+                inspect = None
+            # keep the format of `docker inspect`
+            self_inspect.append([inspect] if inspect is not None else None)
+        return self_inspect[0]
+
+
 def get_mount_mapping():
     inspect = inspect_self()
     if inspect is None:
@@ -87,13 +369,15 @@ def is_privileged():
     if inspect is None:
         return True
     try:
-        if inspect[0]['HostConfig']['Privileged'] == 'true':
-            return True
-    except:
+        return bool(inspect[0]['HostConfig']['Privileged'])
+    except (KeyError, IndexError, TypeError):
         return False
 
 
-def remove_dangling_images():
-    images = pipe(['docker', 'images', '-q', '-f', 'dangling=true'])
-    if images:
-        pipe(['docker', 'rmi'] + images.splitlines(False), silence_errors=True)
+def remove_dangling_images(host=None):
+    client = docker_api.client(host)
+    for image in client.dangling_images():
+        try:
+            client.remove_image(image)
+        except docker_api.APIError as exc:
+            logger.debug('Failed to remove {}: {}'.format(image, exc))
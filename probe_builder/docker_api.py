@@ -0,0 +1,367 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+
+from http.client import HTTPConnection, HTTPException
+from urllib.parse import quote, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = 'unix:///var/run/docker.sock'
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super(APIError, self).__init__('Docker API error {}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+def check_pull_status(line):
+    # a failed pull still answers 200, with the error in one of the progress lines
+    line = line.strip()
+    if not line:
+        return
+    try:
+        status = json.loads(line.decode('utf-8'))
+    except ValueError:
+        logger.warn('Unexpected pull status: {!r}'.format(line))
+        return
+    if isinstance(status, dict) and 'error' in status:
+        raise APIError(500, status['error'])
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    # A minimal client for the Docker Engine API.
+    #
+    # The quick calls (inspecting things, pings) are synchronous and keep a pool
+    # of idle (keep-alive) connections to the daemon. Running containers is done
+    # with coroutines (the *_async calls and the container methods), so that
+    # waiting for hundreds of builds doesn't take a thread each. These use
+    # a connection per request, as they mostly wait for a long-running stream.
+    #
+    # host is a DOCKER_HOST-style URL, unix:// or tcp:// (without TLS)
+
+    def __init__(self, host=None):
+        if host is None:
+            host = os.environ.get('DOCKER_HOST') or DEFAULT_HOST
+        self.host = host
+        url = urlparse(host)
+        if url.scheme == 'unix':
+            self.socket_path = url.path
+            self.address = None
+        elif url.scheme == 'tcp':
+            self.socket_path = None
+            self.address = (url.hostname, url.port or 2375)
+        else:
+            raise ValueError('Unsupported Docker host {}'.format(host))
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def _new_connection(self):
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path)
+        return HTTPConnection(*self.address)
+
+    def _connection(self):
+        # return a connection and whether it comes from the pool
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._new_connection(), False
+
+    def _release(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self.lock:
+            self.idle.append(conn)
+
+    def _request(self, method, path, query=None, body=None, headers=None):
+        # return (connection, response), the caller needs to read the whole
+        # response and pass both to _release (or close the connection)
+        if query:
+            path = '{}?{}'.format(path, urlencode(query))
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        conn, pooled = self._connection()
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except (OSError, HTTPException):
+            conn.close()
+            if not pooled:
+                raise
+            # the daemon may have closed the idle connection, retry with a new one
+            conn = self._new_connection()
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        return conn, response
+
+    def call(self, method, path, query=None, body=None, headers=None, expect=(200, 201, 204, 304)):
+        conn, response = self._request(method, path, query, body, headers)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, response)
+        if response.status not in expect:
+            raise APIError(response.status, self._error_message(data))
+        if data and response.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    @staticmethod
+    def _error_message(data):
+        try:
+            return json.loads(data.decode('utf-8'))['message']
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+            return data
+
+    def ping(self):
+        return self.call('GET', '/_ping') == b'OK'
+
+    async def _open(self):
+        if self.socket_path is not None:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(*self.address)
+
+    async def _request_async(self, method, path, query=None, body=None, headers=None):
+        # return (reader, writer, status, headers), the caller reads the body
+        # with _body_chunks and closes the writer
+        if query:
+            path = '{}?{}'.format(path, urlencode(query))
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if body is None:
+            body = b''
+        if isinstance(body, bytes):
+            headers['Content-Length'] = str(len(body))
+        headers['Host'] = 'docker'
+        headers['Connection'] = 'close'
+
+        reader, writer = await self._open()
+        try:
+            head = '{} {} HTTP/1.1\r\n'.format(method, path)
+            head += ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.items())
+            writer.write((head + '\r\n').encode('latin-1'))
+            if isinstance(body, bytes):
+                writer.write(body)
+            else:
+                # a file, the caller knows its Content-Length
+                while True:
+                    chunk = body.read(65536)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+            await writer.drain()
+
+            status_line = await reader.readline()
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise HTTPException('Bad status line {!r}'.format(status_line))
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer, status, response_headers
+
+    @staticmethod
+    async def _body_chunks(reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    break
+                yield await reader.readexactly(size)
+                await reader.readline()
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                chunk = await reader.read(min(remaining, 65536))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # read until the daemon closes the connection
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def call_async(self, method, path, query=None, body=None, headers=None, expect=(200, 201, 204, 304)):
+        reader, writer, status, response_headers = await self._request_async(method, path, query, body, headers)
+        try:
+            data = b''.join([chunk async for chunk in self._body_chunks(reader, response_headers)])
+        finally:
+            writer.close()
+        if status not in expect:
+            raise APIError(status, self._error_message(data))
+        if data and response_headers.get('content-type', '').startswith('application/json'):
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    async def stream_async(self, method, path, query=None, body=None, headers=None):
+        # yield chunks of the response body as they arrive
+        reader, writer, status, response_headers = await self._request_async(method, path, query, body, headers)
+        try:
+            if status not in (200, 201):
+                data = b''.join([chunk async for chunk in self._body_chunks(reader, response_headers)])
+                raise APIError(status, self._error_message(data))
+            async for chunk in self._body_chunks(reader, response_headers):
+                yield chunk
+        finally:
+            writer.close()
+
+    async def create_container(self, image, command, env, binds=(), tmpfs=None, privileged=False, name=None,
+                               cpus=None):
+        host_config = {
+            'Binds': list(binds),
+            'Tmpfs': tmpfs or {},
+            'Privileged': privileged,
+        }
+        if cpus is not None:
+            host_config['NanoCpus'] = int(float(cpus) * 1e9)
+        config = {
+            'Image': image,
+            'Cmd': list(command),
+            'Env': list(env),
+            'HostConfig': host_config,
+        }
+        query = {'name': name} if name else None
+        try:
+            return (await self.call_async('POST', '/containers/create', query, config))['Id']
+        except APIError as exc:
+            if exc.status != 404:
+                raise
+        # like `docker run`, pull the image if we don't have it
+        await self.pull_image(image)
+        return (await self.call_async('POST', '/containers/create', query, config))['Id']
+
+    async def pull_image(self, image):
+        repo, tag = image, 'latest'
+        if ':' in image.rsplit('/', 1)[-1]:
+            repo, tag = image.rsplit(':', 1)
+        logger.info('Pulling {}:{}'.format(repo, tag))
+        # the progress is a JSON object per line, which may be split across chunks
+        buf = b''
+        async for chunk in self.stream_async('POST', '/images/create', {'fromImage': repo, 'tag': tag}):
+            buf += chunk
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                check_pull_status(line)
+        check_pull_status(buf)
+
+    async def start_container(self, container):
+        await self.call_async('POST', '/containers/{}/start'.format(container))
+
+    async def container_logs(self, container):
+        # yield the (stdout and stderr) output of the container, as it runs
+        # the stream is multiplexed: an 8 byte header (stream type, 3 bytes padding,
+        # big endian length) precedes every frame
+        buf = b''
+        stream = self.stream_async('GET', '/containers/{}/logs'.format(container),
+                                   {'follow': 1, 'stdout': 1, 'stderr': 1})
+        try:
+            async for chunk in stream:
+                buf += chunk
+                while len(buf) >= 8:
+                    _, length = struct.unpack('>BxxxL', buf[:8])
+                    if len(buf) < 8 + length:
+                        break
+                    yield buf[8:8 + length]
+                    buf = buf[8 + length:]
+        finally:
+            # close the connection right away when we stop early
+            await stream.aclose()
+
+    async def wait_container(self, container):
+        return (await self.call_async('POST', '/containers/{}/wait'.format(container)))['StatusCode']
+
+    async def remove_container(self, container, force=True):
+        try:
+            await self.call_async('DELETE', '/containers/{}'.format(quote(container, safe='')),
+                                  {'force': 1 if force else 0})
+        except APIError as exc:
+            if exc.status != 404:
+                raise
+
+    async def put_archive(self, container, path, data):
+        # data is a (seekable) file with a tarball, extracted at `path` in the container
+        data.seek(0, os.SEEK_END)
+        length = data.tell()
+        data.seek(0)
+        await self.call_async('PUT', '/containers/{}/archive'.format(container), {'path': path}, data,
+                              {'Content-Type': 'application/x-tar', 'Content-Length': str(length)})
+
+    def get_archive(self, container, path):
+        return self.stream_async('GET', '/containers/{}/archive'.format(container), {'path': path})
+
+    def inspect_container(self, container):
+        try:
+            return self.call('GET', '/containers/{}/json'.format(quote(container, safe='')))
+        except APIError as exc:
+            if exc.status == 404:
+                return None
+            raise
+
+    def inspect_image(self, image):
+        try:
+            return self.call('GET', '/images/{}/json'.format(quote(image, safe='/:')))
+        except APIError as exc:
+            if exc.status == 404:
+                return None
+            raise
+
+    def dangling_images(self):
+        images = self.call('GET', '/images/json', {'filters': json.dumps({'dangling': ['true']})})
+        return [image['Id'] for image in images]
+
+    def remove_image(self, image):
+        self.call('DELETE', '/images/{}'.format(quote(image, safe='')))
+
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def client(host=None):
+    with clients_lock:
+        obj = clients.get(host)
+        if obj is None:
+            obj = DockerClient(host)
+            clients[host] = obj
+        return obj
@@ -12,6 +12,8 @@ from .ubuntu import UbuntuMirror
 
 from .flatcar import FlatcarMirror
 
+from .. import metrics, trace
+
 DISTROS = {
     'AliyunLinux': AliyunLinuxMirror,
     'AlmaLinux': AlmaLinuxMirror,
@@ -36,4 +38,9 @@ DISTROS = {
 
 def crawl_kernels(distro, crawler_filter):
     dist = DISTROS[distro]
-    return dist().get_package_tree(crawler_filter)
+    with trace.span('crawl_kernels', 'crawl', distro=distro):
+        kernels = dist().get_package_tree(crawler_filter)
+    if crawler_filter.shard is not None:
+        kernels = crawler_filter.shard.filter(kernels)
+    metrics.kernels_crawled.inc(len(kernels), distro=distro)
+    return kernels
@@ -7,7 +7,9 @@ import shutil
 from concurrent.futures import ThreadPoolExecutor
 import os
 import logging
+import time
 
+from probe_builder import metrics, trace
 from probe_builder.context import DownloadConfig
 import tenacity
 
@@ -44,12 +46,14 @@ def download_file(url, output_file, download_config=None):
                 if resp.status_code == 206:
                     # yay, resuming the download
                     shutil.copyfileobj(resp.raw, fp)
+                    metrics.downloaded_bytes.inc(fp.tell() - size)
                     return
                 elif resp.status_code == 416:
                     return  # "requested range not satisfiable", we have the whole thing
                 elif resp.status_code == 200:
                     fp.truncate(0)  # have to start over
                     shutil.copyfileobj(resp.raw, fp)
+                    metrics.downloaded_bytes.inc(fp.tell())
                     return
         resp.raise_for_status()
         raise requests.HTTPError('Unexpected status code {}'.format(resp.status_code))
@@ -60,7 +64,9 @@ def download_file(url, output_file, download_config=None):
         return
     # download to .part file
     temp_file = output_file + ".part"
+    ts0 = time.time()
     download_temp_file(url, temp_file, download_config)
+    metrics.download_seconds.observe(time.time() - ts0)
     # and then rename it to its final target
     shutil.move(temp_file, output_file)
 
@@ -75,18 +81,26 @@ def download_batch(urls, output_dir, download_config=None):
         urlmaps.setdefault(os.path.basename(url), []).append(url)
 
     # inner function to be used to download a single from multiple sources sequentially
+    @trace.traced('download', 'output_file')
     def download_multiple_sources(output_file, urls):
-        for url in urls:
-            try:
-                download_file(url, output_file, download_config)
-            except requests.exceptions.RequestException:
-                traceback.print_exc()
+        metrics.queue_depth.dec(stage='download')
+        metrics.in_progress.inc(stage='download')
+        try:
+            for url in urls:
+                try:
+                    download_file(url, output_file, download_config)
+                except requests.exceptions.RequestException:
+                    traceback.print_exc()
+        finally:
+            metrics.in_progress.dec(stage='download')
 
     # use a parallel executor to download all stuff
-    with ThreadPoolExecutor(max_workers=download_config.concurrency) as executor:
+    with trace.span('download_batch', 'download', files=len(urlmaps)), \
+            ThreadPoolExecutor(max_workers=download_config.concurrency) as executor:
         download_futures = []
         for basename, urls in urlmaps.items():
             output_file = os.path.join(output_dir, basename)
+            metrics.queue_depth.inc(stage='download')
             download_futures.append((basename, executor.submit(download_multiple_sources, output_file, urls)))
 
     for basename, future in download_futures:
@@ -3,10 +3,13 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from collections import namedtuple
 import click
+import hashlib
 import logging
 import os
 import sys
 
+from .. import trace
+
 logger = logging.getLogger(__name__)
 
 def machine2arch(mach):
@@ -16,7 +19,35 @@ def machine2arch(mach):
     }
     return mach2arch.get(mach, mach)
 
-CrawlerFilter = namedtuple("CrawlerFilter", ["machine", "arch", "distro_filter", "kernel_filter"], defaults=[os.uname().machine, machine2arch(os.uname().machine), "", ""])
+
+class Shard(namedtuple("Shard", ["index", "count"])):
+    # one of `count` disjoint parts of the kernel list (index is 1-based)
+    # kernels are assigned to shards by a hash of the crawler key,
+    # so the split is the same on every host and every run
+
+    @classmethod
+    def parse(cls, spec):
+        index, count = spec.split('/', 1)
+        shard = cls(int(index), int(count))
+        if not 1 <= shard.index <= shard.count:
+            raise ValueError('Shard index must be between 1 and {}'.format(shard.count))
+        return shard
+
+    def __str__(self):
+        return '{}/{}'.format(self.index, self.count)
+
+    def contains(self, key):
+        # key is e.g. (drel, release), or just the release
+        if type(key) is tuple:
+            key = '/'.join(key)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return int(digest, 16) % self.count == self.index - 1
+
+    def filter(self, kernels):
+        return {key: packages for key, packages in kernels.items() if self.contains(key)}
+
+
+CrawlerFilter = namedtuple("CrawlerFilter", ["machine", "arch", "distro_filter", "kernel_filter", "shard"], defaults=[os.uname().machine, machine2arch(os.uname().machine), "", "", None])
 
 EMPTY_FILTER=CrawlerFilter()
 
@@ -57,9 +88,14 @@ class Mirror(object):
     def get_package_tree(self, crawler_filter):
         packages = {}
         drel_repos = self.list_drel_repos(crawler_filter)
+
+        def repo_package_tree(drel, repo):
+            with trace.span('get_package_tree', 'crawl', drel=drel, repo=str(repo)):
+                return repo.get_package_tree(crawler_filter)
+
         with click.progressbar(length=len(drel_repos), label='Listing packages', file=sys.stderr, item_show_func=to_s) as pbar:
             with ThreadPoolExecutor(max_workers=8) as executor:
-                futures = { executor.submit(repo.get_package_tree, crawler_filter): (drel, str(repo)) for (drel, repos) in drel_repos.items() for repo in repos }
+                futures = { executor.submit(repo_package_tree, drel, repo): (drel, str(repo)) for (drel, repos) in drel_repos.items() for repo in repos }
                 for future in as_completed(futures):
                     drel, repo = futures[future]
                     for krel, dependencies in future.result().items():
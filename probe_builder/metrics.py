@@ -0,0 +1,239 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# how often (in seconds) the textfile gets rewritten during the run
+TEXTFILE_INTERVAL = 15
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                           .replace('\n', r'\n'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    # A metric family with a fixed set of label names,
+    # keeping a value (or a histogram) per combination of label values
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _samples(self, key, value):
+        yield self.name, format_labels(self.labelnames, key), value
+
+    def render(self, openmetrics=True):
+        # the Prometheus text format (for the textfile collector) wants the full
+        # name of the counter samples in the metadata, OpenMetrics wants the family name
+        name = self.name
+        if self.metric_type == 'counter' and not openmetrics:
+            name += '_total'
+        lines = [
+            '# HELP {} {}'.format(name, self.documentation),
+            '# TYPE {} {}'.format(name, self.metric_type),
+        ]
+        with self.lock:
+            items = sorted(self.values.items())
+            for key, value in items:
+                for sample, labels, sample_value in self._samples(key, value):
+                    lines.append('{}{} {}'.format(sample, labels, format_value(sample_value)))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        yield self.name + '_total', format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800)):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        for bound, count in zip(self.buckets, counts):
+            yield self.name + '_bucket', format_labels(self.labelnames, key, [('le', format_value(bound))]), count
+        yield self.name + '_count', format_labels(self.labelnames, key), counts[-1]
+        yield self.name + '_sum', format_labels(self.labelnames, key), total
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, openmetrics=True):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# buckets for the steps that take seconds rather than minutes
+QUICK_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+kernels_crawled = registry.register(Counter(
+    'probe_builder_kernels_crawled', 'Kernels found by the crawler', ['distro']))
+downloaded_bytes = registry.register(Counter(
+    'probe_builder_downloaded_bytes', 'Bytes of kernel packages downloaded'))
+download_seconds = registry.register(Histogram(
+    'probe_builder_download_seconds', 'Time to download a kernel package', buckets=QUICK_BUCKETS))
+unpack_seconds = registry.register(Histogram(
+    'probe_builder_unpack_seconds', 'Time to unpack a kernel package', ['package_type'], buckets=QUICK_BUCKETS))
+build_seconds = registry.register(Histogram(
+    'probe_builder_build_seconds', 'Time to build the probes of a kernel in a builder container',
+    ['builder_image', 'kind']))
+build_results = registry.register(Counter(
+    'probe_builder_build_results', 'Probe builds by their result', ['kind', 'result']))
+queue_depth = registry.register(Gauge(
+    'probe_builder_queue_depth', 'Work waiting to be picked up, per stage', ['stage']))
+in_progress = registry.register(Gauge(
+    'probe_builder_in_progress', 'Work running right now, per stage', ['stage']))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = registry.render(openmetrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: {}'.format(format % args))
+
+
+def start_http_server(port, address=''):
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on port {}'.format(server.server_address[1]))
+    return server
+
+
+def write_textfile(path):
+    # write to a temporary file and rename it, so that the collector
+    # never reads a partial file (node_exporter ignores files not ending in .prom)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        fp.write(registry.render(openmetrics=False))
+    os.rename(tmp_path, path)
+
+
+class TextfileWriter(object):
+    # Rewrites the textfile every TEXTFILE_INTERVAL seconds and once more when stopped
+
+    def __init__(self, path, interval=TEXTFILE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-textfile', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                write_textfile(self.path)
+            except (IOError, OSError) as exc:
+                logger.warn('Failed to write metrics to {}: {}'.format(self.path, exc))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        write_textfile(self.path)
+
+
+class Exporter(object):
+    # The HTTP endpoint and the textfile are both optional
+
+    def __init__(self, port=None, textfile=None):
+        self.server = None
+        self.writer = None
+        if port is not None:
+            self.server = start_http_server(port)
+        if textfile:
+            self.writer = TextfileWriter(textfile)
+            self.writer.start()
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.stop()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
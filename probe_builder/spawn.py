@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import subprocess
@@ -6,26 +7,69 @@ from probe_builder.py23 import make_bytes, make_string
 
 logger = logging.getLogger(__name__)
 
+# how much of the output of a command we keep in memory (the tail, for error messages),
+# the whole output only goes to the sink
+MAX_OUTPUT = 64 * 1024
 
-def pipe(cmd, silence_errors=False, cwd=None):
+
+def run_sync(coro):
+    # run a coroutine for a caller outside of an event loop. From a running loop,
+    # asyncio.run would fail anyway (and blocking would hold up the other tasks):
+    # fail clearly, pointing at the coroutine to await instead
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    coro.close()
+    raise RuntimeError('Called from a running event loop, await {}() instead'.format(coro.__qualname__))
+
+
+def pipe(cmd, silence_errors=False, cwd=None, sink=None, timeout=None):
+    return run_sync(pipe_async(cmd, silence_errors, cwd, sink, timeout))
+
+
+async def pipe_async(cmd, silence_errors=False, cwd=None, sink=None, timeout=None):
+    # run cmd, passing its output (one line at a time, as it arrives) to sink.write
+    # (by default, log it at debug level) and return the last MAX_OUTPUT bytes of it
+    # if it runs for longer than `timeout` seconds, kill it and raise subprocess.TimeoutExpired
     cmd = [make_bytes(c) for c in cmd]
     cmd_string = make_string(b' '.join(cmd))
     if cwd is not None:
         logger.info('Running {} in {}'.format(cmd_string, make_string(cwd)))
     else:
         logger.info('Running {}'.format(cmd_string))
-    child = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    (stdout, _) = child.communicate(None)
-    if not silence_errors and child.returncode != 0:
-        logger.warn('{} returned error code {}'.format(cmd_string, child.returncode))
+    child = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = bytearray()
+
+    async def read_output():
+        while True:
+            line = await child.stdout.readline()
+            if not line:
+                break
+            output.extend(line)
+            if len(output) > MAX_OUTPUT:
+                del output[:len(output) - MAX_OUTPUT]
+            if sink is not None:
+                sink.write(line)
+            else:
+                logger.debug(make_string(line.rstrip(b'\n')))
+        return await child.wait()
+
+    try:
+        returncode = await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        child.kill()
+        await child.wait()
+        logger.warn('{} timed out after {} seconds'.format(cmd_string, timeout))
+        raise subprocess.TimeoutExpired(cmd_string, timeout, bytes(output))
+
+    stdout = bytes(output)
+    if not silence_errors and returncode != 0:
+        logger.warn('{} returned error code {}'.format(cmd_string, returncode))
         for line in stdout.splitlines(False):
             logger.warn(make_string(line))
-        raise subprocess.CalledProcessError(child.returncode, cmd_string, stdout)
-    else:
-        lines = stdout.splitlines(False)
-        for line in lines:
-            logger.debug(make_string(line))
-        return stdout
+        raise subprocess.CalledProcessError(returncode, cmd_string, stdout)
+    return stdout
 
 
 def json_pipe(cmd, silence_errors=False, cwd=None):
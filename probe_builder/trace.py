@@ -0,0 +1,124 @@
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer(object):
+    # Collects spans (timed phases of the run, like downloading a package or
+    # building a probe, with attributes like the kernel release) and saves them
+    # as a Chrome trace, for chrome://tracing or https://ui.perfetto.dev
+    #
+    # Every thread and every asyncio task (i.e. the build of one kernel)
+    # gets its own track, so that the spans on a track always nest.
+    # Tracing is off (and spans cost next to nothing) until start() is called.
+
+    def __init__(self):
+        self.path = None
+        self.lock = threading.Lock()
+        self.events = []
+        self.tracks = {}
+        # keyed by the task itself, as the id of a finished task may get reused
+        self.task_tracks = weakref.WeakKeyDictionary()
+        self.next_tid = 1
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter()
+
+    def start(self, path):
+        self.path = path
+        self.t0 = time.perf_counter()
+
+    def _track(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            tracks, key, name = self.task_tracks, task, task.get_name()
+        else:
+            thread = threading.current_thread()
+            tracks, key, name = self.tracks, thread.ident, thread.name
+        with self.lock:
+            tid = tracks.get(key)
+            if tid is None:
+                tid = self.next_tid
+                self.next_tid += 1
+                tracks[key] = tid
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                    'args': {'name': name}})
+            return tid
+
+    @contextmanager
+    def span(self, name, category='build', **args):
+        if self.path is None:
+            yield
+            return
+        tid = self._track()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((start - self.t0) * 1e6, 1),
+                'dur': round((end - start) * 1e6, 1),
+                'pid': self.pid,
+                'tid': tid,
+                'args': args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            events = list(self.events)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp, default=str)
+        os.rename(tmp_path, self.path)
+        logger.info('Saved {} trace events to {}'.format(len(events), self.path))
+
+
+tracer = Tracer()
+
+
+def start(path):
+    tracer.start(path)
+
+
+def span(name, category='build', **args):
+    return tracer.span(name, category, **args)
+
+
+def save():
+    tracer.save()
+
+
+def traced(category, *arg_names):
+    # decorator: a span for every call, named after the function,
+    # with the values of the named arguments as attributes
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer.path is None:
+                return fn(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs).arguments
+            with tracer.span(fn.__name__, category, **{name: arguments.get(name) for name in arg_names}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
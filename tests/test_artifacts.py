@@ -0,0 +1,91 @@
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+
+from probe_builder.builder import artifacts
+from probe_builder.context import Probe
+
+
+class ArtifactStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'artifacts')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def output_file(self, name, content=None):
+        path = os.path.join(self.output_dir, name)
+        if content is not None:
+            with open(path, 'wb') as fp:
+                fp.write(content)
+        return path
+
+    def test_fingerprint(self):
+        probe = Probe('/code/sysdig', 'sysdigcloud-probe', '12.0.3', 'sysdigcloud')
+        fp = artifacts.fingerprint('x86_64', probe, '5.4.0', 'abc', 'headers', 'builder', 'kmod')
+        self.assertEqual(fp, artifacts.fingerprint('x86_64', probe, '5.4.0', 'abc', 'headers', 'builder', 'kmod'))
+        self.assertNotEqual(fp, artifacts.fingerprint('x86_64', probe, '5.4.0', 'abc', 'headers', 'builder', 'ebpf'))
+
+    def test_header_digest(self):
+        kernel_dir = os.path.join(self.tmp_dir, 'kernel')
+        os.makedirs(os.path.join(kernel_dir, 'include/generated'))
+        with open(os.path.join(kernel_dir, '.config'), 'w') as fp:
+            fp.write('CONFIG_X=y\n')
+        digest = artifacts.header_digest(kernel_dir)
+        # only the header files count
+        with open(os.path.join(kernel_dir, 'README'), 'w') as fp:
+            fp.write('hello\n')
+        self.assertEqual(artifacts.header_digest(kernel_dir), digest)
+        with open(os.path.join(kernel_dir, 'include/generated/autoconf.h'), 'w') as fp:
+            fp.write('#define CONFIG_X 1\n')
+        self.assertNotEqual(artifacts.header_digest(kernel_dir), digest)
+
+    def test_store_and_fetch(self):
+        store = artifacts.ArtifactStore(self.root)
+        built = self.output_file('probe-5.4.0-abc.ko', b'module')
+        store.store(built, 'f00d')
+
+        reused = self.output_file('probe-5.4.0-def.ko')
+        self.assertTrue(store.fetch('f00d', reused))
+        self.assertEqual(os.stat(reused).st_ino, os.stat(built).st_ino)
+        self.assertEqual(os.stat(store.path('f00d', '.ko')).st_ino, os.stat(built).st_ino)
+        # nothing under this fingerprint (or extension)
+        self.assertFalse(store.fetch('beef', self.output_file('probe-5.15.0-abc.ko')))
+        self.assertFalse(store.fetch('f00d', self.output_file('probe-5.4.0-abc.o')))
+        self.assertFalse(os.path.exists(self.output_file('probe-5.15.0-abc.ko')))
+
+    def test_same_content(self):
+        store = artifacts.ArtifactStore(self.root)
+        first = self.output_file('probe-5.4.0-abc.ko', b'module')
+        second = self.output_file('probe-5.4.1-abc.ko', b'module')
+        other = self.output_file('probe-5.4.2-abc.ko', b'other module')
+        for path in (first, second, other):
+            store.store(path)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(other).st_ino)
+        self.assertEqual(os.stat(first).st_nlink, 3)
+        self.assertEqual(len(os.listdir(os.path.join(self.root, 'objects'))), 2)
+
+    def test_compress(self):
+        store = artifacts.ArtifactStore(self.root, compress=True)
+        kmod = self.output_file('probe-5.4.0-abc.ko', b'module' * 100)
+        same = self.output_file('probe-5.4.1-abc.ko', b'module' * 100)
+        ebpf = self.output_file('probe-bpf-5.4.0-abc.o', b'ebpf')
+        for path in (kmod, same, ebpf):
+            store.store(path)
+        store.close()
+
+        with lzma.open(kmod + '.xz') as fp:
+            self.assertEqual(fp.read(), b'module' * 100)
+        # compressed once
+        self.assertEqual(os.stat(kmod + '.xz').st_ino, os.stat(same + '.xz').st_ino)
+        self.assertFalse(os.path.exists(ebpf + '.xz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
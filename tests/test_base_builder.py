@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from probe_builder.builder.distro.base_builder import DistroBuilder
+
+
+class ConfigFileBuilder(DistroBuilder):
+    # the config hash is whatever the unpacked kernel's `config` file says
+    def __init__(self):
+        self.hashed = []
+
+    def hash_config(self, release, target):
+        self.hashed.append(release)
+        with open(os.path.join(target, 'config')) as fp:
+            return fp.read()
+
+    def get_kernel_dir(self, workspace, release, target):
+        return target
+
+
+class UniqueBuildsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.builder = ConfigFileBuilder()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def unpack(self, name, config):
+        target = os.path.join(self.tmp_dir, name)
+        os.makedirs(target)
+        with open(os.path.join(target, 'config'), 'w') as fp:
+            fp.write(config)
+        return target
+
+    def test_same_kernel_in_several_releases(self):
+        el7 = self.unpack('3.10.0', 'abc')
+        kernel_dirs = [
+            (('7', '3.10.0'), el7),
+            (('7.9', '3.10.0'), el7),
+            (('7', '3.10.1'), self.unpack('3.10.1', 'def')),
+            ('5.4.0', self.unpack('5.4.0', 'abc')),
+        ]
+        self.assertEqual(sorted(self.builder.unique_builds(None, kernel_dirs)), [
+            ('3.10.0', el7, [('7', '3.10.0'), ('7.9', '3.10.0')]),
+            ('3.10.1', os.path.join(self.tmp_dir, '3.10.1'), [('7', '3.10.1')]),
+            ('5.4.0', os.path.join(self.tmp_dir, '5.4.0'), ['5.4.0']),
+        ])
+
+    def test_same_release_in_different_directories(self):
+        # e.g. os and updates shipping different builds of the same release
+        os_dir = self.unpack('os', 'abc')
+        updates_dir = self.unpack('updates', 'def')
+        builds = self.builder.unique_builds(None, [(('7', '3.10.0'), os_dir), (('7u', '3.10.0'), updates_dir)])
+        self.assertEqual(len(builds), 2)
+
+    def test_broken_kernel(self):
+        missing = os.path.join(self.tmp_dir, 'missing')
+        self.assertEqual(self.builder.unique_builds(None, [('5.4.0', missing)]), [('5.4.0', missing, ['5.4.0'])])
+
+    def test_saved_metadata(self):
+        target = self.unpack('5.4.0', 'abc')
+        self.assertEqual(self.builder.kernel_metadata(None, '5.4.0', target)[0], 'abc')
+        self.assertEqual(self.builder.kernel_metadata(None, '5.4.0', target)[0], 'abc')
+        self.assertEqual(self.builder.hashed, ['5.4.0'])
+
+        # unpacking a package again touches its marker file
+        marker = os.path.join(target, '.5.4.0.deb')
+        open(marker, 'w').close()
+        stat = os.stat(marker)
+        os.utime(marker, (stat.st_atime + 10, stat.st_mtime + 10))
+        with open(os.path.join(target, 'config'), 'w') as fp:
+            fp.write('def')
+        self.assertEqual(self.builder.kernel_metadata(None, '5.4.0', target)[0], 'def')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from probe_builder.builder import builder_image, endpoints
+from probe_builder.context import Probe, Workspace
+
+
+class PrepareSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.workspace = Workspace('x86_64', 'x86_64', True, None, self.tmp_dir, '/root/package', '')
+        self.probe = Probe('/code/sysdig', 'sysdigcloud-probe', '12.0.3', 'sysdigcloud')
+        self.runs = []
+        patcher = mock.patch.object(builder_image.docker, 'run', self.fake_run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(builder_image.prepared_sources.clear)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fake_run(self, image_name, volumes, args, env, arch=None, host=None, copy_volumes=False):
+        self.runs.append(host)
+        prepared = [v.host_path for v in volumes if v.container_path == '/code/prepared'][0]
+        with open(os.path.join(prepared, '.configured'), 'w') as fp:
+            fp.write('1\n')
+
+    def prepare(self, endpoint=None):
+        return builder_image.prepare_source(self.workspace._replace(endpoint=endpoint), self.probe,
+                                            'sysdig-probe-builder:ubuntu-gcc9', 'ubuntu-gcc9')
+
+    def test_once_per_daemon(self):
+        remote = endpoints.Endpoint('tcp://builder:2375', shared=False)
+        local = self.prepare()
+        self.assertEqual(local, os.path.join(self.tmp_dir, 'prepared', 'sysdigcloud-probe-12.0.3', 'ubuntu-gcc9'))
+        self.assertEqual(self.prepare(), local)
+        prepared = self.prepare(remote)
+        self.assertEqual(os.path.basename(prepared), 'ubuntu-gcc9@tcp_builder_2375')
+        self.assertEqual(self.prepare(remote), prepared)
+        self.assertEqual(self.runs, [None, 'tcp://builder:2375'])
+        self.assertTrue(os.path.exists(os.path.join(prepared, '.configured')))
+
+        # a new run finds them in the workspace
+        builder_image.prepared_sources.clear()
+        self.assertEqual(self.prepare(remote), prepared)
+        self.assertEqual(len(self.runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
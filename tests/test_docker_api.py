@@ -0,0 +1,202 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import socketserver
+import struct
+import tarfile
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+from probe_builder import docker, docker_api, spawn
+
+
+class StubDaemon(BaseHTTPRequestHandler):
+    # just enough of the Docker Engine API to run a container:
+    # the requests go to server.requests, the container prints server.output
+    # and has a single file (server.archive_files) in the directory we copy back
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='application/json', chunked=False):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 5):
+                chunk = body[i:i + 5]
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.requests.append((self.command, url.path, query, body))
+
+        if (self.command, url.path) == ('POST', '/containers/create'):
+            self.reply(201, {'Id': 'c0ffee'})
+        elif (self.command, url.path) == ('PUT', '/containers/c0ffee/archive'):
+            self.reply(200, content_type='text/plain')
+        elif (self.command, url.path) == ('POST', '/containers/c0ffee/start'):
+            self.reply(204, content_type='text/plain')
+        elif (self.command, url.path) == ('GET', '/containers/c0ffee/logs'):
+            frames = b''.join(struct.pack('>BxxxL', 1, len(line)) + line for line in self.server.output)
+            self.reply(200, frames, 'application/vnd.docker.raw-stream', chunked=True)
+        elif (self.command, url.path) == ('POST', '/containers/c0ffee/wait'):
+            self.reply(200, {'StatusCode': self.server.exit_code})
+        elif (self.command, url.path) == ('GET', '/containers/c0ffee/archive'):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w') as tar:
+                info = tarfile.TarInfo('output')
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+                for name, data in self.server.archive_files.items():
+                    info = tarfile.TarInfo('output/' + name)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            self.reply(200, buf.getvalue(), 'application/x-tar')
+        elif (self.command, url.path) == ('DELETE', '/containers/c0ffee'):
+            self.reply(204, content_type='text/plain')
+        elif (self.command, url.path) == ('POST', '/images/create'):
+            self.reply(200, b''.join(json.dumps(status).encode('utf-8') + b'\r\n' for status in self.server.pull),
+                       chunked=True)
+        else:
+            self.reply(404, {'message': 'no such endpoint'})
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+
+class DockerApiTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(self.tmp_dir, 'docker.sock')
+        self.server = socketserver.ThreadingUnixStreamServer(socket_path, StubDaemon)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.output = [b'building\n', b'done\n']
+        self.server.exit_code = 0
+        self.server.archive_files = {'probe.ko': b'module'}
+        self.server.pull = [{'status': 'Pulling from library/builder'}, {'status': 'Downloaded newer image'}]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = 'unix://' + socket_path
+
+        self.source_dir = os.path.join(self.tmp_dir, 'source')
+        os.makedirs(self.source_dir)
+        with open(os.path.join(self.source_dir, 'Makefile'), 'w') as fp:
+            fp.write('all:\n')
+        os.makedirs(os.path.join(self.source_dir, '.git', 'objects'))
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.output_dir)
+        self.volumes = [
+            docker.DockerVolume(self.source_dir, '/code/source', True),
+            docker.DockerVolume(self.output_dir, '/output', False),
+        ]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def run_container(self):
+        return docker.run('builder', self.volumes, ['all'], [docker.EnvVar('HASH', 'abc')], name='test',
+                          host=self.host, copy_volumes=True)
+
+    def test_run(self):
+        stdout = self.run_container()
+        self.assertEqual(stdout, b'building\ndone\n')
+
+        calls = [(method, path) for method, path, _, _ in self.server.requests]
+        self.assertEqual(calls, [
+            ('POST', '/containers/create'),
+            # the writable volumes start out as empty directories
+            ('PUT', '/containers/c0ffee/archive'),
+            ('PUT', '/containers/c0ffee/archive'),
+            ('POST', '/containers/c0ffee/start'),
+            ('GET', '/containers/c0ffee/logs'),
+            ('POST', '/containers/c0ffee/wait'),
+            ('GET', '/containers/c0ffee/archive'),
+            ('DELETE', '/containers/c0ffee'),
+        ])
+
+        _, _, query, body = self.server.requests[0]
+        self.assertEqual(query['name'], ['test'])
+        config = json.loads(body.decode('utf-8'))
+        self.assertEqual(config['Image'], 'builder')
+        self.assertEqual(config['Cmd'], ['all'])
+        self.assertEqual(config['Env'], ['HASH=abc'])
+        # the volumes get copied instead of bind mounted
+        self.assertEqual(config['HostConfig']['Binds'], [])
+
+        _, _, query, body = self.server.requests[1]
+        self.assertEqual(query['path'], ['/'])
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertIn('code/source/Makefile', tar.getnames())
+            # without the git metadata
+            self.assertNotIn('code/source/.git', tar.getnames())
+            self.assertNotIn('code/source/.git/objects', tar.getnames())
+
+        _, _, query, body = self.server.requests[2]
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            self.assertEqual(tar.getnames(), ['output'])
+
+        _, _, query, _ = self.server.requests[6]
+        self.assertEqual(query['path'], ['/output'])
+        with open(os.path.join(self.output_dir, 'probe.ko'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'module')
+
+    def test_run_failure(self):
+        self.server.exit_code = 2
+        with self.assertRaises(docker.subprocess.CalledProcessError) as cm:
+            self.run_container()
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertEqual(cm.exception.output, b'building\ndone\n')
+        # the container gets removed all the same
+        calls = [(method, path) for method, path, _, _ in self.server.requests]
+        self.assertEqual(calls[-1], ('DELETE', '/containers/c0ffee'))
+
+    def test_run_in_event_loop(self):
+        async def run_in_loop():
+            return self.run_container()
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(run_in_loop())
+        # nothing got started
+        self.assertEqual(self.server.requests, [])
+
+    def test_pull_image(self):
+        asyncio.run(docker_api.client(self.host).pull_image('builder:1.0'))
+        _, path, query, _ = self.server.requests[0]
+        self.assertEqual((path, query), ('/images/create', {'fromImage': ['builder'], 'tag': ['1.0']}))
+
+    def test_pull_image_error(self):
+        # the progress lines arrive in small chunks
+        self.server.pull.append({'errorDetail': {'message': 'manifest unknown'}, 'error': 'manifest unknown'})
+        with self.assertRaises(docker_api.APIError) as cm:
+            asyncio.run(docker_api.client(self.host).pull_image('builder'))
+        self.assertEqual(cm.exception.message, 'manifest unknown')
+
+    def test_pipe_in_event_loop(self):
+        async def pipe_in_loop():
+            return spawn.pipe(['true'])
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(pipe_in_loop())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from probe_builder.builder import endpoints
+
+
+class EndpointPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.down = set()
+        patcher = mock.patch.object(endpoints.docker, 'ping', lambda host: host not in self.down)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse(self):
+        endpoint = endpoints.Endpoint.parse('tcp://builder:2375,slots=4,copy')
+        self.assertEqual((endpoint.host, endpoint.slots, endpoint.shared), ('tcp://builder:2375', 4, False))
+        self.assertIsNone(endpoints.Endpoint.parse('default').host)
+        with self.assertRaises(ValueError):
+            endpoints.Endpoint.parse('default,slots=0')
+
+    def test_slots(self):
+        pool = endpoints.EndpointPool([endpoints.Endpoint('a', 2), endpoints.Endpoint('b', 1)])
+        busy = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        async def build():
+            endpoint = await pool.acquire_async()
+            busy[endpoint.host] += 1
+            peak[endpoint.host] = max(peak[endpoint.host], busy[endpoint.host])
+            await asyncio.sleep(0.01)
+            busy[endpoint.host] -= 1
+            pool.release(endpoint)
+
+        async def run():
+            await asyncio.gather(*[build() for _ in range(10)])
+
+        asyncio.run(run())
+        self.assertEqual(peak, {'a': 2, 'b': 1})
+        self.assertEqual([endpoint.busy for endpoint in pool.endpoints], [0, 0])
+
+    def test_unhealthy_endpoint(self):
+        self.down.add('a')
+        pool = endpoints.EndpointPool([endpoints.Endpoint('a', 4), endpoints.Endpoint('b', 1)])
+
+        async def run():
+            return (await pool.acquire_async()).host
+
+        self.assertEqual(asyncio.run(run()), 'b')
+        self.assertFalse(pool.endpoints[0].healthy)
+
+    def test_no_healthy_endpoint(self):
+        self.down.update(['a', 'b'])
+        pool = endpoints.EndpointPool([endpoints.Endpoint('a'), endpoints.Endpoint('b')])
+
+        async def run():
+            await pool.acquire_async()
+
+        with self.assertRaises(endpoints.NoHealthyEndpoint):
+            asyncio.run(asyncio.wait_for(run(), 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from probe_builder.builder import builder_image
+from probe_builder.builder.distro import base_builder, flatcar
+from probe_builder.context import Probe, Workspace
+
+Result = base_builder.DistroBuilder.ProbeBuildResult
+
+
+class FlatcarBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.workspace = Workspace('x86_64', 'x86_64', True, None, self.tmp_dir, '/root/package', '')
+        self.output_dir = self.workspace.subdir('output')
+        os.makedirs(self.output_dir)
+        self.probe = Probe('/code/sysdig', 'sysdigcloud-probe', '12.0.3', 'sysdigcloud')
+        # the development container of Flatcar 3227.2.0 ships kernel 5.15.63-flatcar
+        self.kernel_dir = self.workspace.subdir('build', 'flatcar', '3227.2.0', 'modules', '5.15.63-flatcar', 'build')
+        self.runs = []
+        self.failing = False
+        for target, fn in ((builder_image, 'run'), (flatcar.docker, 'rm_async')):
+            patcher = mock.patch.object(target, fn, getattr(self, 'fake_' + fn))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        builder_image.output_indexes.pop(self.output_dir, None)
+        shutil.rmtree(self.tmp_dir)
+
+    async def fake_rm_async(self, container_name):
+        pass
+
+    async def fake_run(self, workspace, probe, kernel_dir, kernel_release, config_hash, container_name, image_name,
+                       args, prepared_dir=None, cpus=None, log_path=None):
+        self.runs.append((kernel_release, args))
+        if self.failing:
+            raise subprocess.CalledProcessError(2, 'docker run', b'error: no rule to make target')
+        path = os.path.join(self.output_dir, builder_image.probe_output_file(
+            workspace.machine, probe, kernel_release, config_hash, args == ['bpf']))
+        open(path, 'w').close()
+        return b'done'
+
+    def build(self, bpf=False, skip_reason=None):
+        return asyncio.run(flatcar.FlatcarBuilder.build_kernel_impl(
+            'abc', '', 'builder', self.kernel_dir, self.probe, '3227.2.0', self.workspace, bpf, skip_reason))
+
+    def build_combined(self):
+        return asyncio.run(flatcar.FlatcarBuilder.build_kernel_combined_impl(
+            'abc', '', 'builder', self.kernel_dir, self.probe, '3227.2.0', self.workspace))
+
+    def test_built(self):
+        result = self.build_combined()
+        self.assertEqual((result.kmod_result.build_result_string(), result.ebpf_result.build_result_string()),
+                         ('BUILT', 'BUILT'))
+        self.assertEqual(self.runs, [('5.15.63-flatcar', []), ('5.15.63-flatcar', ['bpf'])])
+        self.assertEqual(result.kmod_result.log_path,
+                         'logs/sysdigcloud-probe-12.0.3/5.15.63-flatcar-abc-kmod.log.gz')
+        # built for the kernel release, not the Flatcar release
+        self.assertEqual(self.build().build_result_string(), 'EXISTING')
+
+    def test_failed(self):
+        self.failing = True
+        result = self.build()
+        self.assertEqual(result.build_result_string(), 'FAILED')
+        self.assertEqual(result.error_log, b'error: no rule to make target')
+
+    def test_skipped(self):
+        self.assertEqual(self.build(True, 'Builder does not support eBPF').build_result_string(), 'SKIPPED')
+        self.assertEqual(self.runs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import probe_builder
+from probe_builder.builder import journal
+
+SIGNATURE = {'probe_version': '12.0.3', 'kernel_filter': None}
+
+
+class RunJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'journal.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def reopen(self, run_journal, signature=SIGNATURE):
+        run_journal.close()
+        run_journal = journal.RunJournal(self.path, signature)
+        self.addCleanup(run_journal.close)
+        return run_journal
+
+    def test_nothing_to_resume(self):
+        run_journal = journal.RunJournal(self.path, SIGNATURE)
+        self.addCleanup(run_journal.close)
+        self.assertIsNone(run_journal.packages())
+
+    def test_resume(self):
+        run_journal = journal.RunJournal(self.path, SIGNATURE)
+        run_journal.start({('7', '3.10.0'): ['a.rpm'], '5.4.0': ['b.deb']})
+        run_journal.record_unpacked(('7', '3.10.0'), [(('7', '3.10.0'), '/ws/7/3.10.0')])
+        run_journal.record_built(('7', '3.10.0'), {'kmod': 'BUILT'})
+
+        run_journal = self.reopen(run_journal)
+        self.assertEqual(run_journal.packages(), {('7', '3.10.0'): ['a.rpm'], '5.4.0': ['b.deb']})
+        self.assertEqual(run_journal.unpacked(), {('7', '3.10.0'): [(('7', '3.10.0'), '/ws/7/3.10.0')]})
+        self.assertEqual(run_journal.built(), {('7', '3.10.0'): {'kmod': 'BUILT'}})
+
+    def test_different_run(self):
+        run_journal = journal.RunJournal(self.path, SIGNATURE)
+        run_journal.start({'5.4.0': ['b.deb']})
+        run_journal = self.reopen(run_journal, dict(SIGNATURE, kernel_filter='5.15'))
+        self.assertIsNone(run_journal.packages())
+
+    def test_start_over(self):
+        run_journal = journal.RunJournal(self.path, SIGNATURE)
+        run_journal.start({'5.4.0': ['b.deb']})
+        run_journal.record_unpacked('5.4.0', [('5.4.0', '/ws/5.4.0')])
+        run_journal.record_built('5.4.0', {'kmod': 'BUILT'})
+        run_journal.start({'5.15.0': ['c.deb']})
+        self.assertEqual(run_journal.packages(), {'5.15.0': ['c.deb']})
+        self.assertEqual(run_journal.unpacked(), {})
+        self.assertEqual(run_journal.built(), {})
+        run_journal.close()
+
+
+class UnpackPackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_journal = journal.RunJournal(os.path.join(self.tmp_dir, 'journal.sqlite'), SIGNATURE)
+        self.distro_obj = mock.Mock()
+        self.distro_obj.get_job_kernels.side_effect = lambda workspace, jobs, config, download=True: jobs
+        self.distro_obj.distro_builder.unpack_kernels.side_effect = \
+            lambda workspace, distro, kernels: [(release, '/ws/' + release) for pkgs in kernels.values()
+                                                for release in pkgs]
+
+    def tearDown(self):
+        self.run_journal.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resume_unpacking(self):
+        packages = {'a': ['5.4.0'], 'b': ['5.15.0', '5.4.0']}
+        self.run_journal.start(packages)
+        self.run_journal.record_unpacked('a', [('5.4.0', '/ws/old/5.4.0')])
+
+        kernel_dirs = probe_builder.unpack_packages(self.distro_obj, packages, None, None, self.run_journal)
+        # only what the interrupted run didn't get to
+        download = self.distro_obj.get_job_kernels.call_args_list[0]
+        self.assertEqual(download[0][1], {'b': ['5.15.0', '5.4.0']})
+        self.assertEqual(self.distro_obj.distro_builder.unpack_kernels.call_count, 1)
+        # the last crawler key wins
+        self.assertEqual(sorted(kernel_dirs), [('5.15.0', '/ws/5.15.0'), ('5.4.0', '/ws/5.4.0')])
+        self.assertEqual(self.run_journal.unpacked()['b'], [('5.15.0', '/ws/5.15.0'), ('5.4.0', '/ws/5.4.0')])
+
+        # nothing left to do
+        self.distro_obj.reset_mock()
+        probe_builder.unpack_packages(self.distro_obj, packages, None, None, self.run_journal)
+        self.distro_obj.get_job_kernels.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from probe_builder.builder import ledger
+from probe_builder.context import Probe
+
+
+class BuildLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ledger.sqlite')
+        self.probe = Probe('/code/sysdig', 'sysdigcloud-probe', '12.0.3', 'sysdigcloud')
+        self.ledger = ledger.BuildLedger(self.path)
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def record(self, result, image_digest='sha256:1', kind='kmod'):
+        self.ledger.record(self.probe, 'x86_64', '5.4.0', 'abc', kind, 'builder:ubuntu', image_digest, result,
+                           12.5, b'error: something', 'logs/5.4.0-abc-kmod.log.gz')
+
+    def known_failure(self, image_digest='sha256:1', kind='kmod'):
+        return self.ledger.known_failure(self.probe, 'x86_64', '5.4.0', 'abc', kind, image_digest)
+
+    def test_unknown(self):
+        self.assertFalse(self.known_failure())
+
+    def test_known_failure(self):
+        self.record('FAILED')
+        self.assertTrue(self.known_failure())
+        # only for this kind
+        self.assertFalse(self.known_failure(kind='ebpf'))
+        # the builder image changed, worth another try
+        self.assertFalse(self.known_failure('sha256:2'))
+        # no digest to compare with
+        self.assertTrue(self.known_failure(None))
+
+    def test_built(self):
+        self.record('FAILED')
+        self.record('BUILT')
+        self.assertFalse(self.known_failure())
+        rows = self.ledger.results(result='BUILT')
+        self.assertEqual([row[:8] for row in rows], [
+            ('sysdigcloud-probe', '12.0.3', 'x86_64', '5.4.0', 'abc', 'kmod', 'builder:ubuntu', 'BUILT')])
+
+    def test_retry_failed(self):
+        self.record('FAILED')
+        retrying = ledger.BuildLedger(self.path, retry_failed=True)
+        try:
+            self.assertFalse(retrying.known_failure(self.probe, 'x86_64', '5.4.0', 'abc', 'kmod', 'sha256:1'))
+        finally:
+            retrying.close()
+
+    def test_record_existing(self):
+        self.record('FAILED')
+        self.ledger.record_existing(self.probe, 'x86_64', '5.4.0', 'abc', 'kmod')
+        self.ledger.record_existing(self.probe, 'x86_64', '5.4.0', 'abc', 'ebpf')
+        self.assertFalse(self.known_failure())
+        self.assertEqual([(row[5], row[7]) for row in self.ledger.results()], [('ebpf', 'EXISTING'),
+                                                                                ('kmod', 'EXISTING')])
+        # a probe we know who built stays that way
+        self.record('BUILT', kind='ebpf')
+        self.ledger.record_existing(self.probe, 'x86_64', '5.4.0', 'abc', 'ebpf')
+        self.assertEqual(self.ledger.results(result='BUILT')[0][5], 'ebpf')
+
+    def test_log_paths(self):
+        self.record('FAILED')
+        self.ledger.record_existing(self.probe, 'x86_64', '5.4.0', 'abc', 'ebpf')
+        self.assertEqual(self.ledger.log_paths('5.4.0'), [
+            ('sysdigcloud-probe', '12.0.3', 'x86_64', 'abc', 'kmod', 'FAILED', 'logs/5.4.0-abc-kmod.log.gz')])
+        self.assertEqual(self.ledger.log_paths('5.4.0', kind='ebpf'), [])
+
+    def test_persistent(self):
+        self.record('FAILED')
+        self.ledger.close()
+        self.ledger = ledger.BuildLedger(self.path)
+        self.assertTrue(self.known_failure())
+
+
+if __name__ == '__main__':
+    unittest.main()
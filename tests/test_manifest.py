@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from probe_builder.builder import manifest
+
+PROBE = ('sysdigcloud-probe', '12.0.3')
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def probe(self, name, content):
+        path = os.path.join(self.output_dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(content)
+        return path
+
+    def write_manifest(self):
+        with mock.patch.object(manifest, 'file_digest', side_effect=manifest.file_digest) as file_digest:
+            path = manifest.write_manifest(self.output_dir, PROBE[0], PROBE[1], self.tmp_dir)
+        return path, sorted(os.path.basename(call[0][0]) for call in file_digest.call_args_list)
+
+    def test_parse_probe_file_name(self):
+        self.assertEqual(manifest.parse_probe_file_name(*PROBE, 'sysdigcloud-probe-12.0.3-x86_64-5.4.0-1-aws-abc.ko'),
+                         ('x86_64', '5.4.0-1-aws', 'abc', 'kmod'))
+        self.assertEqual(manifest.parse_probe_file_name(*PROBE, 'sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko.xz'),
+                         ('x86_64', '5.4.0', 'abc', 'kmod-xz'))
+        self.assertEqual(manifest.parse_probe_file_name(*PROBE, 'sysdigcloud-probe-bpf-12.0.3-x86_64-5.4.0-abc.o'),
+                         ('x86_64', '5.4.0', 'abc', 'ebpf'))
+        # another version, or no config hash
+        self.assertIsNone(manifest.parse_probe_file_name(*PROBE, 'sysdigcloud-probe-12.0.2-x86_64-5.4.0-abc.ko'))
+        self.assertIsNone(manifest.parse_probe_file_name(*PROBE, 'sysdigcloud-probe-12.0.3-x86_64-abc.ko'))
+
+    def test_write_manifest(self):
+        self.probe('sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko', b'module')
+        self.probe('sysdigcloud-probe-bpf-12.0.3-x86_64-5.4.0-abc.o', b'ebpf')
+        self.probe('sysdigcloud-probe-12.0.2-x86_64-5.4.0-abc.ko', b'old module')
+        path, _ = self.write_manifest()
+
+        self.assertEqual(path, os.path.join(self.output_dir, 'sysdigcloud-probe-12.0.3.manifest'))
+        entries = manifest.read_manifest(path)
+        self.assertEqual(sorted(entries), ['sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko',
+                                           'sysdigcloud-probe-bpf-12.0.3-x86_64-5.4.0-abc.o'])
+        entry = entries['sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko']
+        self.assertEqual((entry['kind'], entry['size'], entry['sha256']),
+                         ('kmod', '6', hashlib.sha256(b'module').hexdigest()))
+        # nothing but the probes and the manifest gets published
+        self.assertEqual(len(os.listdir(self.output_dir)), 4)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, '.sysdigcloud-probe-12.0.3.manifest.stat')))
+
+    def test_stat_cache(self):
+        kmod = self.probe('sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko', b'module')
+        self.probe('sysdigcloud-probe-bpf-12.0.3-x86_64-5.4.0-abc.o', b'ebpf')
+        self.write_manifest()
+        self.assertEqual(self.write_manifest()[1], [])
+
+        # a new probe, and one replaced by a hard link to another file of the same size
+        self.probe('sysdigcloud-probe-12.0.3-x86_64-5.4.1-abc.ko', b'new')
+        other = os.path.join(self.tmp_dir, 'other.ko')
+        with open(other, 'wb') as fp:
+            fp.write(b'MODULE')
+        os.unlink(kmod)
+        os.link(other, kmod)
+        path, hashed = self.write_manifest()
+        self.assertEqual(hashed, ['sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko',
+                                  'sysdigcloud-probe-12.0.3-x86_64-5.4.1-abc.ko'])
+        self.assertEqual(manifest.read_manifest(path)['sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko']['sha256'],
+                         hashlib.sha256(b'MODULE').hexdigest())
+
+    def test_hard_links_hashed_once(self):
+        kmod = self.probe('sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko', b'module')
+        os.link(kmod, os.path.join(self.output_dir, 'sysdigcloud-probe-12.0.3-x86_64-5.4.1-abc.ko'))
+        self.assertEqual(len(self.write_manifest()[1]), 1)
+
+    def test_no_cache_dir(self):
+        self.probe('sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko', b'module')
+        # left over by an older version
+        self.probe('.sysdigcloud-probe-12.0.3.manifest.stat', b'{}')
+        manifest.write_manifest(self.output_dir, *PROBE)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['sysdigcloud-probe-12.0.3-x86_64-5.4.0-abc.ko',
+                                                               'sysdigcloud-probe-12.0.3.manifest'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+from probe_builder.builder import report
+
+
+class BuildReportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'report.ndjson')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_records(self):
+        build_report = report.BuildReport(self.path)
+        build_report.write({'distro_release': '7', 'kernel_release': '3.10.0', 'kmod': 'BUILT', 'ebpf': 'SKIPPED'})
+        build_report.write({'distro_release': '', 'kernel_release': '5.4.0', 'kmod': 'FAILED', 'ebpf': 'BUILT'})
+        build_report.close()
+        # a killed run
+        with open(self.path, 'a') as fp:
+            fp.write('{"distro_release": "", "kern')
+
+        self.assertEqual(list(build_report.results()), [
+            ('7', '3.10.0', 'BUILT', 'SKIPPED'),
+            ('', '5.4.0', 'FAILED', 'BUILT'),
+        ])
+
+    def test_junit(self):
+        records = [
+            {'distro_release': '7', 'kernel_release': '3.10.0', 'kmod': 'BUILT', 'ebpf': 'SKIPPED',
+             'kmod_build_time': 10.5, 'ebpf_build_time': 0, 'kmod_log_path': 'logs/3.10.0-kmod.log.gz'},
+            {'distro_release': '', 'kernel_release': '5.4.0', 'kmod': 'FAILED', 'ebpf': 'EXCEPTION',
+             'kmod_build_time': 2, 'kmod_log_path': 'logs/5.4.0-kmod.log.gz', 'error': 'Traceback <...>'},
+        ]
+        path = os.path.join(self.tmp_dir, 'junit.xml')
+        report.write_junit(lambda: iter(records), path)
+
+        suite = ET.parse(path).getroot()
+        self.assertEqual((suite.get('tests'), suite.get('failures'), suite.get('skipped'), suite.get('time')),
+                         ('4', '2', '1', '12.500'))
+        cases = {case.get('name'): case for case in suite.findall('testcase')}
+        self.assertEqual(sorted(cases), ['3.10.0 ebpf', '3.10.0 kmod', '5.4.0 ebpf', '5.4.0 kmod'])
+
+        self.assertEqual(cases['3.10.0 kmod'].get('classname'), '7')
+        self.assertIsNone(cases['3.10.0 kmod'].find('failure'))
+        self.assertEqual(cases['3.10.0 kmod'].find('system-out').text, 'logs/3.10.0-kmod.log.gz')
+        self.assertIsNotNone(cases['3.10.0 ebpf'].find('skipped'))
+
+        failure = cases['5.4.0 kmod'].find('failure')
+        self.assertEqual(cases['5.4.0 kmod'].get('classname'), 'kernels')
+        self.assertEqual(failure.get('message'), 'FAILED, see logs/5.4.0-kmod.log.gz')
+        self.assertEqual(failure.text, 'Traceback <...>')
+        self.assertEqual(cases['5.4.0 ebpf'].find('failure').get('type'), 'EXCEPTION')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from probe_builder.builder import endpoints, scheduler
+
+
+class BuildHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'build-history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimate_per_builder(self):
+        history = scheduler.BuildHistory(self.path)
+        self.assertEqual(history.estimate('5.4.0'), 0)
+        history.record('5.4.0', 'ubuntu-gcc9', 10)
+        history.record('5.4.0', 'ubuntu-gcc11', 30)
+        self.assertEqual(history.estimate('5.4.0', 'ubuntu-gcc9'), 10)
+        self.assertEqual(history.estimate('5.4.0', 'ubuntu-gcc11'), 30)
+        # anything else gets the mean
+        self.assertEqual(history.estimate('5.4.0', 'ubuntu-gcc12'), 20)
+        self.assertEqual(history.estimate('5.15.0'), 20)
+
+    def test_save_and_migrate(self):
+        with open(self.path, 'w') as fp:
+            json.dump({'5.4.0': {'builder': 'ubuntu-gcc9', 'duration': 12.5}}, fp)
+        history = scheduler.BuildHistory(self.path)
+        self.assertEqual(history.estimate('5.4.0', 'ubuntu-gcc9'), 12.5)
+        history.record('5.15.0', 'ubuntu-gcc11', 1)
+        history.save()
+        with open(self.path) as fp:
+            self.assertEqual(json.load(fp), {'5.4.0': {'ubuntu-gcc9': 12.5}, '5.15.0': {'ubuntu-gcc11': 1}})
+
+    def test_order(self):
+        history = scheduler.BuildHistory(self.path)
+        history.record('a', 'x', 1)
+        history.record('b', 'x', 3)
+        history.record('b', 'y', 2)
+        build_scheduler = scheduler.BuildScheduler(history, 1, 1)
+        kernel_dirs = [('a', 'ta'), (('7', 'b'), 'tb')]
+        self.assertEqual(build_scheduler.order(kernel_dirs, {'a': 'x', 'b': 'y'}), [(('7', 'b'), 'tb'), ('a', 'ta')])
+
+
+class BuildSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = scheduler.BuildHistory(os.path.join(self.tmp_dir, 'build-history.json'))
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.peak = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    async def build(self, build_scheduler):
+        cpus = await build_scheduler.acquire_cpus_async()
+        with self.lock:
+            self.busy += cpus
+            self.peak = max(self.peak, self.busy)
+        await asyncio.sleep(0.01)
+        with self.lock:
+            self.busy -= cpus
+        build_scheduler.release_cpus(cpus)
+
+    def test_more_slots_than_cpus(self):
+        build_scheduler = scheduler.BuildScheduler(self.history, 4, 2)
+
+        async def run():
+            await asyncio.gather(*[self.build(build_scheduler) for _ in range(8)])
+
+        asyncio.run(run())
+        self.assertEqual(self.peak, 2)
+        self.assertEqual(build_scheduler.budget().free_cpus, 2)
+
+    def test_shares(self):
+        build_scheduler = scheduler.BuildScheduler(self.history, 2, 8)
+
+        async def run():
+            first = await build_scheduler.acquire_cpus_async()
+            second = await build_scheduler.acquire_cpus_async()
+            return first, second
+
+        self.assertEqual(asyncio.run(run()), (4, 4))
+
+    def test_budget_per_endpoint(self):
+        a = endpoints.Endpoint('a', 2)
+        b = endpoints.Endpoint('b', 1)
+        build_scheduler = scheduler.BuildScheduler(self.history, 3, 4, [a, b])
+
+        async def run():
+            cpus = [await build_scheduler.acquire_cpus_async(endpoint) for endpoint in (a, a, b)]
+            # both daemons are busy
+            self.assertEqual([build_scheduler.budget(endpoint).free_cpus for endpoint in (a, b)], [0, 0])
+            waiting = asyncio.ensure_future(build_scheduler.acquire_cpus_async(a))
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiting.done())
+            # CPUs freed on another daemon don't help
+            build_scheduler.release_cpus(cpus[2], b)
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiting.done())
+            build_scheduler.release_cpus(cpus[0], a)
+            return cpus, await asyncio.wait_for(waiting, 5)
+
+        self.assertEqual(asyncio.run(run()), ([2, 2, 4], 2))
+
+    def test_event_loop_per_thread(self):
+        # like the work queue workers
+        build_scheduler = scheduler.BuildScheduler(self.history, 4, 1)
+
+        def worker():
+            async def run():
+                for _ in range(5):
+                    await self.build(build_scheduler)
+            asyncio.run(run())
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(self.peak, 1)
+        self.assertEqual(build_scheduler.budget().free_cpus, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from probe_builder.kernel_crawler.repo import Shard
+
+
+class ShardTest(unittest.TestCase):
+    def test_parse(self):
+        shard = Shard.parse('2/4')
+        self.assertEqual(shard, Shard(2, 4))
+        self.assertEqual(str(shard), '2/4')
+        for spec in ('0/4', '5/4', 'x/4', '1'):
+            with self.assertRaises(ValueError):
+                Shard.parse(spec)
+
+    def test_disjoint_and_complete(self):
+        kernels = {('7.{}'.format(i % 3), '3.10.0-{}.el7'.format(i)): ['url{}'.format(i)] for i in range(200)}
+        kernels.update({'5.4.0-{}'.format(i): [] for i in range(100)})
+        shards = [Shard(index, 4).filter(kernels) for index in range(1, 5)]
+        seen = {}
+        for shard in shards:
+            # the split is even enough for every shard to get something
+            self.assertTrue(shard)
+            for key, packages in shard.items():
+                self.assertNotIn(key, seen)
+                seen[key] = packages
+        self.assertEqual(seen, kernels)
+
+    def test_stable(self):
+        # the same split on every host and every run
+        key = ('7.9', '3.10.0-1160.el7')
+        self.assertEqual([Shard(index, 3).contains(key) for index in range(1, 4)].count(True), 1)
+        self.assertEqual(Shard(1, 1).contains(key), True)
+        self.assertEqual([Shard(index, 7).contains(key) for index in range(1, 8)],
+                         [Shard(index, 7).contains('7.9/3.10.0-1160.el7') for index in range(1, 8)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import subprocess
+import unittest
+
+from probe_builder import spawn
+
+
+class Sink(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class PipeTest(unittest.TestCase):
+    def test_output_tail(self):
+        sink = Sink()
+        cmd = ['python3', '-c', 'for i in range(20000): print(i)']
+        stdout = spawn.pipe(cmd, sink=sink)
+        # the sink gets everything, only the tail stays in memory
+        self.assertEqual(len(sink.lines), 20000)
+        self.assertEqual(len(stdout), spawn.MAX_OUTPUT)
+        self.assertTrue(stdout.endswith(b'\n19998\n19999\n'))
+
+    def test_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            spawn.pipe(['sh', '-c', 'echo oops; exit 3'], sink=Sink())
+        self.assertEqual((cm.exception.returncode, cm.exception.output), (3, b'oops\n'))
+
+    def test_timeout(self):
+        with self.assertRaises(subprocess.TimeoutExpired) as cm:
+            spawn.pipe(['sh', '-c', 'echo started; exec sleep 10'], sink=Sink(), timeout=0.5)
+        self.assertEqual(cm.exception.output, b'started\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
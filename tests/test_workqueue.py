@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from probe_builder.builder import workqueue
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'queue.sqlite')
+        self.queue = workqueue.WorkQueue(self.path, lease_time=60, max_attempts=2)
+        self.queue.set_settings({'probe_version': '12.0.3'})
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def expire(self):
+        # pretend the leases ran out
+        self.queue.db.execute('UPDATE jobs SET lease_expires=?', (time.time() - 1,))
+
+    def test_lease_and_complete(self):
+        self.assertEqual(self.queue.publish({('7', '3.10.0'): ['b.rpm', 'a.rpm'], '5.4.0': ['c.deb']}), 2)
+        job_id, key, packages = self.queue.lease('w1')
+        self.assertEqual((key, packages), (('7', '3.10.0'), ['a.rpm', 'b.rpm']))
+        other = self.queue.lease('w2')
+        self.assertEqual(other[1], '5.4.0')
+        self.assertIsNone(self.queue.lease('w3'))
+        self.assertFalse(self.queue.finished())
+
+        self.queue.complete('w1', job_id, [{'kmod': 'BUILT'}])
+        self.queue.complete('w2', other[0], [])
+        self.assertTrue(self.queue.finished())
+        self.assertEqual(self.queue.results(), [(('7', '3.10.0'), [{'kmod': 'BUILT'}]), ('5.4.0', [])])
+
+    def test_heartbeat(self):
+        self.queue.publish({'5.4.0': []})
+        job_id, _, _ = self.queue.lease('w1')
+        self.assertEqual(self.queue.heartbeat('w1', [job_id]), [])
+        self.assertEqual(self.queue.heartbeat('w2', [job_id]), [job_id])
+
+    def test_expired_lease(self):
+        self.queue.publish({'5.4.0': []})
+        job_id, _, _ = self.queue.lease('w1')
+        self.expire()
+        # back in the queue, w1 lost it
+        self.assertEqual(self.queue.lease('w2')[0], job_id)
+        self.assertEqual(self.queue.heartbeat('w1', [job_id]), [job_id])
+        # given up on after max_attempts
+        self.expire()
+        self.assertIsNone(self.queue.lease('w3'))
+        self.assertTrue(self.queue.finished())
+        self.assertEqual(self.queue.results(), [('5.4.0', None)])
+
+    def test_complete_twice(self):
+        self.queue.publish({'5.4.0': []})
+        job_id, _, _ = self.queue.lease('w1')
+        self.expire()
+        self.queue.lease('w2')
+        self.queue.complete('w2', job_id, [{'kmod': 'BUILT'}])
+        self.queue.complete('w1', job_id, [{'kmod': 'FAILED'}])
+        self.assertEqual(self.queue.results(), [('5.4.0', [{'kmod': 'BUILT'}])])
+
+    def test_publish_again(self):
+        self.queue.publish({'5.4.0': ['a.deb'], '5.15.0': ['b.deb']})
+        for _ in range(2):
+            job_id, _, _ = self.queue.lease('w1')
+            self.queue.complete('w1', job_id, [{'kmod': 'BUILT'}])
+
+        # a restarted coordinator keeps the finished jobs, unless their packages changed
+        self.assertFalse(self.queue.set_settings({'probe_version': '12.0.3'}))
+        self.assertEqual(self.queue.publish({'5.4.0': ['a.deb'], '5.15.0': ['b2.deb'], '6.1.0': []}), 2)
+        self.assertEqual(self.queue.counts(), {workqueue.WorkQueue.DONE: 1, workqueue.WorkQueue.QUEUED: 2})
+        self.assertEqual(dict(self.queue.results())['5.15.0'], None)
+
+        # a different run starts over
+        self.assertTrue(self.queue.set_settings({'probe_version': '12.1.0'}))
+        self.assertEqual(self.queue.results(), [])
+        self.assertEqual(self.queue.settings(), {'probe_version': '12.1.0'})
+
+
+if __name__ == '__main__':
+    unittest.main()